@@ -0,0 +1,267 @@
+"""
+Sleep suggestions: the OpenAI-backed coach and its rule-based fallback.
+The caller is responsible for setting `openai.api_key` (see load_dotenv in the app).
+"""
+import random
+
+import openai
+
+from sleepaid_analytics import bedtime_difference
+from sleepaid_cache import TTLS, get_cache, make_key
+from sleepaid_openai import SuggestionUnavailable, get_client
+from sleepaid_profiles import GOAL_MAP, STRUGGLE_MAP
+from sleepaid_records import as_record, format_hhmm, has_valid_time
+from sleepaid_scoring import COMPONENTS, get_scoring_model, score_logs
+
+
+def get_user_goal_for_ai(user_profile):
+    user_profile = user_profile or {}
+    # Migrated profiles keep it under sleep_patterns (see get_user_profile in the app)
+    sleep_patterns = user_profile.get('sleep_patterns', {}) or {}
+    if sleep_patterns.get('goal'):
+        if sleep_patterns['goal'] == "Custom goal":
+            return sleep_patterns.get('goal_custom') or 'Custom goal'
+        return sleep_patterns['goal']
+    onboarding = user_profile.get('onboarding', {}) or {}
+    if onboarding.get('goal'):
+        if onboarding['goal'] == 'custom':
+            return onboarding.get('goal_custom', 'Custom goal')
+        return GOAL_MAP.get(onboarding['goal'], onboarding['goal'])
+    # fallback legacy
+    return user_profile.get('goals', {}).get('primary_goal', 'improve sleep')
+
+def get_user_struggle_for_ai(user_profile):
+    user_profile = user_profile or {}
+    sleep_patterns = user_profile.get('sleep_patterns', {}) or {}
+    if sleep_patterns.get('struggle'):
+        return sleep_patterns['struggle']
+    onboarding = user_profile.get('onboarding', {}) or {}
+    if onboarding.get('struggle'):
+        return STRUGGLE_MAP.get(onboarding['struggle'], onboarding['struggle'])
+    return None
+
+def rule_based_suggestion(score):
+    """Canned advice used when the model is unavailable."""
+    if score >= 90:
+        return "Excellent! Maintain your routine and avoid screens before bed."
+    elif score >= 75:
+        return "Good! Try to sleep a bit earlier for even better rest."
+    else:
+        return "You might benefit from cutting late-night screen time or adjusting your sleep schedule."
+
+# --- Prompt building ---
+# The prompt is a compact key=value summary rather than the raw log: no notes,
+# no emoji lists, just the numbers the coach needs, cut to a fixed budget.
+PROMPT_TOKEN_BUDGET = 120
+BASELINE_DAYS = 7
+SYSTEM_PROMPT = "You are a helpful sleep coach."
+INSTRUCTION = "Give 1-2 short, friendly, practical sentences to improve tonight's sleep, referencing the score, goal and weakest areas."
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token for English); avoids a tokenizer dependency."""
+    return (len(text) + 3) // 4
+
+def _signed(value, unit, digits=0):
+    return f"{value:+.{digits}f}{unit}"
+
+def _metrics(record):
+    """Today's numbers, in a fixed order, leaving out what the log didn't record."""
+    parts = [f"sleep={record.hours_slept:g}h"]
+    if has_valid_time(record.bed_minutes):
+        parts.append(f"bed={format_hhmm(record.bed_minutes)}")
+    if has_valid_time(record.wake_minutes):
+        parts.append(f"wake={format_hhmm(record.wake_minutes)}")
+    if record.time_to_fall_asleep is not None:
+        parts.append(f"latency={record.time_to_fall_asleep}m")
+    parts.append(f"wakeups={record.woke_up_times}")
+    if record.sleep_efficiency is not None:
+        parts.append(f"eff={record.sleep_efficiency:.0f}%")
+    if record.quality_rating is not None:
+        parts.append(f"quality={record.quality_rating}/10")
+    if record.feelings:
+        # Drop the emoji, keep the word
+        parts.append("felt=" + "/".join(label.split(" ", 1)[-1] for label in record.feeling_labels()))
+    return " ".join(parts)
+
+def _deltas(record, baseline):
+    """Differences from the mean of the previous BASELINE_DAYS logs."""
+    def mean(values):
+        values = [v for v in values if v is not None]
+        return sum(values) / len(values) if values else None
+    parts = []
+    hours = mean([r.hours_slept for r in baseline])
+    if hours is not None:
+        parts.append(f"sleep {_signed(record.hours_slept - hours, 'h', 1)}")
+    latency = mean([r.time_to_fall_asleep for r in baseline])
+    if latency is not None and record.time_to_fall_asleep is not None:
+        parts.append(f"latency {_signed(record.time_to_fall_asleep - latency, 'm')}")
+    wakeups = mean([r.woke_up_times for r in baseline])
+    if wakeups is not None:
+        parts.append(f"wakeups {_signed(record.woke_up_times - wakeups, '', 1)}")
+    bed = mean([r.bed_minutes for r in baseline if has_valid_time(r.bed_minutes)])
+    if bed is not None and has_valid_time(record.bed_minutes):
+        parts.append(f"bed {_signed(record.bed_minutes - bed, 'm')}")
+    return ", ".join(parts)
+
+def _component_shortfall(record, previous, user_profile):
+    """(name, points) for each component short of 100, costliest (by weighted points lost) first."""
+    model = get_scoring_model(user_profile)
+    consistency = bedtime_difference(record, previous) if previous is not None else 0
+    points = model.components(record, user_profile or {}, consistency)
+    shortfall = sorted(COMPONENTS, key=lambda name: (100 - points[name]) * model.weights[name], reverse=True)
+    return [(name, points[name]) for name in shortfall if points[name] < 100]
+
+def _weakest_components(record, previous, user_profile, count=2):
+    """The components costing the most points today, as 'name points/100'."""
+    return [f"{name} {points:.0f}/100" for name, points in _component_shortfall(record, previous, user_profile)[:count]]
+
+def build_prompt(score, log, user_profile, history=None, token_budget=PROMPT_TOKEN_BUDGET):
+    """
+    The user message for one suggestion.
+    log: today's log (record or dict). history: the user's records newest first,
+    today's included; the ones after it form the rolling baseline.
+    Lines are added in priority order and stop once the budget would be exceeded.
+    """
+    record = as_record(log)
+    earlier = [r for r in (history or []) if r.ordinal != record.ordinal][:BASELINE_DAYS]
+    lines = [f"score={score}"]
+    if earlier:
+        baseline_scores = score_logs(earlier, user_profile)
+        baseline = sum(baseline_scores) / len(baseline_scores)
+        lines[0] += f" ({_signed(score - baseline, '')} vs {len(earlier)}-day avg {baseline:.0f})"
+    goal = get_user_goal_for_ai(user_profile)
+    struggle = get_user_struggle_for_ai(user_profile)
+    lines.append(f"goal={goal}" + (f"; struggle={struggle}" if struggle else ""))
+    weakest = _weakest_components(record, earlier[0] if earlier else None, user_profile)
+    if weakest:
+        lines.append("weakest: " + ", ".join(weakest))
+    lines.append("today: " + _metrics(record))
+    if earlier:
+        lines.append("vs avg: " + _deltas(record, earlier))
+
+    budget = token_budget - estimate_tokens(INSTRUCTION)
+    prompt_lines = []
+    for line in lines:
+        if estimate_tokens("\n".join(prompt_lines + [line])) > budget:
+            break
+        prompt_lines.append(line)
+    return "\n".join(prompt_lines + [INSTRUCTION])
+
+# --- Shared suggestion templates ---
+# Users in the same score band with the same goal, struggle and weakest component
+# get nearly the same advice, so suggestions for such a signature are generated
+# from the signature alone (no personal numbers) and shared across users. Each
+# signature keeps up to TEMPLATE_VARIANTS suggestions; once they are all there,
+# requests are served from them and only rare signatures reach the model.
+SCORE_BAND_WIDTH = 10
+TEMPLATE_VARIANTS = 3
+TEMPLATE_INSTRUCTION = "Give 1-2 short, friendly, practical sentences to improve tonight's sleep for someone like this. Don't quote exact numbers."
+
+def suggestion_signature(score, record, previous, user_profile):
+    """
+    (score band, goal, struggle, weakest component), or None when the goal is
+    free text: a custom goal is personal, so it always gets its own suggestion.
+    """
+    sleep_patterns = (user_profile or {}).get('sleep_patterns', {}) or {}
+    onboarding = (user_profile or {}).get('onboarding', {}) or {}
+    if sleep_patterns.get('goal') == "Custom goal" or onboarding.get('goal') == 'custom':
+        return None
+    band = min(score, 100) // SCORE_BAND_WIDTH * SCORE_BAND_WIDTH
+    shortfall = _component_shortfall(record, previous, user_profile)
+    weakest = shortfall[0][0] if shortfall else "none"
+    return (band, get_user_goal_for_ai(user_profile), get_user_struggle_for_ai(user_profile) or "none", weakest)
+
+def template_prompt(signature):
+    band, goal, struggle, weakest = signature
+    return "\n".join([
+        f"score={band}-{min(band + SCORE_BAND_WIDTH - 1, 100)}",
+        f"goal={goal}" + (f"; struggle={struggle}" if struggle != "none" else ""),
+        f"weakest: {weakest}",
+        TEMPLATE_INSTRUCTION,
+    ])
+
+def _template_key(signature):
+    return make_key("template", "_shared", *[str(part).replace(":", " ") for part in signature])
+
+def _count(cache, outcome):
+    try:
+        cache.incr(make_key("template_stats", "_shared", outcome), TTLS["template_stats"])
+    except Exception as e:
+        print(f"Cache write failed for template {outcome} count: {e}")
+
+def template_stats(cache=None):
+    """Hit/miss counts for shared suggestion templates, across every process using the cache."""
+    cache = cache or get_cache()
+    try:
+        hits = cache.get(make_key("template_stats", "_shared", "hits")) or 0
+        misses = cache.get(make_key("template_stats", "_shared", "misses")) or 0
+    except Exception as e:
+        print(f"Cache read failed for template stats: {e}")
+        hits = misses = 0
+    total = hits + misses
+    return {"hits": hits, "misses": misses, "hit_rate": hits / total if total else 0.0}
+
+def _chat(prompt):
+    return get_client().chat(
+        model="gpt-4o",
+        messages=[{"role": "system", "content": SYSTEM_PROMPT},
+                  {"role": "user", "content": prompt}],
+        max_tokens=60,
+        temperature=0.7,
+    )
+
+def templated_suggestion(signature, cache=None):
+    """
+    (suggestion, source) for a signature: a stored variant ("template") once the
+    signature has all of its variants, otherwise a new model call ("model") whose
+    answer is kept as another variant. If that call fails, any variant stored so
+    far is used; with none, SuggestionUnavailable is raised.
+    """
+    cache = cache or get_cache()
+    key = _template_key(signature)
+    try:
+        variants = cache.get(key) or []
+    except Exception as e:
+        print(f"Cache read failed for {key}: {e}")
+        variants = []
+    if len(variants) >= TEMPLATE_VARIANTS:
+        _count(cache, "hits")
+        return random.choice(variants), "template"
+    _count(cache, "misses")
+    try:
+        content = _chat(template_prompt(signature))
+    except SuggestionUnavailable:
+        if variants:
+            return random.choice(variants), "template"
+        raise
+    # Kept even if it repeats an earlier variant, so a signature always fills up
+    try:
+        cache.set(key, variants + [content], TTLS["template"])
+    except Exception as e:
+        print(f"Cache write failed for {key}: {e}")
+    return content, "model"
+
+def suggest(score, log=None, user_profile=None, history=None):
+    """
+    (suggestion, source), source being "model" (a model call was made), "template"
+    (a shared variant was reused) or "rules". Falls back to the rule-based suggestion
+    without an API key, log or profile, or when the model call fails (the error is
+    logged, not shown to the user).
+    history: the user's LogRecords newest first, for the baseline comparison.
+    """
+    if not openai.api_key or not log or not user_profile:
+        return rule_based_suggestion(score), "rules"
+    try:
+        record = as_record(log)
+        earlier = [r for r in (history or []) if r.ordinal != record.ordinal]
+        signature = suggestion_signature(score, record, earlier[0] if earlier else None, user_profile)
+        if signature is not None:
+            return templated_suggestion(signature)
+        return _chat(build_prompt(score, log, user_profile, history)), "model"
+    except Exception as e:
+        # Anything unexpected (a malformed log, a parse error) mustn't reach the page either
+        print(f"AI suggestion unavailable, using rule-based: {type(e).__name__}: {e}")
+        return rule_based_suggestion(score), "rules"
+
+def generate_gpt_suggestion(score, log=None, user_profile=None, history=None):
+    return suggest(score, log, user_profile, history)[0]
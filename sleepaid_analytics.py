@@ -0,0 +1,180 @@
+"""
+Sleep analytics shared by the Streamlit app and the offline workers:
+streaks, window stats and the per-user rollups the dashboard reads.
+"""
+from datetime import datetime
+
+import numpy as np
+
+from sleepaid_records import INVALID_TIME
+from sleepaid_cache import digest
+from sleepaid_scoring import BASE_MODEL, calculate_sleep_score, score_columns, scoring_fingerprint
+from sleepaid_store import LogStore
+from sleepaid_time import user_today
+
+# Bump when the shape of a rollup document changes so stale ones are recomputed.
+ROLLUP_VERSION = 3
+# The widest window a rollup summarizes; logs older than this only count towards streaks
+ROLLUP_WINDOW_DAYS = 30
+
+# --- Streak Calculation ---
+def calculate_streaks(records, today=None):
+    """
+    Calculate the current and longest streak of consecutive days with sleep logs.
+    records: list of LogRecords (any order); ones without a valid date are ignored.
+    today: the user's current sleep day. When given, a streak whose latest log is
+    older than yesterday no longer counts as current.
+    Returns: (current_streak, longest_streak)
+    """
+    ordinals = sorted((r.ordinal for r in records if r.ordinal is not None), reverse=True)
+    if not ordinals:
+        return 0, 0
+    streak = 1
+    if today is not None and today.toordinal() - ordinals[0] > 1:
+        streak = 0
+    for prev, curr in zip(ordinals, ordinals[1:]):
+        if not streak:
+            break
+        if prev - curr == 1:
+            streak += 1
+        elif prev - curr > 1:
+            break  # streak ended
+    # Now, calculate the longest streak
+    longest = 0
+    temp_streak = 1
+    for prev, curr in zip(ordinals, ordinals[1:]):
+        if prev - curr == 1:
+            temp_streak += 1
+        else:
+            if temp_streak > longest:
+                longest = temp_streak
+            temp_streak = 1
+    if temp_streak > longest:
+        longest = temp_streak
+    return streak, longest
+
+# --- Rollups ---
+def get_day_label(day):
+    """Returns 'Th' for Thursday, otherwise the first initial of the day."""
+    weekday = day.strftime('%a')
+    if weekday == 'Thu':
+        return 'Th'
+    return weekday[0]
+
+def compute_window_stats(store, user_profile, days, today=None):
+    """
+    Summary stats over a LogStore's logs dated within the last `days` days (inclusive of today).
+    Returns a dict of averages plus the number of logged nights in the window.
+    """
+    today_ordinal = (today or user_today(user_profile)).toordinal()
+    window = store.slice(today_ordinal - (days - 1), today_ordinal)
+    if not len(window):
+        return {"days": days, "nights_logged": 0, "avg_score": 0, "best_score": 0, "low_score": 0,
+                "avg_hours": 0.0, "avg_latency": 0.0, "avg_wakeups": 0.0}
+    scores = score_columns(window, user_profile)
+    return {
+        "days": days,
+        "nights_logged": len(window),
+        "avg_score": int(scores.mean()),
+        "best_score": int(scores.max()),
+        "low_score": int(scores.min()),
+        "avg_hours": round(float(window.hours_slept.mean()), 2),
+        "avg_latency": round(float(np.nan_to_num(window.time_to_fall_asleep).mean()), 1),
+        "avg_wakeups": round(float(window.woke_up_times.mean()), 2),
+    }
+
+def bedtime_difference(record_a, record_b):
+    """
+    Minutes between two nights' bedtimes (a missing bedtime counts as midnight),
+    or 0 if either one is malformed.
+    """
+    bed_a = record_a.bed_minutes or 0
+    bed_b = record_b.bed_minutes or 0
+    if bed_a == INVALID_TIME or bed_b == INVALID_TIME:
+        return 0
+    return abs(bed_a - bed_b)
+
+def calculate_today_scores(records, user_profile):
+    """
+    Score for the latest log (with bedtime consistency against the previous one)
+    and the percentage change from the previous day's score.
+    records: list of LogRecords sorted by date descending.
+    Returns: (today_score, previous_score, change_percent)
+    """
+    if not records:
+        return 0, 0, 0
+    # Calculate consistency if there's a previous log to compare to
+    consistency_diff = bedtime_difference(records[0], records[1]) if len(records) > 1 else 0
+    today_score = calculate_sleep_score(records[0], user_profile, consistency_diff)
+    previous_score = 0
+    change_percent = 0
+    # Calculate percentage change from the previous day's score
+    if len(records) > 1:
+        previous_score = calculate_sleep_score(records[1], user_profile, 0) # Use 0 consistency for prev day
+        if previous_score > 0:
+            change_percent = int(((today_score - previous_score) / previous_score) * 100)
+        elif today_score > 0:
+            change_percent = 100 # From 0 to a positive score
+    return today_score, previous_score, change_percent
+
+def logs_digest(records, today):
+    """
+    Digest of the logs a rollup's numbers come from: the two newest (today's score and
+    its change) and everything in the last ROLLUP_WINDOW_DAYS days. Editing any of them
+    changes it even when the log count and newest date stay the same.
+    """
+    first_day = today.toordinal() - (ROLLUP_WINDOW_DAYS - 1)
+    used = []
+    for i, record in enumerate(records):
+        if i >= 2 and (record.ordinal is None or record.ordinal < first_day):
+            break
+        used.append(record.to_dict())
+    return digest(used)
+
+def build_rollup(records, user_profile, today=None):
+    """
+    Everything the dashboard needs that can be computed ahead of time for one user.
+    records: list of LogRecords sorted by date descending.
+    """
+    today = today or user_today(user_profile)
+    store = LogStore.from_records(records)
+    current_streak, longest_streak = calculate_streaks(records, today)
+    today_score, previous_score, change_percent = calculate_today_scores(records, user_profile)
+    return {
+        "version": ROLLUP_VERSION,
+        "scoring_version": BASE_MODEL.version,
+        "scoring_fingerprint": scoring_fingerprint(user_profile),
+        "as_of": today.isoformat(),
+        "computed_at": datetime.now().isoformat(),
+        "log_count": len(records),
+        "latest_log_date": records[0].date if records else "",
+        "logs_digest": logs_digest(records, today),
+        "current_streak": current_streak,
+        "longest_streak": longest_streak,
+        "today_score": today_score,
+        "previous_score": previous_score,
+        "change_percent": change_percent,
+        "stats_7d": compute_window_stats(store, user_profile, 7, today),
+        "stats_30d": compute_window_stats(store, user_profile, ROLLUP_WINDOW_DAYS, today),
+    }
+
+def rollup_is_fresh(rollup, records, today, user_profile=None):
+    """
+    A rollup is reusable only if it was computed for the user's current sleep day,
+    from the profile's current scoring inputs, and no log has been added or changed since.
+    """
+    if not rollup or rollup.get("version") != ROLLUP_VERSION:
+        return False
+    if rollup.get("as_of") != today.isoformat():
+        return False
+    # Retuned scoring rules invalidate every stored score
+    if rollup.get("scoring_version") != BASE_MODEL.version:
+        return False
+    # So does an edit to the goal, usual bedtime or anything else the score reads from the profile
+    if rollup.get("scoring_fingerprint") != scoring_fingerprint(user_profile):
+        return False
+    latest_log_date = records[0].date if records else ""
+    if rollup.get("log_count") != len(records) or rollup.get("latest_log_date") != latest_log_date:
+        return False
+    # A re-submitted or backfilled log leaves both of those as they were
+    return rollup.get("logs_digest") == logs_digest(records, today)
@@ -0,0 +1,116 @@
+"""
+Incremental anomaly detection on sleep metrics.
+
+The insights section only compared plain 7-day means. Here each user carries a
+small EWMA (exponentially weighted moving average) mean/variance per metric,
+stored in their profile as `anomaly_state`. A new log is first compared
+against the state (a z-score beyond Z_THRESHOLD is flagged) and then folded
+into it in O(1), so "last night was unusual" is known the moment a log is saved
+without rescanning history. Users with logs but no state yet get one built by
+replaying their history once.
+"""
+import math
+
+from sleepaid_records import has_valid_time
+
+STATE_VERSION = 1
+ALPHA = 0.1          # weight of the newest night (~10-night memory)
+Z_THRESHOLD = 2.5
+MIN_NIGHTS = 7       # nights folded in before anything is flagged
+# Floor on the standard deviation so a very regular user isn't flagged for tiny changes
+MIN_STD = {"hours_slept": 0.5, "latency": 5.0, "wakeups": 0.5, "efficiency": 3.0, "bedtime": 20.0}
+
+LABELS = {
+    "hours_slept": "hours slept",
+    "latency": "time to fall asleep",
+    "wakeups": "wakeups",
+    "efficiency": "sleep efficiency",
+    "bedtime": "bedtime",
+}
+
+
+def _bedtime(minutes):
+    """Minutes since noon, so a bedtime either side of midnight stays on one continuous scale."""
+    return (minutes - 12 * 60) % (24 * 60)
+
+def metric_values(record):
+    """{metric: value} for the metrics the log recorded."""
+    values = {"hours_slept": record.hours_slept, "wakeups": record.woke_up_times}
+    if record.time_to_fall_asleep is not None:
+        values["latency"] = record.time_to_fall_asleep
+    if record.sleep_efficiency is not None:
+        values["efficiency"] = record.sleep_efficiency
+    if has_valid_time(record.bed_minutes):
+        values["bedtime"] = _bedtime(record.bed_minutes)
+    return values
+
+def empty_state():
+    return {"version": STATE_VERSION, "last_ordinal": None, "metrics": {}, "flags": [], "flagged_date": None}
+
+def is_current(state):
+    return isinstance(state, dict) and state.get("version") == STATE_VERSION
+
+def check(state, record):
+    """Flags for `record` against `state` (without updating it), largest deviation first."""
+    flags = []
+    for metric, value in metric_values(record).items():
+        stats = state["metrics"].get(metric)
+        if not stats or stats["n"] < MIN_NIGHTS:
+            continue
+        std = max(math.sqrt(stats["var"]), MIN_STD[metric])
+        z = (value - stats["mean"]) / std
+        if abs(z) >= Z_THRESHOLD:
+            flags.append({"metric": metric, "value": value, "mean": round(stats["mean"], 2), "z": round(z, 2)})
+    flags.sort(key=lambda flag: abs(flag["z"]), reverse=True)
+    return flags
+
+def observe(state, record, alpha=ALPHA):
+    """
+    Check `record`, then fold it into the state. Returns (new state, flags).
+    A log for a day at or before the last one folded in (a re-log or backfill)
+    is checked but not folded in again, so editing a day can't double-count it.
+    """
+    state = dict(state) if is_current(state) else empty_state()
+    flags = check(state, record)
+    state["flags"] = flags
+    state["flagged_date"] = record.date
+    if record.ordinal is None or (state["last_ordinal"] is not None and record.ordinal <= state["last_ordinal"]):
+        return state, flags
+    metrics = dict(state["metrics"])
+    for metric, value in metric_values(record).items():
+        stats = metrics.get(metric)
+        if stats is None:
+            metrics[metric] = {"mean": float(value), "var": 0.0, "n": 1}
+            continue
+        diff = value - stats["mean"]
+        increment = alpha * diff
+        metrics[metric] = {
+            "mean": stats["mean"] + increment,
+            "var": (1 - alpha) * (stats["var"] + diff * increment),
+            "n": stats["n"] + 1,
+        }
+    state["metrics"] = metrics
+    state["last_ordinal"] = record.ordinal
+    return state, flags
+
+def state_from_records(records):
+    """Build the state by replaying `records` oldest first (for users who had logs before this existed)."""
+    state = empty_state()
+    for record in sorted((r for r in records if r.ordinal is not None), key=lambda r: r.ordinal):
+        state, _ = observe(state, record)
+    return state
+
+def describe_flag(flag):
+    """One sentence for the insights section."""
+    metric, value, mean = flag["metric"], flag["value"], flag["mean"]
+    direction = "above" if flag["z"] > 0 else "below"
+    if metric == "bedtime":
+        direction = "later" if flag["z"] > 0 else "earlier"
+        return f"Your bedtime was about {abs(value - mean):.0f} min {direction} than usual."
+    if metric == "hours_slept":
+        return f"You slept {value:g} h, well {direction} your usual {mean:.1f} h."
+    if metric == "latency":
+        return f"Falling asleep took {value:.0f} min, well {direction} your usual {mean:.0f} min."
+    if metric == "wakeups":
+        return f"You woke up {value} time{'s' if value != 1 else ''}, well {direction} your usual {mean:.1f}."
+    return f"Your {LABELS[metric]} was {value:.0f}%, well {direction} your usual {mean:.0f}%."
@@ -1,75 +1,47 @@
 import streamlit as st
-from datetime import datetime, time as time_type, timedelta
+from streamlit.errors import StreamlitAPIException
+from datetime import date as date_type, datetime, time as time_type, timedelta
 import json
 import os
 import statistics
 import time
-import firebase_admin
-from firebase_admin import credentials, auth, firestore, _apps
+from firebase_admin import auth
 import base64
 import urllib.parse
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 import openai
 from dotenv import load_dotenv
 from google.cloud.firestore_v1 import Increment
-import pytz
-
-# --- Streak Calculation ---
-def calculate_streaks(logs):
-    """
-    Calculate the current and longest streak of consecutive days with sleep logs.
-    logs: list of dicts with 'date' in 'YYYY-MM-DD'.
-    Returns: (current_streak, longest_streak)
-    """
-    from datetime import datetime, timedelta
-    if not logs:
-        return 0, 0
-    # Sort logs by date descending
-    sorted_logs = sorted(logs, key=lambda x: x.get("date", ""), reverse=True)
-    streak = 0
-    longest = 0
-    prev_date = None
-    for log in sorted_logs:
-        log_date_str = log.get("date")
-        if not log_date_str:
-            continue
-        try:
-            log_date = datetime.strptime(log_date_str, "%Y-%m-%d")
-        except Exception:
-            continue
-        if prev_date is None:
-            streak = 1
-        else:
-            if prev_date - log_date == timedelta(days=1):
-                streak += 1
-            elif prev_date - log_date > timedelta(days=1):
-                break  # streak ended
-        prev_date = log_date
-    # Now, calculate the longest streak
-    longest = 0
-    temp_streak = 1
-    for i in range(1, len(sorted_logs)):
-        try:
-            d1 = datetime.strptime(sorted_logs[i-1].get("date", ""), "%Y-%m-%d")
-            d2 = datetime.strptime(sorted_logs[i].get("date", ""), "%Y-%m-%d")
-        except Exception:
-            continue
-        if (d1 - d2) == timedelta(days=1):
-            temp_streak += 1
-        else:
-            if temp_streak > longest:
-                longest = temp_streak
-            temp_streak = 1
-    if temp_streak > longest:
-        longest = temp_streak
-    return streak, longest
+from sleepaid_analytics import (
+    calculate_streaks,
+    calculate_today_scores,
+    get_day_label,
+    rollup_is_fresh,
+)
+from sleepaid_records import FEELINGS, LogRecord, format_hhmm, has_valid_time
+from sleepaid_scoring import get_scoring_model, score_columns
+from sleepaid_prefix import PrefixIndex
+from sleepaid_store import LogStore
+from sleepaid_trends import BUCKETS, METRICS, RANGES, default_bucket, trend_series
+from sleepaid_time import TIMEZONES, last_n_days, timezone_index, user_today
+from sleepaid_ai import get_user_goal_for_ai, suggest, template_stats
+from sleepaid_anomaly import describe_flag, is_current, observe, state_from_records
+import sleepaid_factors as factors
+from sleepaid_codec import encode_log, record_from_document
+from sleepaid_export import discard_export, get_job, read_archive, start_export
+from sleepaid_cache import bump_generation, cached, digest, get_cache, make_key, user_generation
+from sleepaid_firebase import connect
+from sleepaid_profiles import canonicalize_profile
+from sleepaid_profiling import admin_uids, env_pages, profile_rerun
+from sleepaid_sessions import get_session_memory
+from sleepaid_avatars import AVATAR_SIZES, avatar_hash, avatar_url, process_avatar, remove_avatar
+from sleepaid_writer import BackgroundWriter, describe
 
 # --- Get the absolute path of the script's directory ---
 _this_file = os.path.abspath(__file__)
 _this_dir = os.path.dirname(_this_file)
-AVATAR_DIR = os.path.join(_this_dir, "data", "avatars")
-os.makedirs(AVATAR_DIR, exist_ok=True)
 
 # --- Load OpenAI API Key from .env2 ---
 load_dotenv(os.path.join(_this_dir, ".env2"))
@@ -96,34 +68,50 @@ def increment_user_usage(uid):
         except Exception as e:
             st.error(f"Error updating usage: {e}")
 
-# --- Helper function for custom day labels ---
-def get_day_label(day):
-    """Returns 'Th' for Thursday, otherwise the first initial of the day."""
-    weekday = day.strftime('%a')
-    if weekday == 'Thu':
-        return 'Th'
-    return weekday[0]
-
-
 # --- Get the absolute path of the script's directory ---
 _this_file = os.path.abspath(__file__)
 _this_dir = os.path.dirname(_this_file)
 ASSETS_DIR = os.path.join(_this_dir, "assets")
 
 # --- Firebase Admin SDK Setup ---
-# Load credentials from the service account key JSON file
-# Using a raw string (r"...") to handle Windows paths correctly
+# Initialized once per process (see sleepaid_firebase.py); reruns reuse the same client.
+# The key path comes from SLEEPAID_FIREBASE_CREDENTIALS.
 try:
-    cred = credentials.Certificate(r"C:\Users\sween\Downloads\sleepaid\sleepaid-c10bf-firebase-adminsdk-fbsvc-9fc57fd56d.json")
-    # Initialize Firebase if not already initialized
-    if not _apps:
-        firebase_admin.initialize_app(cred)
-    db = firestore.client()
+    firebase = connect()
+    db = firebase.db
 except Exception as e:
     st.error(f"Failed to initialize Firebase: {e}")
     st.info("Please ensure your Firebase service account key is correctly placed and the path is correct.")
+    firebase = None
     db = None
 
+def _invalidate_users(jobs):
+    # A log list cached (by any replica) while these writes were queued lacks them once they
+    # leave the queue. Only that entry is dropped: bumping the generation would also make
+    # the writing session's own LogStore look stale and reload the whole history.
+    cache = get_cache()
+    for uid in {job["uid"] for job in jobs if job["kind"] == "log"}:
+        key = make_key("logs", uid, user_generation(cache, uid))
+        try:
+            cache.delete(key)
+        except Exception as e:
+            print(f"Cache delete failed for {key}: {e}")
+
+@st.cache_resource
+def _create_writer():
+    return BackgroundWriter(None, on_applied=_invalidate_users)
+
+def get_writer():
+    """
+    The process-wide background writer. Writes queue durably even while `db` is None;
+    it starts flushing them as soon as a rerun manages to initialize Firebase.
+    """
+    writer = _create_writer()
+    if writer.db is None and db is not None:
+        writer.db = db
+        writer.health = firebase
+    return writer
+
 # --- Session State Initialization ---
 if 'logged_in' not in st.session_state:
     st.session_state.logged_in = False
@@ -164,6 +152,12 @@ def login(email, password):
 def logout():
     st.session_state.logged_in = False
     st.session_state.user_uid = None
+    # The signed-out user's logs and indexes needn't wait for idle eviction
+    if "memory_handle" in st.session_state:
+        get_session_memory().close_session(st.session_state.memory_handle.session_id)
+    # Nor should their export archive outlive the session
+    if st.session_state.get("export_token"):
+        discard_export(st.session_state.pop("export_token"))
     st.session_state.page = "login"
     # When we logout, we want to clear all query params and go to a clean login state
     if "action" in st.query_params:
@@ -171,30 +165,297 @@ def logout():
     st.rerun()
 
 # --- Firestore Data Functions ---
+def fetch_user_logs(uid):
+    """A user's log documents from Firestore, newest first, or None if they couldn't be read."""
+    if not db:
+        return None
+    try:
+        logs_ref = db.collection('users').document(uid).collection('sleep_logs').order_by('date', direction="DESCENDING").stream()
+        return [log.to_dict() for log in logs_ref]
+    except Exception as e:
+        st.error(f"Error loading logs: {e}")
+        return None
+
 def load_user_logs(uid):
-    logs = []
-    if db:
-        try:
-            logs_ref = db.collection('users').document(uid).collection('sleep_logs').order_by('date', direction="DESCENDING").stream()
-            for log in logs_ref:
-                logs.append(log.to_dict())
-        except Exception as e:
-            st.error(f"Error loading logs: {e}")
-    return logs
+    """Load a user's logs as LogRecords, newest first. Each document (either schema version) is decoded exactly once here."""
+    # Shared across replicas; the generation changes whenever the user writes
+    cache = get_cache()
+    logs = cached(cache, "logs", uid, [user_generation(cache, uid)], lambda: fetch_user_logs(uid)) or []
+    # Logs still waiting in the write queue replace (or add to) what Firestore has
+    pending = get_writer().pending("log", uid)
+    if pending:
+        logs = [log for log in logs if log.get('date') not in pending] + list(pending.values())
+        logs.sort(key=lambda log: str(log.get('date', '')), reverse=True)
+    return [record_from_document(log) for log in logs]
+
+def session_handle():
+    """This browser session's handle into the process-wide SessionMemory (see sleepaid_sessions)."""
+    handle = st.session_state.get("memory_handle")
+    if handle is None:
+        handle = st.session_state.memory_handle = get_session_memory().open_session()
+    return handle
+
+def _log_store_tag(uid, generation=None):
+    # The generation moves on every write by the user from any tab, device or replica
+    return (uid, user_generation(get_cache(), uid) if generation is None else generation)
+
+def get_log_store(uid):
+    """
+    The user's logs as a columnar LogStore, reloaded only when they've written since it
+    was loaded (or it was evicted while the session sat idle).
+    """
+    memory = get_session_memory()
+    tag = _log_store_tag(uid)
+    store = memory.get(session_handle(), "log_store", tag=tag)
+    if store is None:
+        store = memory.put(session_handle(), "log_store", LogStore.from_records(load_user_logs(uid)), tag=tag)
+    return store
+
+# --- Log entry fields, shared by the log form and the backfill grid ---
+FEELING_OPTIONS = ["😴 Exhausted", "😐 Meh", "🙂 Refreshed", "💪 Energized"]
+WAKEUP_OPTIONS = ["0 (I didn't wake up)", "1 time", "2 times", "3+ times"]
+ENVIRONMENT_OPTIONS = ["Room was cool", "Dark", "Quiet", "No screens", "No caffeine"]
+MENTAL_STATE_OPTIONS = ["Relaxed", "Neutral", "Stressed"]
+
+def validate_log_fields(hours_slept, time_in_bed, time_to_fall_asleep, bed_time, wake_time):
+    """The log form's checks. Returns a list of error messages, empty if the entry is valid."""
+    errors = []
+    try:
+        hours_val = float(hours_slept)
+        if hours_val <= 0 or hours_val > 24:
+            errors.append("Hours slept must be between 0 and 24.")
+    except (TypeError, ValueError):
+        errors.append("Please enter a valid number for hours slept.")
+        hours_val = None
+    if time_in_bed is None or pd.isna(time_in_bed) or (hours_val is not None and time_in_bed < hours_val) or time_in_bed > 24:
+        errors.append("Time in bed must be at least as much as hours slept and no more than 24.")
+    if time_to_fall_asleep is None or pd.isna(time_to_fall_asleep) or time_to_fall_asleep < 0 or time_to_fall_asleep > 180:
+        errors.append("Time to fall asleep must be between 0 and 180 minutes.")
+    if not bed_time:
+        errors.append("Bed time is required.")
+    if not wake_time:
+        errors.append("Wake time is required.")
+    return errors
+
+def wakeup_count_from_option(option):
+    if "3+" in option:
+        return 3
+    if "2" in option:
+        return 2
+    if "1" in option:
+        return 1
+    return 0
+
+def build_log(day, hours_slept, time_in_bed, time_to_fall_asleep, bed_time, wake_time, woke_up_feeling,
+              wakeup_count, quality_rating, sleep_environment, mental_state, notes):
+    """A validated entry as the Firestore log document, with sleep efficiency worked out from the times."""
+    bed_time_str = bed_time.strftime("%H:%M")
+    wake_time_str = wake_time.strftime("%H:%M")
+    # Calculate Sleep Efficiency
+    bed_datetime = datetime.strptime(bed_time_str, "%H:%M")
+    wake_datetime = datetime.strptime(wake_time_str, "%H:%M")
+    if wake_datetime <= bed_datetime:
+        wake_datetime += timedelta(days=1)
+    time_in_bed_minutes = (wake_datetime - bed_datetime).total_seconds() / 60
+    sleep_efficiency = (float(hours_slept) * 60 / time_in_bed_minutes) * 100 if time_in_bed_minutes > 0 else 0
+    log = {
+        "date": day.isoformat(),
+        "hours_slept": float(hours_slept),
+        "time_in_bed": float(time_in_bed),
+        "time_to_fall_asleep": int(time_to_fall_asleep),
+        "bed_time": bed_time_str,
+        "wake_time": wake_time_str,
+        "sleep_efficiency": sleep_efficiency,
+        "woke_up_feeling": list(woke_up_feeling),
+        "woke_up_night": wakeup_count > 0,
+        "woke_up_times": wakeup_count,
+        "quality_rating": quality_rating,
+        "sleep_environment": list(sleep_environment),
+        "mental_state": list(mental_state),
+        "notes": notes,
+    }
+    if quality_rating is None:
+        del log["quality_rating"]
+    return log
+
+BACKFILL_WINDOWS = [7, 14, 30]
+
+def backfill_frame(store, today, days):
+    """One row per day of the last `days` (oldest first), prefilled from the logs the user already has."""
+    start = today.toordinal() - (days - 1)
+    existing = {r.ordinal: r for r in store.slice(start, today.toordinal()).records}
+    rows = []
+    for ordinal in range(start, today.toordinal() + 1):
+        record = existing.get(ordinal)
+        if record is None:
+            rows.append({"date": date_type.fromordinal(ordinal), "logged": False, "hours_slept": None, "time_in_bed": None,
+                         "time_to_fall_asleep": None, "bed_time": None, "wake_time": None, "woke_up_feeling": [],
+                         "wakeups": None, "quality_rating": None, "sleep_environment": [], "mental_state": [], "notes": ""})
+            continue
+        rows.append({
+            "date": date_type.fromordinal(ordinal),
+            "logged": True,
+            "hours_slept": record.hours_slept,
+            "time_in_bed": record.time_in_bed,
+            "time_to_fall_asleep": record.time_to_fall_asleep,
+            "bed_time": time_type(*divmod(record.bed_minutes, 60)) if has_valid_time(record.bed_minutes) else None,
+            "wake_time": time_type(*divmod(record.wake_minutes, 60)) if has_valid_time(record.wake_minutes) else None,
+            "woke_up_feeling": record.feeling_labels(),
+            "wakeups": WAKEUP_OPTIONS[min(record.woke_up_times, 3)],
+            "quality_rating": _to_int_or_none(record.quality_rating),
+            "sleep_environment": record.environment_labels(),
+            "mental_state": record.mental_state_labels(),
+            "notes": record.notes,
+        })
+    return pd.DataFrame(rows)
+
+def _to_int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
 
-def save_user_log(uid, log_data):
+def backfill_logs(original, edited):
+    """
+    Logs for the grid rows that were added or changed, plus (date, error) pairs for rows
+    that fail the log form's validation. Untouched empty days are skipped.
+    """
+    logs, errors = [], []
+    for i in range(len(edited)):
+        row = edited.iloc[i]
+        if row.equals(original.iloc[i]):
+            continue
+        if not row["logged"] and pd.isna(row["hours_slept"]):
+            continue  # touched a missing day but left it empty
+        day = pd.Timestamp(row["date"]).date()
+        bed_time = row["bed_time"] if not pd.isna(row["bed_time"]) else None
+        wake_time = row["wake_time"] if not pd.isna(row["wake_time"]) else None
+        row_errors = validate_log_fields(row["hours_slept"], row["time_in_bed"], row["time_to_fall_asleep"], bed_time, wake_time)
+        if row_errors:
+            errors.extend((day, err) for err in row_errors)
+            continue
+        quality = None if pd.isna(row["quality_rating"]) else int(row["quality_rating"])
+        wakeups = row["wakeups"] if isinstance(row["wakeups"], str) else WAKEUP_OPTIONS[0]
+        logs.append(build_log(day, row["hours_slept"], row["time_in_bed"], row["time_to_fall_asleep"], bed_time, wake_time,
+                              row["woke_up_feeling"] or [], wakeup_count_from_option(wakeups), quality,
+                              row["sleep_environment"] or [], row["mental_state"] or [], row["notes"] or ""))
+    return logs, errors
+
+def save_user_log(uid, log_data, user_profile=None):
+    """
+    Apply the log to the session's store right away and queue the Firestore write.
+    Queued writes survive outages and restarts; failed attempts are reported by show_failed_writes.
+    With the user's profile, the log is also run through anomaly detection and the
+    factor statistics, and the updated profile is written with it.
+    """
+    return save_user_logs(uid, [log_data], user_profile)
+
+def goal_range(user_profile):
+    """(min, max) hours of the user's sleep duration goal."""
+    sleep_patterns = user_profile.get('sleep_patterns', {}) if user_profile else {}
+    goal = sleep_patterns.get('sleep_duration_goal', '7-8 hours')
+    scoring_model = get_scoring_model(user_profile)
+    return goal, scoring_model.goal_ranges.get(goal, scoring_model.default_goal_range)
+
+def get_prefix_index(uid, store, user_profile):
+    """The store's PrefixIndex, rebuilt only when a log is added or the goal range changes."""
+    _, (min_goal, max_goal) = goal_range(user_profile)
+    key = (uid, id(store), store.version, min_goal, max_goal)
+    memory = get_session_memory()
+    index = memory.get(session_handle(), "prefix_index", tag=key)
+    if index is None:
+        index = memory.put(session_handle(), "prefix_index", PrefixIndex.from_columns(store.view(), min_goal, max_goal), tag=key)
+    return index
+
+def save_user_logs(uid, logs, user_profile=None):
+    """
+    Save several logs at once (the backfill grid): they and the profile update are queued
+    together and reach Firestore in one batched write, and the store, cache generation and
+    profile insights are updated once for the whole set.
+    """
+    records = [LogRecord.from_dict(log) for log in logs]
+    # Use date as the document ID for easy lookup; stored in the compact encoding
+    writes = [("log", uid, log['date'], encode_log(log)) for log in logs]
+    if user_profile:
+        writes.append(("profile", uid, uid, updated_log_insights(uid, records, user_profile)))
+    try:
+        get_writer().submit_many(writes)
+    except OSError as e:
+        st.error(f"Error saving log: {e}")
+        return False
+    # Only a current store in memory needs the new logs; an evicted or stale one reloads with them
+    memory = get_session_memory()
+    store = memory.get(session_handle(), "log_store", tag=_log_store_tag(uid))
+    if store is not None:
+        for record in records:
+            store.append(record)
+    generation = bump_generation(get_cache(), uid)
+    if store is not None and generation is not None:
+        # This session's own write doesn't need a reload
+        memory.put(session_handle(), "log_store", store, tag=_log_store_tag(uid, generation))
+    return True
+
+def updated_log_insights(uid, records, user_profile):
+    """
+    The profile with new logs folded into its anomaly state and factor statistics.
+    O(1) per log once both exist; called before the logs are added to the store.
+    """
+    store = get_log_store(uid)
+    records = sorted((r for r in records if r.ordinal is not None), key=lambda r: r.ordinal)
+    new_days = {r.ordinal for r in records}
+    state = user_profile.get("anomaly_state")
+    if not is_current(state):
+        # First log since anomaly detection was added: replay the earlier logs once
+        state = state_from_records([r for r in store.newest_first() if r.ordinal not in new_days])
+    stats = user_profile.get("factor_stats")
+    if not factors.is_current(stats, user_profile):
+        stats = factors.stats_from_columns(store.view(), user_profile)
+    for record in records:
+        state, _ = observe(state, record)
+        same_day = store.slice(record.ordinal, record.ordinal).records
+        stats = factors.add_log(stats, record, user_profile, same_day[0] if same_day else None)
+    return {**user_profile, "anomaly_state": state, "factor_stats": stats}
+
+def load_factor_stats(uid, cols, user_profile):
+    """The profile's factor statistics, or (until the next log updates them) a one-off build shared through the cache."""
+    stats = (user_profile or {}).get("factor_stats")
+    if factors.is_current(stats, user_profile):
+        return stats
+    cache = get_cache()
+    parts = [user_generation(cache, uid), factors.fingerprint(user_profile), len(cols)]
+    return cached(cache, "factors", uid, parts, lambda: factors.stats_from_columns(cols, user_profile))
+
+def show_failed_writes(uid):
+    """Surface background writes that failed since the last render, and what's still waiting to sync."""
+    writer = get_writer()
+    for job, error in writer.pop_failures(uid):
+        st.error(f"❌ The server rejected your {describe(job)} ({error}), so it wasn't saved. Please check it and try again.")
+    waiting = len(writer.pending("log", uid)) + len(writer.pending("profile", uid))
+    if firebase is not None and not firebase.healthy:
+        st.sidebar.warning("⚠️ We can't reach the server right now. Your changes are kept and will sync once it's back; "
+                           "some of your history may be out of date until then.")
+    if waiting:
+        st.sidebar.caption(f"⏳ {waiting} change{'s' if waiting != 1 else ''} waiting to sync")
+
+def fetch_user_rollup(uid):
     if db:
         try:
-            # Use date as the document ID for easy lookup
-            doc_id = log_data['date']
-            db.collection('users').document(uid).collection('sleep_logs').document(doc_id).set(log_data)
-            return True
+            doc = db.collection('user_rollups').document(uid).get()
+            if doc.exists:
+                return doc.to_dict()
         except Exception as e:
-            st.error(f"Error saving log: {e}")
-            return False
-    return False
+            st.error(f"Error loading rollup: {e}")
+    return None
+
+def load_user_rollup(uid, today):
+    """The rollup written by sleepaid_worker.py, or None if there isn't one. Cached across replicas per sleep day."""
+    return cached(get_cache(), "rollup", uid, [today.isoformat()], lambda: fetch_user_rollup(uid))
 
 def get_user_profile(uid):
+    # A profile save still in the write queue is newer than what Firestore has
+    pending = get_writer().pending("profile", uid)
+    if uid in pending:
+        return pending[uid]
     if db:
         try:
             doc_ref = db.collection('user_profiles').document(uid)
@@ -203,51 +464,20 @@ def get_user_profile(uid):
                 data = doc.to_dict()
                 if not data or not isinstance(data, dict):
                     return None
-                # Migrate legacy profile to new structure if needed
-                if 'personal_info' not in data or 'sleep_patterns' not in data or 'lifestyle_support' not in data:
-                    # Try to infer from legacy fields
-                    onboarding = data.get('onboarding', {})
-                    # Personal info
-                    personal_info = {
-                        'first_name': onboarding.get('first_name', ''),
-                        'age': onboarding.get('age', ''),
-                        'gender': onboarding.get('gender', ''),
-                        'timezone': onboarding.get('timezone', 'UTC'),
-                    }
-                    # Sleep patterns
-                    sleep_patterns = {
-                        'struggle': onboarding.get('struggle', ''),
-                        'goal': onboarding.get('goal', ''),
-                        'goal_custom': onboarding.get('goal_custom', ''),
-                        'usual_bedtime': onboarding.get('usual_bedtime', '23:00'),
-                        'usual_wake_time': onboarding.get('usual_wake_time', '07:00'),
-                    }
-                    # Lifestyle/support
-                    lifestyle_support = {
-                        'workout': onboarding.get('workout', ''),
-                        'workout_freq': onboarding.get('workout_freq', 0),
-                        'caffeine': onboarding.get('caffeine', ''),
-                        'caffeine_time': onboarding.get('caffeine_time', ''),
-                        'phone_use': onboarding.get('phone_use', ''),
-                        'support_pref': onboarding.get('support_pref', ''),
-                    }
-                    data['personal_info'] = personal_info
-                    data['sleep_patterns'] = sleep_patterns
-                    data['lifestyle_support'] = lifestyle_support
-                return data
+                # Older profiles are converted in memory until sleepaid_migrate_profiles.py has rewritten them
+                return canonicalize_profile(data)
         except Exception as e:
             st.error(f"Error getting profile: {e}")
     return None
 
 def save_user_profile(uid, profile_data):
-    if db:
-        try:
-            db.collection('user_profiles').document(uid).set(profile_data)
-            return True
-        except Exception as e:
-            st.error(f"Error saving profile: {e}")
-            return False
-    return False
+    """Queue the profile write; get_user_profile reads it back from the queue until it lands."""
+    try:
+        get_writer().submit("profile", uid, uid, canonicalize_profile(profile_data))
+        return True
+    except OSError as e:
+        st.error(f"Error saving profile: {e}")
+        return False
 
 # --- Onboarding Form ---
 def show_onboarding_form():
@@ -267,8 +497,7 @@ def show_onboarding_form():
             first_name = st.text_input("First Name", value=onboarding_data.get('first_name', ''))
             age = st.text_input("Age", value=onboarding_data.get('age', ''))
             gender = st.selectbox("Gender (optional)", ["", "Male", "Female", "Other"], index=["", "Male", "Female", "Other"].index(onboarding_data.get('gender', '')))
-            timezone_list = pytz.all_timezones
-            timezone = st.selectbox("Time Zone", timezone_list, index=timezone_list.index(onboarding_data.get('timezone', 'UTC')) if onboarding_data.get('timezone', 'UTC') in timezone_list else 0)
+            timezone = st.selectbox("Time Zone", TIMEZONES, index=timezone_index(onboarding_data.get('timezone', 'UTC')))
             avatar_file = st.file_uploader("Profile Avatar (optional)", type=["png", "jpg", "jpeg"])
             submitted = st.form_submit_button("Next →")
         if submitted:
@@ -294,11 +523,13 @@ def show_onboarding_form():
             onboarding_data['age'] = age_val
             onboarding_data['gender'] = gender
             onboarding_data['timezone'] = timezone
-            # Save avatar if uploaded
+            # Save avatar thumbnails if uploaded
             if avatar_file:
-                avatar_path = os.path.join(AVATAR_DIR, f"{st.session_state.user_uid}.png")
-                with open(avatar_path, "wb") as f:
-                    f.write(avatar_file.read())
+                try:
+                    process_avatar(st.session_state.user_uid, avatar_file.getvalue())
+                except ValueError as e:
+                    st.error(f"❌ Avatar not saved: {e}")
+                    st.stop()
             st.session_state.onboarding_data = onboarding_data
             st.session_state.onboarding_page = 2
             st.rerun()
@@ -404,6 +635,20 @@ def show_onboarding_form():
 
 
 
+# Helper for avatar <img> tags: serve the smallest static thumbnail that stays sharp
+def avatar_img_tag(uid, display_px, style=""):
+    """Returns an <img> for the user's avatar at `display_px`, or None if they have none."""
+    content_hash = avatar_hash(uid)
+    if not content_hash:
+        return None
+    size_1x = next((s for s in AVATAR_SIZES if s >= display_px), AVATAR_SIZES[-1])
+    size_2x = next((s for s in AVATAR_SIZES if s >= display_px * 2), AVATAR_SIZES[-1])
+    return (
+        f"<img src='{avatar_url(uid, size_1x, content_hash)}' "
+        f"srcset='{avatar_url(uid, size_1x, content_hash)} 1x, {avatar_url(uid, size_2x, content_hash)} 2x' "
+        f"width='{display_px}' height='{display_px}' style='{style}'/>"
+    )
+
 # Helper function to encode images
 def get_image_as_base64(path):
     # Check if the file exists to avoid errors
@@ -567,6 +812,24 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # --- Helper Functions ---
+_EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
+def build_history_frame(store):
+    """Full log history as a display/CSV DataFrame, newest first, built from the store's columns."""
+    cols = store.view()
+    newest_first = slice(None, None, -1)
+    dates = (cols.ordinal[newest_first].astype(np.int64) - _EPOCH_ORDINAL).astype("datetime64[D]").astype(str)
+    return pd.DataFrame({
+        "Date": dates,
+        "Hours Slept": cols.hours_slept[newest_first],
+        "Bed Time": [format_hhmm(m) if m >= 0 else "-" for m in cols.bed_minutes[newest_first].tolist()],
+        "Wake Time": [format_hhmm(m) if m >= 0 else "-" for m in cols.wake_minutes[newest_first].tolist()],
+        "Time to Fall Asleep (min)": cols.time_to_fall_asleep[newest_first],
+        "Wakeups": cols.woke_up_times[newest_first],
+        "Quality": cols.quality_rating[newest_first],
+        "Notes": [log.notes[:60] for log in cols.records[newest_first]],  # Truncate long notes
+    })
+
 def load_logs():
     logs = []
     if os.path.exists("data/sleep_logs.json"):
@@ -581,197 +844,6 @@ def load_logs():
                     print(f"Warning: Skipping invalid JSON line: {line}")
     return logs
 
-def calculate_sleep_score(log, user_profile, consistency):
-    """
-    Personalized sleep score based on user onboarding preferences and daily log.
-    Args:
-        log (dict): The sleep log for the day.
-        user_profile (dict): The user's onboarding profile.
-        consistency (float): Minutes difference in bedtime from previous day.
-    Returns:
-        int: Sleep score (0-100)
-    """
-    score = 0
-    # --- Configurable weights for scalability ---
-    weights = {
-        "duration": 0.25,
-        "latency": 0.15,
-        "wakeups": 0.10,
-        "energy": 0.10,
-        "consistency": 0.10,
-        "efficiency": 0.15,
-        "environment": 0.10,
-        "stress": 0.05,
-    }
-    # --- 1. Personalized Sleep Duration ---
-    hours = float(log.get("hours_slept", 0))
-    sleep_habits = user_profile.get("sleep_habits", {})
-    goal = sleep_habits.get("sleep_duration_goal", "7-8 hours")
-    # Map goal to numeric range
-    goal_ranges = {
-        "<6 hours": (0, 6),
-        "6-7 hours": (6, 7),
-        "7-8 hours": (7, 8),
-        "8+ hours": (8, 24),
-    }
-    min_goal, max_goal = goal_ranges.get(goal, (7, 8))
-    # Give full points for being within goal, partial for close, less for far
-    if min_goal <= hours <= max_goal:
-        score += 100 * weights["duration"]
-    elif (min_goal - 0.5) <= hours < min_goal or max_goal < hours <= (max_goal + 0.5):
-        score += 75 * weights["duration"]
-    elif (min_goal - 1) <= hours < (min_goal - 0.5) or (max_goal + 0.5) < hours <= (max_goal + 1):
-        score += 50 * weights["duration"]
-    else:
-        score += 20 * weights["duration"]
-
-    # --- 2. Sleep Onset Latency (personalized if user provided) ---
-    onset_latency = int(log.get("time_to_fall_asleep", 15))
-    user_latency_goal = sleep_habits.get("time_to_fall_asleep", 20)
-    if onset_latency <= user_latency_goal:
-        score += 100 * weights["latency"]
-    elif onset_latency <= user_latency_goal + 10:
-        score += 70 * weights["latency"]
-    else:
-        score += 30 * weights["latency"]
-
-    # --- 3. Wakeups (personalized if user wakes up at night) ---
-    night_patterns = user_profile.get("night_patterns", {})
-    wakes_up_at_night = night_patterns.get("wakes_up_at_night", False)
-    wakeup_count_goal = night_patterns.get("wake_up_count", "0")
-    wakeups = int(log.get("woke_up_times", 0))
-    # If user says they usually wake up, be more lenient
-    if wakes_up_at_night:
-        if str(wakeups) == str(wakeup_count_goal):
-            score += 100 * weights["wakeups"]
-        elif abs(wakeups - int(wakeup_count_goal if wakeup_count_goal.isdigit() else 1)) == 1:
-            score += 70 * weights["wakeups"]
-        else:
-            score += 30 * weights["wakeups"]
-    else:
-        if wakeups == 0:
-            score += 100 * weights["wakeups"]
-        elif wakeups == 1:
-            score += 70 * weights["wakeups"]
-        else:
-            score += 30 * weights["wakeups"]
-
-    # --- 4. Morning Energy (not personalized yet) ---
-    energy_options = log.get("woke_up_feeling", ["😐 Okay"])
-    energy = energy_options[0] if energy_options else "😐 Okay"
-    if energy in ["💪 Energized", "🙂 Refreshed", "Motivated"]:
-        score += 100 * weights["energy"]
-    elif energy in ["😐 Okay", "😐 Meh"]:
-        score += 70 * weights["energy"]
-    else:
-        score += 30 * weights["energy"]
-
-    # --- 5. Schedule Consistency (personalized to usual_bedtime) ---
-    usual_bedtime = sleep_habits.get("usual_bedtime", "23:00")
-    try:
-        log_bedtime = log.get("bed_time", usual_bedtime)
-        log_bedtime_dt = datetime.strptime(log_bedtime, "%H:%M")
-        usual_bedtime_dt = datetime.strptime(usual_bedtime, "%H:%M")
-        bedtime_diff = abs((log_bedtime_dt - usual_bedtime_dt).total_seconds() / 60)
-    except Exception:
-        bedtime_diff = consistency
-    if bedtime_diff <= 15:
-        score += 100 * weights["consistency"]
-    elif bedtime_diff <= 30:
-        score += 70 * weights["consistency"]
-    else:
-        score += 30 * weights["consistency"]
-
-    # --- 6. Sleep Efficiency ---
-    time_in_bed_hours = float(log.get("time_in_bed", hours if hours > 0 else 8))
-    efficiency = (hours / time_in_bed_hours) * 100 if time_in_bed_hours > 0 else 0
-    if efficiency >= 90:
-        score += 100 * weights["efficiency"]
-    elif efficiency >= 75:
-        score += 70 * weights["efficiency"]
-    else:
-        score += 30 * weights["efficiency"]
-
-    # --- 7. Sleep Environment (not personalized yet) ---
-    environment_factors = log.get("sleep_environment", [])
-    score += min(len(environment_factors), 5) / 5 * 100 * weights["environment"]  # max 10% of score
-
-    # --- 8. Pre-Bed Stress (not personalized yet) ---
-    stress_level_options = log.get("mental_state", ["Neutral"])
-    stress_level = stress_level_options[0] if stress_level_options else "Neutral"
-    if stress_level == "Relaxed":
-        score += 100 * weights["stress"]
-    elif stress_level == "Neutral":
-        score += 60 * weights["stress"]
-    else:
-        score += 20 * weights["stress"]
-
-    return int(min(score, 100))
-
-# --- NEW: Use onboarding for goal display ---
-def get_user_goal_for_ai(user_profile):
-    onboarding = user_profile.get('onboarding', {}) if user_profile else {}
-    goal_map = {
-        "7+_hours": "Sleep 7+ hours",
-        "no_caffeine": "No caffeine after 6pm",
-        "log_daily": "Log my sleep daily",
-        "bed_before_11": "Go to bed before 11pm",
-        "wake_consistent": "Wake up at the same time",
-        "custom": onboarding.get('goal_custom', 'Custom goal')
-    }
-    if onboarding.get('goal'):
-        if onboarding['goal'] == 'custom':
-            return onboarding.get('goal_custom', 'Custom goal')
-        return goal_map.get(onboarding['goal'], onboarding['goal'])
-    # fallback legacy
-    return user_profile.get('goals', {}).get('primary_goal', 'improve sleep')
-
-def get_user_struggle_for_ai(user_profile):
-    onboarding = user_profile.get('onboarding', {}) if user_profile else {}
-    struggle_map = {
-        "falling_asleep": "Falling asleep",
-        "waking_up": "Waking up during the night",
-        "waking_early": "Waking up too early",
-        "consistency": "Staying consistent"
-    }
-    if onboarding.get('struggle'):
-        return struggle_map.get(onboarding['struggle'], onboarding['struggle'])
-    return None
-
-# Patch generate_gpt_suggestion to use new goal/struggle
-def generate_gpt_suggestion(score, log=None, user_profile=None):
-    if not openai.api_key or not log or not user_profile:
-        if score >= 90:
-            return "Excellent! Maintain your routine and avoid screens before bed."
-        elif score >= 75:
-            return "Good! Try to sleep a bit earlier for even better rest."
-        else:
-            return "You might benefit from cutting late-night screen time or adjusting your sleep schedule."
-    try:
-        user_goal = get_user_goal_for_ai(user_profile)
-        user_struggle = get_user_struggle_for_ai(user_profile)
-        prompt = (
-            f"User's sleep score: {score}\n"
-            f"User's main sleep goal: {user_goal}\n"
-            f"User's biggest struggle: {user_struggle}\n"
-            f"Sleep log summary: {log}\n"
-            "Write a short, friendly, and practical suggestion (1-2 sentences) to help the user improve their sleep, referencing their score, goal, and struggle."
-        )
-        response = openai.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "system", "content": "You are a helpful sleep coach."},
-                      {"role": "user", "content": prompt}],
-            max_tokens=60,
-            temperature=0.7,
-        )
-        content = response.choices[0].message.content
-        if content:
-            return content.strip()
-        else:
-            return "(AI suggestion unavailable: No content returned from OpenAI.)"
-    except Exception as e:
-        return f"(AI suggestion unavailable: {e})"
-
 # --- Routing Logic ---
 def set_page(page):
     st.session_state.page = page
@@ -785,6 +857,373 @@ def sync_page_from_query_params():
         st.session_state.page = page_from_url
         params.clear()
 
+def take_profile_request(uid):
+    """Consume a ?profile=1 query param; True if an admin (SLEEPAID_ADMIN_UIDS) asked to profile this rerun."""
+    params = st.query_params
+    if "profile" not in params:
+        return False
+    requested = params.get("profile") not in ("", "0")
+    del params["profile"]
+    return requested and uid in admin_uids()
+
+def show_admin_stats(uid):
+    """Shared suggestion-template hit rate in the sidebar, for admins (SLEEPAID_ADMIN_UIDS) only."""
+    if uid not in admin_uids():
+        return
+    stats = template_stats()
+    st.sidebar.caption(f"🛠️ Suggestion templates: {stats['hits']} hits, {stats['misses']} misses "
+                       f"({stats['hit_rate']:.0%} answered without a model call)")
+
+def profile_page_from_env(page):
+    """True the first time this session shows a page SLEEPAID_PROFILE names ("dashboard,log" or "all")."""
+    pages = env_pages()
+    if page not in pages and "all" not in pages:
+        return False
+    profiled = st.session_state.setdefault("profiled_pages", set())
+    if page in profiled:
+        return False
+    profiled.add(page)
+    return True
+
+def cached_gpt_suggestion(uid, today, today_score, logs, user_profile):
+    """Today's suggestion, looked up once per day and log state; only actual model calls count against usage."""
+    cache = get_cache()
+    fallback = []
+    def generate():
+        suggestion, source = suggest(today_score, logs[0] if logs else None, user_profile, logs)
+        if source == "rules":
+            fallback.append(suggestion)  # shown this time, but not kept for a day
+            return None
+        if source == "model":
+            increment_user_usage(uid)
+        return suggestion
+    parts = [today.isoformat(), user_generation(cache, uid), digest(user_profile)]
+    return cached(cache, "suggestion", uid, parts, generate) or fallback[0]
+
+def cached_log_scores(uid, cols, user_profile):
+    """score_columns over all of a user's logs, shared across replicas until the logs or scoring inputs change."""
+    cache = get_cache()
+    model = get_scoring_model(user_profile)
+    inputs = [model.version, (user_profile or {}).get("scoring_overrides"), model.profile_params(user_profile), len(cols)]
+    parts = [user_generation(cache, uid), digest(inputs)]
+    return np.asarray(cached(cache, "scores", uid, parts, lambda: score_columns(cols, user_profile).tolist()), dtype=np.int64)
+
+# --- Fragments ---
+# Each of these reruns on its own when one of its widgets is used, so toggling a
+# dashboard tab or editing the profile doesn't re-run Firebase init, the profile
+# and log loads, streaks and scores. Arguments are kept from the last full run.
+def rerun_fragment():
+    """Rerun only the current fragment, or the whole script if this isn't a fragment rerun."""
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        # e.g. the click arrived together with a full rerun (AppTest always does a full run)
+        st.rerun()
+
+def toggle_tab(tab):
+    # Toggle behavior: if same tab is clicked, close it.
+    st.session_state.active_tab = None if st.session_state.get('active_tab') == tab else tab
+
+def set_avatar_modal(show):
+    st.session_state.show_avatar_modal = show
+
+@st.fragment
+def trend_explorer(cols, scores, today):
+    """Long-range trends on the profile page; changing a control only reruns this panel."""
+    st.markdown("<h3 style='text-align: center; margin-bottom: 1rem; color: #C084FC; font-weight: 600;'>Trends</h3>", unsafe_allow_html=True)
+    col1, col2 = st.columns(2)
+    with col1:
+        metric = st.selectbox("Metric", list(METRICS), key="trend_metric")
+    with col2:
+        range_label = st.radio("Range", list(RANGES), horizontal=True, key="trend_range")
+    days = RANGES[range_label]
+    bucket = st.radio("Group by", BUCKETS, index=BUCKETS.index(default_bucket(days)), horizontal=True, key=f"trend_bucket_{range_label}")
+    dates, values, counts = trend_series(cols, scores, metric, days, bucket, today)
+    if not len(dates):
+        st.info("Log your sleep to see your trends here.")
+        return
+    fig = go.Figure(go.Scatter(
+        x=dates.astype(str),
+        y=values,
+        mode='lines+markers' if len(dates) <= 60 else 'lines',
+        line=dict(color='#A78BFA', width=2),
+        marker=dict(size=6),
+        customdata=counts,
+        hovertemplate='<b>%{x}</b><br>' + metric + ': %{y:.1f}<br>%{customdata} logged day(s)<extra></extra>'
+    ))
+    fig.update_layout(
+        xaxis=dict(showgrid=False, zeroline=False, tickfont=dict(color='#CCC8CF')),
+        yaxis=dict(showgrid=True, gridcolor='#333', zeroline=False, tickfont=dict(color='#CCC8CF')),
+        plot_bgcolor='rgba(0,0,0,0)', paper_bgcolor='rgba(0,0,0,0)',
+        margin=dict(l=0, r=0, t=0, b=0), height=260
+    )
+    st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': False})
+
+EXPORT_POLL_SECONDS = 2
+
+@st.fragment(run_every=EXPORT_POLL_SECONDS)
+def export_progress(token):
+    """Polls a running export; once it has finished, a full rerun swaps in the download link."""
+    job = get_job(token)
+    if job is None or job.status != "running":
+        st.rerun()
+    st.caption(f"⏳ Preparing your archive… {job.logs_written} logs so far")
+
+def export_panel(uid, user_profile):
+    """Full-account export: built in the background, then downloadable from this session for an hour."""
+    job = get_job(st.session_state.get("export_token") or "")
+    if job is not None and job.uid != uid:
+        job = None
+    if job is not None and job.status == "failed":
+        st.error(f"❌ Export failed: {job.error}")
+    if job is None or job.status == "failed":
+        if not st.button("📦 Export all my data", key="export_button"):
+            return
+        job = start_export(db, uid, user_profile, get_writer().pending("log", uid))
+        st.session_state.export_token = job.token
+    if job.status == "running":
+        export_progress(job.token)
+    else:
+        # Read only when clicked, so the archive isn't held in memory for every rerun
+        st.download_button("⬇️ Download your archive", data=lambda: read_archive(job), file_name=job.filename,
+                           mime="application/zip", key="export_download")
+        st.caption(f"{job.logs_written} logs, profile, usage and avatar; available for an hour")
+
+DEBT_WINDOWS = ["Last 7 days", "Last 30 days", "This month", "Last month", "Custom"]
+
+@st.fragment
+def sleep_debt_view(index, today, goal):
+    """Sleep debt and recovery for a chosen window, straight from the prefix-sum index."""
+    st.markdown("<h3 style='text-align: center; margin-bottom: 1rem; color: #C084FC; font-weight: 600;'>Sleep Debt</h3>", unsafe_allow_html=True)
+    choice = st.radio("Window", DEBT_WINDOWS, horizontal=True, key="debt_window")
+    if choice == "Last 7 days":
+        stats = index.last_days(today, 7)
+    elif choice == "Last 30 days":
+        stats = index.last_days(today, 30)
+    elif choice == "This month":
+        stats = index.window(today.replace(day=1).toordinal(), today.toordinal())
+    elif choice == "Last month":
+        last_month = today.replace(day=1) - timedelta(days=1)
+        stats = index.month(last_month.year, last_month.month)
+    else:
+        picked = st.date_input("Range", value=(today - timedelta(days=13), today), max_value=today, key="debt_range")
+        if not isinstance(picked, (tuple, list)) or len(picked) != 2:
+            st.caption("Pick a start and an end date.")
+            return
+        stats = index.window(picked[0].toordinal(), picked[1].toordinal())
+    if not stats["nights_logged"]:
+        st.info("No nights logged in this window.")
+        return
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Sleep debt", f"{stats['sleep_debt']:.1f} h")
+    col2.metric("Recovered", f"{stats['recovered']:.1f} h")
+    col3.metric("Net", f"{stats['net_debt']:.1f} h" if stats['net_debt'] > 0 else "None")
+    st.caption(f"Against your {goal} goal, over {stats['nights_logged']} logged night{'s' if stats['nights_logged'] != 1 else ''}. "
+               f"Average {stats['avg_hours']:.1f} h, {stats['percent_in_goal']}% of nights within your goal.")
+
+@st.fragment
+def dashboard_tabs(store, logs, today, today_score, rollup, user_profile):
+    """Metrics / GPT Suggestion / Last 7 Days panel on the dashboard."""
+    st.markdown("<div class='dashboard-tabs-container'>", unsafe_allow_html=True)
+    with st.container(border=True):
+        tabs = ["Metrics", "GPT Suggestion", "Last 7 Days"]
+        if 'active_tab' not in st.session_state:
+            st.session_state.active_tab = None
+
+        cols = st.columns(len(tabs))
+        for i, tab in enumerate(tabs):
+            with cols[i]:
+                # The callback runs before the fragment re-executes, so no extra rerun is needed
+                st.button(tab, key=f"tab_{tab}", use_container_width=True, on_click=toggle_tab, args=(tab,))
+
+        # --- Display content based on active tab ---
+        active_tab = st.session_state.get("active_tab") # Can be None
+        if active_tab:
+            st.markdown("<div style='padding-top: 1.5rem;'>", unsafe_allow_html=True)
+
+            if active_tab == "Metrics":
+                if logs:
+                    latest_log = logs[0]
+                    efficiency_val = f"{latest_log.sleep_efficiency:.0f}%" if latest_log.sleep_efficiency is not None else "N/A"
+                    latency_val = f"{latest_log.time_to_fall_asleep} min" if latest_log.time_to_fall_asleep is not None else "N/A"
+
+                    col1, col2, col3 = st.columns(3)
+                    with col1:
+                        st.metric("Hours Slept", f"{latest_log.hours_slept}")
+                    with col2:
+                        st.metric("Sleep Efficiency", efficiency_val)
+                    with col3:
+                        st.metric("Time to Fall Asleep", latency_val)
+                else:
+                    st.info("Log your sleep to see your metrics here.")
+
+            elif active_tab == "GPT Suggestion":
+                st.markdown("<h4 style='text-align: center; color: #CCC8CF;'>AI-Powered Insight</h4>", unsafe_allow_html=True)
+                user_usage = get_user_usage(st.session_state.user_uid) or {}
+                if user_usage.get("messages", 0) >= 100:
+                    st.warning("You've hit your monthly message limit.")
+                    suggestion = "(AI suggestion unavailable: message limit reached.)"
+                elif rollup and rollup.get("suggestion"):
+                    # Precomputed overnight, no model call needed
+                    suggestion = rollup["suggestion"]
+                else:
+                    suggestion = cached_gpt_suggestion(st.session_state.user_uid, today, today_score, logs, user_profile)
+                st.markdown(f"<p style='text-align: center; font-size: 1.1rem; padding: 0 1rem;'>{suggestion}</p>", unsafe_allow_html=True)
+
+            elif active_tab == "Last 7 Days":
+                st.markdown("<h4 style='text-align: center; margin-bottom: 1.5rem; color: #C084FC; font-weight: 600;'>7-Day Sleep Score Trend</h4>", unsafe_allow_html=True)
+                date_range = last_n_days(today, 7)
+                week = store.slice(date_range[0].toordinal(), today.toordinal())
+                scores_by_date = dict(zip(week.ordinal.tolist(), score_columns(week, user_profile).tolist()))
+                trend_data = []
+                for day in date_range:
+                    score = scores_by_date.get(day.toordinal(), 0)
+                    trend_data.append({'day': get_day_label(day), 'score': score})
+
+                df = pd.DataFrame(trend_data)
+
+                fig = go.Figure()
+                bar_colors = ['#A78BFA' if s > 0 else 'rgba(0,0,0,0)' for s in df['score']]
+                fig.add_trace(go.Bar(
+                    x=df.index,
+                    y=df['score'],
+                    marker_color=bar_colors,
+                    marker_line_width=0,
+                    width=0.6,
+                    customdata=df['day'],
+                    hovertemplate='<b>%{customdata}</b><br>Score: %{y}<extra></extra>'
+                ))
+                fig.update_layout(
+                    xaxis=dict(showgrid=False, showline=False, zeroline=False, tickfont=dict(color='#CCC8CF', size=14), tickmode='array', tickvals=df.index, ticktext=df['day']),
+                    yaxis=dict(showgrid=False, showline=False, zeroline=False, showticklabels=False, range=[0, 105]),
+                    plot_bgcolor='rgba(0,0,0,0)', paper_bgcolor='rgba(0,0,0,0)',
+                    margin=dict(l=0, r=0, t=0, b=0), bargap=0.2, height=150
+                )
+                fig.update_traces(marker_cornerradius=8)
+                st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': False})
+
+            st.markdown("</div>", unsafe_allow_html=True)
+    st.markdown("</div>", unsafe_allow_html=True)
+
+@st.fragment
+def avatar_editor(uid):
+    """Avatar preview with change/remove controls on the Edit Profile page."""
+    avatar_img = avatar_img_tag(uid, 100)
+    col1, col2, col3 = st.columns([1, 1, 1])
+    with col1:
+        if avatar_img:
+            st.markdown(avatar_img, unsafe_allow_html=True)
+        else:
+            st.image("https://ui-avatars.com/api/?name=User", width=100)
+    with col2:
+        st.button("Change Avatar", on_click=set_avatar_modal, args=(True,))
+    with col3:
+        if avatar_img:
+            if st.button("Remove"):
+                remove_avatar(uid)
+                st.success("Avatar removed!")
+                time.sleep(0.5)
+                rerun_fragment()
+    if st.session_state.get("show_avatar_modal", False):
+        with st.expander("Upload a new avatar", expanded=True):
+            uploaded_file = st.file_uploader("Choose a new avatar", type=["png", "jpg", "jpeg"])
+            if uploaded_file:
+                try:
+                    process_avatar(uid, uploaded_file.getvalue())
+                except ValueError as e:
+                    st.error(f"❌ Avatar not saved: {e}")
+                else:
+                    st.success("Avatar updated!")
+                    st.session_state.show_avatar_modal = False
+                    time.sleep(0.5)
+                    rerun_fragment()
+            st.button("Close", on_click=set_avatar_modal, args=(False,))
+
+@st.fragment
+def edit_profile_form(user_profile, personal_info, sleep_patterns, lifestyle_support):
+    """Edit Profile form. Saving or cancelling reruns the whole page to leave edit mode."""
+    with st.form("edit_profile_form"):
+        st.markdown("### Personal Info")
+        first_name = st.text_input("First Name", value=personal_info.get('first_name', ''))
+        age = st.text_input("Age", value=str(personal_info.get('age', '')))
+        gender = st.selectbox("Gender (optional)", ["", "Male", "Female", "Other"], index=["", "Male", "Female", "Other"].index(personal_info.get('gender', '')))
+        timezone = st.selectbox("Time Zone", TIMEZONES, index=timezone_index(personal_info.get('timezone', 'UTC')))
+        st.markdown("### Sleep Patterns")
+        struggle = st.selectbox("What's your biggest sleep struggle?", ["Falling asleep", "Waking up during the night", "Waking up too early", "Staying consistent"], index=["Falling asleep", "Waking up during the night", "Waking up too early", "Staying consistent"].index(sleep_patterns.get('struggle', 'Falling asleep')))
+        goal = st.selectbox("What's your main sleep goal?", ["Sleep 7+ hours", "No caffeine after 6pm", "Log my sleep daily", "Go to bed before 11pm", "Wake up at the same time", "Custom goal"], index=["Sleep 7+ hours", "No caffeine after 6pm", "Log my sleep daily", "Go to bed before 11pm", "Wake up at the same time", "Custom goal"].index(sleep_patterns.get('goal', 'Sleep 7+ hours')))
+        goal_custom = ""
+        if goal == "Custom goal":
+            goal_custom = st.text_input("Describe your custom sleep goal:", value=sleep_patterns.get('goal_custom', ''))
+        usual_bedtime = st.time_input("What time do you usually go to bed?", value=datetime.strptime(sleep_patterns.get('usual_bedtime', '23:00'), "%H:%M").time())
+        usual_wake_time = st.time_input("What time do you usually wake up?", value=datetime.strptime(sleep_patterns.get('usual_wake_time', '07:00'), "%H:%M").time())
+        st.markdown("### Lifestyle & Support Preferences")
+        workout = st.radio("Do you have a workout routine?", ["Yes", "No"], index=0 if lifestyle_support.get('workout', 'No') == 'Yes' else 1)
+        workout_freq = 0
+        if workout == "Yes":
+            workout_freq = st.number_input("How many times per week?", min_value=1, max_value=14, value=lifestyle_support.get('workout_freq', 3))
+        caffeine = st.radio("Do you use caffeine?", ["Yes", "No"], index=0 if lifestyle_support.get('caffeine', 'No') == 'Yes' else 1)
+        caffeine_time = ""
+        if caffeine == "Yes":
+            caffeine_time = st.time_input("Time of last caffeine?", value=datetime.strptime(lifestyle_support.get('caffeine_time', '15:00'), "%H:%M").time())
+        phone_use = st.radio("Do you use your phone at night?", ["Yes", "No"], index=0 if lifestyle_support.get('phone_use', 'Yes') == 'Yes' else 1)
+        support_pref = st.text_area("What would you like SleepAid to help with most?", value=lifestyle_support.get('support_pref', ''))
+        submitted = st.form_submit_button("Save Changes")
+        cancel = st.form_submit_button("Cancel")
+    if submitted:
+        errors = []
+        if not (first_name or "").strip():
+            errors.append("First name is required.")
+        try:
+            age_val = int(age or "")
+            if age_val <= 0 or age_val > 120:
+                errors.append("Age must be a positive number less than 120.")
+        except Exception:
+            errors.append("Please enter a valid number for age.")
+        if not timezone:
+            errors.append("Time zone is required.")
+        if goal == "Custom goal" and not (goal_custom or "").strip():
+            errors.append("Please enter your custom goal.")
+        if not usual_bedtime:
+            errors.append("Usual bedtime is required.")
+        if not usual_wake_time:
+            errors.append("Usual wake time is required.")
+        if errors:
+            for err in errors:
+                st.error(err)
+            return
+        updated_profile = user_profile.copy() if user_profile and isinstance(user_profile, dict) else {}
+        updated_profile['personal_info'] = {
+            "first_name": (first_name or "").strip(),
+            "age": age_val,
+            "gender": gender,
+            "timezone": timezone,
+        }
+        updated_profile['sleep_patterns'] = {
+            "struggle": struggle,
+            "goal": goal,
+            "goal_custom": (goal_custom or "").strip() if goal == "Custom goal" else "",
+            "usual_bedtime": usual_bedtime.strftime("%H:%M") if usual_bedtime else '',
+            "usual_wake_time": usual_wake_time.strftime("%H:%M") if usual_wake_time else '',
+        }
+        updated_profile['lifestyle_support'] = {
+            "workout": workout,
+            "workout_freq": workout_freq if workout == "Yes" else 0,
+            "caffeine": caffeine,
+            "caffeine_time": caffeine_time.strftime("%H:%M") if caffeine == "Yes" and caffeine_time else '',
+            "phone_use": phone_use,
+            "support_pref": (support_pref or '').strip(),
+        }
+        updated_profile['onboarding_complete'] = True
+        updated_profile['updated_at'] = datetime.now().isoformat()
+        if save_user_profile(st.session_state.user_uid, updated_profile):
+            st.success("✅ Profile updated!")
+            st.session_state.editing_profile = False
+            time.sleep(0.5)
+            st.rerun()
+    elif cancel:
+        st.session_state.editing_profile = False
+        st.rerun()
+
 page = st.session_state.get('page', 'login')
 
 # --- Protected Content ---
@@ -891,9 +1330,14 @@ if not st.session_state.logged_in:
                     st.error("Passwords do not match.")
 else:
     # --- Main App (when logged in) ---
+    # Read before the page sync below clears the query params
+    profile_requested = take_profile_request(st.session_state.user_uid)
     # Sync page from URL first, as links will set query params
     sync_page_from_query_params()
     page = st.session_state.get('page', 'dashboard')
+    if profile_requested or profile_page_from_env(page):
+        # Samples the rest of this rerun; the flame profile is written when it ends
+        profile_rerun(page, st.session_state.user_uid)
     
     # Handle actions from query params, like logout
     params = st.query_params
@@ -933,7 +1377,10 @@ else:
         if st.button("Logout"):
             logout()
 
+    show_admin_stats(st.session_state.user_uid)
+
     # --- Onboarding / Main App Logic ---
+    show_failed_writes(st.session_state.user_uid)
     user_profile = get_user_profile(st.session_state.user_uid)
     onboarding_complete = user_profile is not None and user_profile.get("onboarding_complete", False)
     
@@ -945,10 +1392,19 @@ else:
     # --- DASHBOARD ---
     elif page == "dashboard":
         # --- Main Content ---
-        logs = load_user_logs(st.session_state.user_uid)
+        store = get_log_store(st.session_state.user_uid)
+        logs = store.newest_first()
+        # --- Precomputed rollup from the nightly worker (if still fresh) ---
+        # All date math below uses the user's local sleep day
+        today = user_today(user_profile)
+        rollup = load_user_rollup(st.session_state.user_uid, today)
+        if not rollup_is_fresh(rollup, logs, today, user_profile):
+            rollup = None
         # --- Calculate Streaks ---
-        user_timezone = user_profile.get('personal_info', {}).get('timezone', 'UTC') if user_profile else 'UTC'
-        current_streak, longest_streak = calculate_streaks(logs)
+        if rollup:
+            current_streak, longest_streak = rollup["current_streak"], rollup["longest_streak"]
+        else:
+            current_streak, longest_streak = calculate_streaks(logs, today)
         # --- Streak Badge ---
         streak_emoji = '🔥' if current_streak >= 3 else '🌙'
         streak_badge_html = f"""
@@ -964,28 +1420,10 @@ else:
             st.success(f"🎉 Congrats! {current_streak}-day streak! Keep it going!")
         
         # --- Calculate Today's Score and Change ---
-        today_score = 0
-        change_percent = 0
-        if logs:
-            consistency_diff = 0
-            # Calculate consistency if there's a previous log to compare to
-            if len(logs) > 1:
-                try:
-                    latest_bedtime = datetime.strptime(logs[0].get("bed_time", "00:00"), "%H:%M")
-                    previous_bedtime = datetime.strptime(logs[1].get("bed_time", "00:00"), "%H:%M")
-                    consistency_diff = abs((latest_bedtime - previous_bedtime).total_seconds() / 60)
-                except (ValueError, KeyError):
-                    consistency_diff = 0 # Handle potential missing or malformed data
-
-            today_score = calculate_sleep_score(logs[0], user_profile, consistency_diff)
-
-            # Calculate percentage change from the previous day's score
-            if len(logs) > 1:
-                previous_score = calculate_sleep_score(logs[1], user_profile, 0) # Use 0 consistency for prev day
-                if previous_score > 0:
-                    change_percent = int(((today_score - previous_score) / previous_score) * 100)
-                elif today_score > 0:
-                    change_percent = 100 # From 0 to a positive score
+        if rollup:
+            today_score, change_percent = rollup["today_score"], rollup["change_percent"]
+        else:
+            today_score, _, change_percent = calculate_today_scores(logs, user_profile)
 
         # --- Centered Logo Header ---
         logo_path = os.path.join(ASSETS_DIR, "sleepaid_text.svg")
@@ -1015,90 +1453,7 @@ else:
         st.markdown(score_card_html, unsafe_allow_html=True)
         
         # --- Tabs for different views (INSIDE the grey box) ---
-        st.markdown("<div class='dashboard-tabs-container'>", unsafe_allow_html=True)
-        with st.container(border=True):
-            tabs = ["Metrics", "GPT Suggestion", "Last 7 Days"]
-            if 'active_tab' not in st.session_state:
-                st.session_state.active_tab = None
-
-            cols = st.columns(len(tabs))
-            for i, tab in enumerate(tabs):
-                with cols[i]:
-                    if st.button(tab, key=f"tab_{tab}", use_container_width=True):
-                        # Toggle behavior: if same tab is clicked, close it.
-                        if st.session_state.get('active_tab') == tab:
-                            st.session_state.active_tab = None
-                        else:
-                            st.session_state.active_tab = tab
-                        st.rerun()
-
-            # --- Display content based on active tab ---
-            active_tab = st.session_state.get("active_tab") # Can be None
-            if active_tab:
-                st.markdown("<div style='padding-top: 1.5rem;'>", unsafe_allow_html=True)
-
-                if active_tab == "Metrics":
-                    if logs:
-                        latest_log = logs[0]
-                        efficiency_val = f"{latest_log.get('sleep_efficiency', 0):.0f}%" if 'sleep_efficiency' in latest_log else "N/A"
-                        latency_val = f"{latest_log.get('time_to_fall_asleep', 'N/A')} min" if 'time_to_fall_asleep' in latest_log else "N/A"
-
-                        col1, col2, col3 = st.columns(3)
-                        with col1:
-                            st.metric("Hours Slept", f"{latest_log.get('hours_slept', 'N/A')}")
-                        with col2:
-                            st.metric("Sleep Efficiency", efficiency_val)
-                        with col3:
-                            st.metric("Time to Fall Asleep", latency_val)
-                    else:
-                        st.info("Log your sleep to see your metrics here.")
-
-                elif active_tab == "GPT Suggestion":
-                    st.markdown("<h4 style='text-align: center; color: #CCC8CF;'>AI-Powered Insight</h4>", unsafe_allow_html=True)
-                    user_usage = get_user_usage(st.session_state.user_uid) or {}
-                    if user_usage.get("messages", 0) >= 100:
-                        st.warning("You've hit your monthly message limit.")
-                        suggestion = "(AI suggestion unavailable: message limit reached.)"
-                    else:
-                        suggestion = generate_gpt_suggestion(today_score, logs[0] if logs else None, user_profile)
-                        increment_user_usage(st.session_state.user_uid)
-                    st.markdown(f"<p style='text-align: center; font-size: 1.1rem; padding: 0 1rem;'>{suggestion}</p>", unsafe_allow_html=True)
-
-                elif active_tab == "Last 7 Days":
-                    st.markdown("<h4 style='text-align: center; margin-bottom: 1.5rem; color: #C084FC; font-weight: 600;'>7-Day Sleep Score Trend</h4>", unsafe_allow_html=True)
-                    today = datetime.now()
-                    date_range = [today - timedelta(days=i) for i in range(6, -1, -1)]
-                    scores_by_date = {log['date']: calculate_sleep_score(log, user_profile, 0) for log in logs}
-                    trend_data = []
-                    for day in date_range:
-                        date_str = day.strftime('%Y-%m-%d')
-                        score = scores_by_date.get(date_str, 0)
-                        trend_data.append({'day': get_day_label(day), 'score': score})
-                    
-                    df = pd.DataFrame(trend_data)
-                    
-                    fig = go.Figure()
-                    bar_colors = ['#A78BFA' if s > 0 else 'rgba(0,0,0,0)' for s in df['score']]
-                    fig.add_trace(go.Bar(
-                        x=df.index,
-                        y=df['score'],
-                        marker_color=bar_colors,
-                        marker_line_width=0,
-                        width=0.6,
-                        customdata=df['day'],
-                        hovertemplate='<b>%{customdata}</b><br>Score: %{y}<extra></extra>'
-                    ))
-                    fig.update_layout(
-                        xaxis=dict(showgrid=False, showline=False, zeroline=False, tickfont=dict(color='#CCC8CF', size=14), tickmode='array', tickvals=df.index, ticktext=df['day']),
-                        yaxis=dict(showgrid=False, showline=False, zeroline=False, showticklabels=False, range=[0, 105]),
-                        plot_bgcolor='rgba(0,0,0,0)', paper_bgcolor='rgba(0,0,0,0)',
-                        margin=dict(l=0, r=0, t=0, b=0), bargap=0.2, height=150
-                    )
-                    fig.update_traces(marker_cornerradius=8)
-                    st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': False})
-                
-                st.markdown("</div>", unsafe_allow_html=True)
-        st.markdown("</div>", unsafe_allow_html=True)
+        dashboard_tabs(store, logs, today, today_score, rollup, user_profile)
 
         # --- Log Sleep Button ---
         st.markdown('<div class="log-sleep-button-container" style="margin-top: 1.5rem;">', unsafe_allow_html=True)
@@ -1107,12 +1462,11 @@ else:
         st.markdown('</div>', unsafe_allow_html=True)
 
         # --- Top Right Avatar ---
-        avatar_path = os.path.join(AVATAR_DIR, f"{st.session_state.user_uid}.png")
-        if os.path.exists(avatar_path):
-            avatar_img = f"data:image/png;base64,{get_image_as_base64(avatar_path)}"
+        avatar_img = avatar_img_tag(st.session_state.user_uid, 48, "border-radius:50%; border:2px solid #C084FC; background:#232026;")
+        if avatar_img:
             avatar_html = f"""
             <div style='position: fixed; top: 1.2rem; right: 1.5rem; z-index: 1002;'>
-                <img src='{avatar_img}' width='48' height='48' style='border-radius:50%; border:2px solid #C084FC; background:#232026;'/>
+                {avatar_img}
             </div>
             """
         else:
@@ -1129,9 +1483,13 @@ else:
         user_name = user_profile.get('personal_info', {}).get('name', 'User') if (user_profile and isinstance(user_profile, dict)) else 'User'
         initials = ''.join([x[0] for x in user_name.split()]) if user_name else 'U'
         initials = initials.upper()
-        logs = load_user_logs(st.session_state.user_uid)
-        sleeps_logged = len(logs)
-        avg_score = int(sum([calculate_sleep_score(log, user_profile, 0) for log in logs]) / sleeps_logged) if sleeps_logged else 0
+        store = get_log_store(st.session_state.user_uid)
+        logs = store.newest_first()
+        all_logs = store.view()
+        sleeps_logged = len(all_logs)
+        # Score every log once in a single batch; reused by the card and the trend chart
+        log_scores = cached_log_scores(st.session_state.user_uid, all_logs, user_profile)
+        avg_score = int(log_scores.mean()) if sleeps_logged else 0
         # --- Profile Editing State ---
         if 'editing_profile' not in st.session_state:
             st.session_state.editing_profile = False
@@ -1141,118 +1499,8 @@ else:
             personal_info = user_profile.get('personal_info', {}) if user_profile else {}
             sleep_patterns = user_profile.get('sleep_patterns', {}) if user_profile else {}
             lifestyle_support = user_profile.get('lifestyle_support', {}) if user_profile else {}
-            uid = st.session_state.user_uid
-            avatar_path = os.path.join(AVATAR_DIR, f"{uid}.png")
-            col1, col2, col3 = st.columns([1, 1, 1])
-            with col1:
-                if os.path.exists(avatar_path):
-                    st.image(avatar_path, width=100)
-                else:
-                    st.image("https://ui-avatars.com/api/?name=User", width=100)
-            with col2:
-                if st.button("Change Avatar"):
-                    st.session_state.show_avatar_modal = True
-            with col3:
-                if os.path.exists(avatar_path):
-                    if st.button("Remove"):
-                        os.remove(avatar_path)
-                        st.success("Avatar removed!")
-                        time.sleep(0.5)
-                        st.rerun()
-            if st.session_state.get("show_avatar_modal", False):
-                with st.expander("Upload a new avatar", expanded=True):
-                    uploaded_file = st.file_uploader("Choose a new avatar", type=["png", "jpg", "jpeg"])
-                    if uploaded_file:
-                        with open(avatar_path, "wb") as f:
-                            f.write(uploaded_file.read())
-                        st.success("Avatar updated!")
-                        st.session_state.show_avatar_modal = False
-                        time.sleep(0.5)
-                        st.rerun()
-                    if st.button("Close"):
-                        st.session_state.show_avatar_modal = False
-            with st.form("edit_profile_form"):
-                st.markdown("### Personal Info")
-                first_name = st.text_input("First Name", value=personal_info.get('first_name', ''))
-                age = st.text_input("Age", value=str(personal_info.get('age', '')))
-                gender = st.selectbox("Gender (optional)", ["", "Male", "Female", "Other"], index=["", "Male", "Female", "Other"].index(personal_info.get('gender', '')))
-                timezone_list = pytz.all_timezones
-                timezone = st.selectbox("Time Zone", timezone_list, index=timezone_list.index(personal_info.get('timezone', 'UTC')) if personal_info.get('timezone', 'UTC') in timezone_list else 0)
-                st.markdown("### Sleep Patterns")
-                struggle = st.selectbox("What's your biggest sleep struggle?", ["Falling asleep", "Waking up during the night", "Waking up too early", "Staying consistent"], index=["Falling asleep", "Waking up during the night", "Waking up too early", "Staying consistent"].index(sleep_patterns.get('struggle', 'Falling asleep')))
-                goal = st.selectbox("What's your main sleep goal?", ["Sleep 7+ hours", "No caffeine after 6pm", "Log my sleep daily", "Go to bed before 11pm", "Wake up at the same time", "Custom goal"], index=["Sleep 7+ hours", "No caffeine after 6pm", "Log my sleep daily", "Go to bed before 11pm", "Wake up at the same time", "Custom goal"].index(sleep_patterns.get('goal', 'Sleep 7+ hours')))
-                goal_custom = ""
-                if goal == "Custom goal":
-                    goal_custom = st.text_input("Describe your custom sleep goal:", value=sleep_patterns.get('goal_custom', ''))
-                usual_bedtime = st.time_input("What time do you usually go to bed?", value=datetime.strptime(sleep_patterns.get('usual_bedtime', '23:00'), "%H:%M").time())
-                usual_wake_time = st.time_input("What time do you usually wake up?", value=datetime.strptime(sleep_patterns.get('usual_wake_time', '07:00'), "%H:%M").time())
-                st.markdown("### Lifestyle & Support Preferences")
-                workout = st.radio("Do you have a workout routine?", ["Yes", "No"], index=0 if lifestyle_support.get('workout', 'No') == 'Yes' else 1)
-                workout_freq = 0
-                if workout == "Yes":
-                    workout_freq = st.number_input("How many times per week?", min_value=1, max_value=14, value=lifestyle_support.get('workout_freq', 3))
-                caffeine = st.radio("Do you use caffeine?", ["Yes", "No"], index=0 if lifestyle_support.get('caffeine', 'No') == 'Yes' else 1)
-                caffeine_time = ""
-                if caffeine == "Yes":
-                    caffeine_time = st.time_input("Time of last caffeine?", value=datetime.strptime(lifestyle_support.get('caffeine_time', '15:00'), "%H:%M").time())
-                phone_use = st.radio("Do you use your phone at night?", ["Yes", "No"], index=0 if lifestyle_support.get('phone_use', 'Yes') == 'Yes' else 1)
-                support_pref = st.text_area("What would you like SleepAid to help with most?", value=lifestyle_support.get('support_pref', ''))
-                submitted = st.form_submit_button("Save Changes")
-                cancel = st.form_submit_button("Cancel")
-            if submitted:
-                errors = []
-                if not (first_name or "").strip():
-                    errors.append("First name is required.")
-                try:
-                    age_val = int(age or "")
-                    if age_val <= 0 or age_val > 120:
-                        errors.append("Age must be a positive number less than 120.")
-                except Exception:
-                    errors.append("Please enter a valid number for age.")
-                if not timezone:
-                    errors.append("Time zone is required.")
-                if goal == "Custom goal" and not (goal_custom or "").strip():
-                    errors.append("Please enter your custom goal.")
-                if not usual_bedtime:
-                    errors.append("Usual bedtime is required.")
-                if not usual_wake_time:
-                    errors.append("Usual wake time is required.")
-                if errors:
-                    for err in errors:
-                        st.error(err)
-                    st.stop()
-                updated_profile = user_profile.copy() if user_profile and isinstance(user_profile, dict) else {}
-                updated_profile['personal_info'] = {
-                    "first_name": (first_name or "").strip(),
-                    "age": age_val,
-                    "gender": gender,
-                    "timezone": timezone,
-                }
-                updated_profile['sleep_patterns'] = {
-                    "struggle": struggle,
-                    "goal": goal,
-                    "goal_custom": (goal_custom or "").strip() if goal == "Custom goal" else "",
-                    "usual_bedtime": usual_bedtime.strftime("%H:%M") if usual_bedtime else '',
-                    "usual_wake_time": usual_wake_time.strftime("%H:%M") if usual_wake_time else '',
-                }
-                updated_profile['lifestyle_support'] = {
-                    "workout": workout,
-                    "workout_freq": workout_freq if workout == "Yes" else 0,
-                    "caffeine": caffeine,
-                    "caffeine_time": caffeine_time.strftime("%H:%M") if caffeine == "Yes" and caffeine_time else '',
-                    "phone_use": phone_use,
-                    "support_pref": (support_pref or '').strip(),
-                }
-                updated_profile['onboarding_complete'] = True
-                updated_profile['updated_at'] = datetime.now().isoformat()
-                if save_user_profile(st.session_state.user_uid, updated_profile):
-                    st.success("✅ Profile updated!")
-                    st.session_state.editing_profile = False
-                    time.sleep(0.5)
-                    st.rerun()
-            elif cancel:
-                st.session_state.editing_profile = False
-                st.rerun()
+            avatar_editor(st.session_state.user_uid)
+            edit_profile_form(user_profile, personal_info, sleep_patterns, lifestyle_support)
             st.stop()
 
         # --- Profile Card with Edit Profile Button truly inside ---
@@ -1260,10 +1508,8 @@ else:
         first_name = (personal_info.get('first_name') or '').strip()
         display_name = first_name if first_name else 'User'
         initials = display_name[0].upper() if display_name else 'U'
-        avatar_path = os.path.join(AVATAR_DIR, f"{st.session_state.user_uid}.png")
-        if os.path.exists(avatar_path):
-            avatar_img_html = f"<img src='data:image/png;base64,{get_image_as_base64(avatar_path)}' width='64' style='border-radius:50%;'/>"
-        else:
+        avatar_img_html = avatar_img_tag(st.session_state.user_uid, 64, "border-radius:50%;")
+        if not avatar_img_html:
             avatar_img_html = f"<div class='me-avatar'>{initials}</div>"
             
 
@@ -1301,19 +1547,9 @@ else:
             <circle cx="12" cy="12" r="2" fill="#C084FC"/>
         </svg>
         """
-        # --- NEW: Use onboarding for goal display ---
-        onboarding = user_profile.get('onboarding', {}) if user_profile else {}
-        goal_map = {
-            "7+_hours": "Sleep 7+ hours",
-            "no_caffeine": "No caffeine after 6pm",
-            "log_daily": "Log my sleep daily",
-            "bed_before_11": "Go to bed before 11pm",
-            "wake_consistent": "Wake up at the same time",
-            "custom": None
-        }
-        user_goal = goal_map.get(onboarding.get('goal', ''), None)
-        if onboarding.get('goal', '') == 'custom':
-            user_goal = onboarding.get('goal_custom', 'Custom goal') if isinstance(onboarding.get('goal_custom', None), str) else 'Custom goal'
+        # --- Goal display (canonical profiles keep it under sleep_patterns; see sleepaid_profiles) ---
+        sleep_patterns = user_profile.get('sleep_patterns', {}) if user_profile else {}
+        user_goal = get_user_goal_for_ai(user_profile) if (sleep_patterns or {}).get('goal') else None
         if not user_goal:
             # fallback to legacy
             user_goal = user_profile.get('goals', {}).get('primary_goal', 'Goal not set') if user_profile and isinstance(user_profile, dict) else 'Goal not set'
@@ -1342,16 +1578,15 @@ else:
             st.markdown("<h3 style='text-align: center; margin-bottom: 1.5rem; color: #C084FC; font-weight: 600;'>7-Day Sleep Trend</h3>", unsafe_allow_html=True)
 
             # 1. Prepare data for the last 7 days, ensuring correct chronological order
-            today = datetime.now()
-            date_range = [today - timedelta(days=i) for i in range(6, -1, -1)] # Past to present
+            today = user_today(user_profile)
+            date_range = last_n_days(today, 7) # Past to present
             
             day_order = [get_day_label(day) for day in date_range]
-            scores_by_date = {log['date']: calculate_sleep_score(log, user_profile, 0) for log in logs}
+            scores_by_date = dict(zip(all_logs.ordinal.tolist(), log_scores.tolist()))
 
             trend_data = []
             for day in date_range:
-                date_str = day.strftime('%Y-%m-%d')
-                score = scores_by_date.get(date_str, 0)
+                score = scores_by_date.get(day.toordinal(), 0)
                 trend_data.append({'day': get_day_label(day), 'score': score})
 
             df = pd.DataFrame(trend_data)
@@ -1412,30 +1647,22 @@ else:
                 st.markdown(f"<div style='text-align: center;'><div style='font-size: 1.8rem; font-weight: 600; color: #A78BFA;'>{low_score_7d}</div><div style='color: #CCC8CF;'>Low</div></div>", unsafe_allow_html=True)
         st.markdown("</div>", unsafe_allow_html=True)
 
+        # --- Long-Range Trends (resampled and downsampled server-side) ---
+        st.markdown("<div class='me-page-trend-container'>", unsafe_allow_html=True)
+        with st.container(border=True):
+            trend_explorer(all_logs, log_scores, today)
+        st.markdown("</div>", unsafe_allow_html=True)
+
+        # --- Sleep Debt (any window, from the prefix-sum index) ---
+        st.markdown("<div class='me-page-trend-container'>", unsafe_allow_html=True)
+        with st.container(border=True):
+            sleep_debt_view(get_prefix_index(st.session_state.user_uid, store, user_profile), today, goal_range(user_profile)[0])
+        st.markdown("</div>", unsafe_allow_html=True)
+
         # --- Sleep Log History Table (Full History) ---
         st.markdown("<h4 style='color: #C084FC; font-weight: 700; margin-bottom: 1rem;'>Sleep Log History</h4>", unsafe_allow_html=True)
         if logs:
-            # Prepare DataFrame
-            history_data = []
-            for log in logs:
-                history_data.append({
-                    "Date": log.get("date", "-"),
-                    "Hours Slept": log.get("hours_slept", "-"),
-                    "Bed Time": log.get("bed_time", "-"),
-                    "Wake Time": log.get("wake_time", "-"),
-                    "Time to Fall Asleep (min)": log.get("time_to_fall_asleep", "-"),
-                    "Wakeups": log.get("woke_up_times", "-"),
-                    "Quality": log.get("quality_rating", "-"),
-                    "Notes": log.get("notes", "")[:60]  # Truncate long notes
-                })
-            df_history = pd.DataFrame(history_data)
-            # Sort by date descending if possible
-            try:
-                df_history["Date"] = pd.to_datetime(df_history["Date"], errors="coerce")
-                df_history = df_history.sort_values("Date", ascending=False)
-                df_history["Date"] = df_history["Date"].dt.strftime("%Y-%m-%d")
-            except Exception:
-                pass
+            df_history = build_history_frame(store)
             # --- Download as CSV button (restyled) ---
             st.markdown("""
                 <style>
@@ -1478,130 +1705,58 @@ else:
             st.dataframe(df_history, use_container_width=True, hide_index=True)
         else:
             st.info("No sleep logs yet. Log your sleep to see your history here!")
+        export_panel(st.session_state.user_uid, user_profile)
 
         # --- Personalized Insights Block 
         st.markdown("<h4 style='color: #C084FC; font-weight: 700; margin-bottom: 1rem;'>Personalized Insights</h4>", unsafe_allow_html=True)
 
-        # Sleep Consistency: average bedtime/wake time difference over last 7 logs
-        if len(logs) > 1:
-            bedtime_diffs = []
-            waketime_diffs = []
-            for i in range(1, min(7, len(logs))):
-                try:
-                    prev_bed = datetime.strptime(logs[i]['bed_time'], "%H:%M")
-                    curr_bed = datetime.strptime(logs[i-1]['bed_time'], "%H:%M")
-                    bedtime_diffs.append(abs((curr_bed - prev_bed).total_seconds() / 60))
-                    prev_wake = datetime.strptime(logs[i]['wake_time'], "%H:%M")
-                    curr_wake = datetime.strptime(logs[i-1]['wake_time'], "%H:%M")
-                    waketime_diffs.append(abs((curr_wake - prev_wake).total_seconds() / 60))
-                except Exception:
-                    continue
-            avg_bedtime_consistency = int(statistics.mean(bedtime_diffs)) if bedtime_diffs else 0
-            avg_waketime_consistency = int(statistics.mean(waketime_diffs)) if waketime_diffs else 0
-        else:
-            avg_bedtime_consistency = 0
-            avg_waketime_consistency = 0
+        # Last-7-day aggregates come from the prefix-sum index (O(1) per window)
+        index = get_prefix_index(st.session_state.user_uid, store, user_profile)
+        week = index.last_days(today, 7)
+
+        # Sleep Consistency: average bedtime/wake time difference over the last 7 days
+        avg_bedtime_consistency = int(week["avg_bedtime_diff"])
+        avg_waketime_consistency = int(week["avg_waketime_diff"])
         st.markdown(f"<b>Sleep Consistency:</b> Your average bedtime difference is <span style='color:#A78BFA'>{avg_bedtime_consistency} min</span> and wake time difference is <span style='color:#A78BFA'>{avg_waketime_consistency} min</span> over the last 7 days.", unsafe_allow_html=True)
 
         # Goal Progress: visualize progress toward primary sleep goal
-        sleep_habits = user_profile.get('sleep_habits', {}) if user_profile else {}
-        goal = sleep_habits.get('sleep_duration_goal', '7-8 hours')
-        goal_ranges = {
-            "<6 hours": (0, 6),
-            "6-7 hours": (6, 7),
-            "7-8 hours": (7, 8),
-            "8+ hours": (8, 24),
-        }
-        min_goal, max_goal = goal_ranges.get(goal, (7, 8))
-        # Calculate % of last 7 logs within goal
-        logs_in_goal = 0
-        for log in logs[:7]:
-            hours = float(log.get("hours_slept", 0))
-            if min_goal <= hours <= max_goal:
-                logs_in_goal += 1
-        percent_in_goal = int((logs_in_goal / min(7, len(logs))) * 100) if logs else 0
-        st.markdown(f"<b>Goal Progress:</b> <span style='color:#A78BFA'>{percent_in_goal}%</span> of your last 7 nights met your sleep duration goal (<b>{goal}</b>).", unsafe_allow_html=True)
+        goal, _ = goal_range(user_profile)
+        percent_in_goal = week["percent_in_goal"]
+        st.markdown(f"<b>Goal Progress:</b> <span style='color:#A78BFA'>{percent_in_goal}%</span> of the nights you logged in the last 7 days met your sleep duration goal (<b>{goal}</b>).", unsafe_allow_html=True)
+
+        # Unusual Nights: flags from the latest log's anomaly check (see sleepaid_anomaly)
+        anomaly_state = user_profile.get('anomaly_state') if user_profile else None
+        latest = store.latest()
+        if is_current(anomaly_state) and anomaly_state["flags"] and latest and anomaly_state["flagged_date"] == latest.date:
+            unusual = " ".join(describe_flag(flag) for flag in anomaly_state["flags"])
+            st.markdown(f"<b>Unusual Night ({latest.date}):</b> {unusual}", unsafe_allow_html=True)
+
+        # Factor Impact: what each environment / mental-state tag does for this user (see sleepaid_factors)
+        notable = factors.notable_effects(factors.factor_effects(load_factor_stats(st.session_state.user_uid, all_logs, user_profile)))
+        if notable:
+            st.markdown("<b>What Helps You:</b> " + " ".join(factors.describe_effect(e) for e in notable), unsafe_allow_html=True)
 
         # AI Insights: summarize trends or recurring issues
         # We'll use a simple rule-based summary for now
-        if logs:
-            last7 = logs[:7]
-            avg_hours = statistics.mean([float(log.get("hours_slept", 0)) for log in last7])
-            avg_latency = statistics.mean([int(log.get("time_to_fall_asleep", 0)) for log in last7])
-            avg_wakeups = statistics.mean([int(log.get("woke_up_times", 0)) for log in last7])
+        if week["nights_logged"]:
+            avg_hours = week["avg_hours"]
+            avg_latency = week["avg_latency"]
+            avg_wakeups = week["avg_wakeups"]
+            # Count feelings by enum code, then translate the winner back to its label
             energy_counts = {}
-            for log in last7:
-                for log_item in last7:
-                    woke_up_feeling = log_item.get("woke_up_feeling", [])
-                    if isinstance(woke_up_feeling, str):
-                        # If it's a string, treat as a single feeling
-                        feelings = [woke_up_feeling]
-                    else:
-                        # Otherwise, assume it's a list
-                        feelings = woke_up_feeling
-                    for feeling in feelings:
-                        energy_counts[feeling] = energy_counts.get(feeling, 0) + 1
-                most_common_energy = max(energy_counts.items(), key=lambda x: x[1])[0] if energy_counts else "N/A"
-                ai_summary = f"You averaged <b>{avg_hours:.1f} hours</b> of sleep, took <b>{avg_latency:.0f} min</b> to fall asleep, and woke up <b>{avg_wakeups:.1f} times</b> per night. Most common morning feeling: <b>{most_common_energy}</b>."
-            else:
-                ai_summary = "Not enough data for insights yet. Log more sleep!"
-            st.markdown(f"<b>AI Insights:</b> {ai_summary}", unsafe_allow_html=True)
+            for log in store.slice(today.toordinal() - 6, today.toordinal()).records:
+                for code in log.feelings:
+                    energy_counts[code] = energy_counts.get(code, 0) + 1
+            most_common_energy = FEELINGS.label(max(energy_counts.items(), key=lambda x: x[1])[0]) if energy_counts else "N/A"
+            ai_summary = f"You averaged <b>{avg_hours:.1f} hours</b> of sleep, took <b>{avg_latency:.0f} min</b> to fall asleep, and woke up <b>{avg_wakeups:.1f} times</b> per night. Most common morning feeling: <b>{most_common_energy}</b>."
+        else:
+            ai_summary = "Not enough data for insights yet. Log more sleep!"
+        st.markdown(f"<b>AI Insights:</b> {ai_summary}", unsafe_allow_html=True)
         st.markdown("</div>", unsafe_allow_html=True)
 
         # --- Streak Badge on Profile ---
         # Calculate current streak and longest streak
-        def calculate_streaks(logs):
-            from datetime import datetime, timedelta
-
-            if not logs:
-                return 0, 0
-
-            # Sort logs by date descending
-            sorted_logs = sorted(logs, key=lambda x: x.get("date", ""), reverse=True)
-            streak = 0
-            longest = 0
-            prev_date = None
-
-            for log in sorted_logs:
-                log_date_str = log.get("date")
-                if not log_date_str:
-                    continue
-                try:
-                    log_date = datetime.strptime(log_date_str, "%Y-%m-%d")
-                except Exception:
-                    continue
-
-                if prev_date is None:
-                    streak = 1
-                else:
-                    if prev_date - log_date == timedelta(days=1):
-                        streak += 1
-                    elif prev_date - log_date > timedelta(days=1):
-                        break  # streak ended
-
-                prev_date = log_date
-
-            # Now, calculate the longest streak
-            longest = 0
-            temp_streak = 1
-            for i in range(1, len(sorted_logs)):
-                try:
-                    d1 = datetime.strptime(sorted_logs[i-1].get("date", ""), "%Y-%m-%d")
-                    d2 = datetime.strptime(sorted_logs[i].get("date", ""), "%Y-%m-%d")
-                except Exception:
-                    continue
-                if (d1 - d2) == timedelta(days=1):
-                    temp_streak += 1
-                else:
-                    if temp_streak > longest:
-                        longest = temp_streak
-                    temp_streak = 1
-            if temp_streak > longest:
-                longest = temp_streak
-
-            return streak, longest
-
-        current_streak, longest_streak = calculate_streaks(logs)
+        current_streak, longest_streak = calculate_streaks(logs, user_today(user_profile))
         streak_emoji = '🔥' if current_streak >= 3 else '🌙'
         streak_badge_html = f"""
         <div style='text-align:center; margin-bottom:1rem;'>
@@ -1754,13 +1909,13 @@ else:
             # New multiselect for wake-up feeling
             woke_up_feeling = st.multiselect(
                 "How did you feel when you woke up?",
-                ["😴 Exhausted", "😐 Meh", "🙂 Refreshed", "💪 Energized"]
+                FEELING_OPTIONS
             )
             
             # Simplified wake-up question - always visible
             wakeup_count_str = st.selectbox(
                 "How many times did you wake up last night?",
-                ["0 (I didn't wake up)", "1 time", "2 times", "3+ times"]
+                WAKEUP_OPTIONS
             )
             
             quality_rating = st.selectbox(
@@ -1771,12 +1926,12 @@ else:
 
             sleep_environment = st.multiselect(
                 "Describe your sleep environment (optional)",
-                ["Room was cool", "Dark", "Quiet", "No screens", "No caffeine"]
+                ENVIRONMENT_OPTIONS
             )
 
             mental_state = st.multiselect(
                 "Mental state before bed",
-                ["Relaxed", "Neutral", "Stressed"]
+                MENTAL_STATE_OPTIONS
             )
 
             # Notes text input
@@ -1784,66 +1939,68 @@ else:
             submitted = st.form_submit_button("Submit Sleep Log")
 
         if submitted:
-            errors = []
-            try:
-                hours_val = float(hours_slept)
-                if hours_val <= 0 or hours_val > 24:
-                    errors.append("Hours slept must be between 0 and 24.")
-            except Exception:
-                errors.append("Please enter a valid number for hours slept.")
-            if time_in_bed < hours_val or time_in_bed > 24:
-                errors.append("Time in bed must be at least as much as hours slept and no more than 24.")
-            if time_to_fall_asleep < 0 or time_to_fall_asleep > 180:
-                errors.append("Time to fall asleep must be between 0 and 180 minutes.")
-            if not bed_time:
-                errors.append("Bed time is required.")
-            if not wake_time:
-                errors.append("Wake time is required.")
+            errors = validate_log_fields(hours_slept, time_in_bed, time_to_fall_asleep, bed_time, wake_time)
             if errors:
                 for err in errors:
                     st.error(err)
                 st.stop()
-            wakeup_count = 0
-            if "3+" in wakeup_count_str:
-                wakeup_count = 3
-            elif "2" in wakeup_count_str:
-                wakeup_count = 2
-            elif "1" in wakeup_count_str:
-                wakeup_count = 1
-            
-            woke_up_night = wakeup_count > 0
+            log = build_log(user_today(user_profile), hours_slept, time_in_bed, time_to_fall_asleep, bed_time, wake_time,
+                            woke_up_feeling, wakeup_count_from_option(wakeup_count_str), quality_rating,
+                            sleep_environment, mental_state, notes)
+            if save_user_log(st.session_state.user_uid, log, user_profile):
+                st.toast("✅ Sleep logged successfully!")
+                set_page("dashboard")
 
-            # Ensure time inputs are not None before formatting
-            bed_time_str = bed_time.strftime("%H:%M") if bed_time else "23:00"
-            wake_time_str = wake_time.strftime("%H:%M") if wake_time else "07:00"
-            
-            # Calculate Sleep Efficiency
-            bed_datetime = datetime.strptime(bed_time_str, "%H:%M")
-            wake_datetime = datetime.strptime(wake_time_str, "%H:%M")
-            if wake_datetime <= bed_datetime:
-                wake_datetime += timedelta(days=1)
-            time_in_bed_minutes = (wake_datetime - bed_datetime).total_seconds() / 60
-            sleep_efficiency = (float(hours_slept) * 60 / time_in_bed_minutes) * 100 if time_in_bed_minutes > 0 else 0
-
-            log = {
-                "date": str(datetime.now().date()),
-                "hours_slept": float(hours_slept),
-                "time_in_bed": time_in_bed,
-                "time_to_fall_asleep": time_to_fall_asleep,
-                "bed_time": bed_time_str,
-                "wake_time": wake_time_str,
-                "sleep_efficiency": sleep_efficiency,
-                "woke_up_feeling": woke_up_feeling,
-                "woke_up_night": woke_up_night,
-                "woke_up_times": wakeup_count,
-                "quality_rating": quality_rating,
-                "sleep_environment": sleep_environment,
-                "mental_state": mental_state,
-                "notes": notes
-             }
-            if save_user_log(st.session_state.user_uid, log):
-                st.success("✅ Sleep logged successfully!")
+        if st.button("📅 Missed some days? Fill them in", use_container_width=True):
+            set_page("backfill")
+
+    # --- Backfill Page: edit or add several days at once ---
+    elif page == "backfill":
+        st.markdown("<h1 style='text-align: center;'>Fill In Missed Days</h1>", unsafe_allow_html=True)
+        st.caption("Edit any day's row or fill in the days you missed, then save them all at once.")
+        today = user_today(user_profile)
+        days = st.selectbox("Days to show", BACKFILL_WINDOWS, index=1, format_func=lambda d: f"Last {d} days")
+        store = get_log_store(st.session_state.user_uid)
+        original = backfill_frame(store, today, days)
+        feeling_options = FEELING_OPTIONS + sorted({f for fs in original["woke_up_feeling"] for f in fs} - set(FEELING_OPTIONS))
+        edited = st.data_editor(
+            original,
+            key=f"backfill_editor_{days}",
+            num_rows="fixed",
+            hide_index=True,
+            use_container_width=True,
+            column_config={
+                "date": st.column_config.DateColumn("Date", disabled=True, format="ddd MMM D"),
+                "logged": st.column_config.CheckboxColumn("Logged", disabled=True),
+                "hours_slept": st.column_config.NumberColumn("Hours slept", min_value=0.5, max_value=24.0, step=0.5),
+                "time_in_bed": st.column_config.NumberColumn("Time in bed (h)", min_value=0.0, max_value=24.0, step=0.5),
+                "time_to_fall_asleep": st.column_config.NumberColumn("Fall asleep (min)", min_value=0, max_value=180, step=5),
+                "bed_time": st.column_config.TimeColumn("Bed time", format="HH:mm", step=300),
+                "wake_time": st.column_config.TimeColumn("Wake time", format="HH:mm", step=300),
+                "woke_up_feeling": st.column_config.MultiselectColumn("Felt", options=feeling_options),
+                "wakeups": st.column_config.SelectboxColumn("Wakeups", options=WAKEUP_OPTIONS),
+                "quality_rating": st.column_config.NumberColumn("Quality (1-10)", min_value=1, max_value=10, step=1),
+                "sleep_environment": st.column_config.MultiselectColumn("Environment", options=ENVIRONMENT_OPTIONS),
+                "mental_state": st.column_config.MultiselectColumn("Mental state", options=MENTAL_STATE_OPTIONS),
+                "notes": st.column_config.TextColumn("Notes"),
+            },
+        )
+        col_back, col_save = st.columns(2)
+        with col_back:
+            if st.button("← Back", use_container_width=True):
+                set_page("log")
+        with col_save:
+            save_clicked = st.button("💾 Save changes", use_container_width=True)
+        if save_clicked:
+            logs, errors = backfill_logs(original, edited)
+            if errors:
+                for day, err in errors:
+                    st.error(f"{day.strftime('%a %b %d')}: {err}")
+                st.stop()
+            if not logs:
+                st.info("No changes to save.")
+                st.stop()
+            if save_user_logs(st.session_state.user_uid, logs, user_profile):
+                st.toast(f"✅ Saved {len(logs)} day{'s' if len(logs) != 1 else ''} of sleep logs!")
                 set_page("dashboard")
-                time.sleep(0.2)  # Give Firestore a moment to write
-                st.rerun()
 
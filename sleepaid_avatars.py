@@ -0,0 +1,129 @@
+"""
+Avatar processing.
+
+Uploads are decoded once, squared, resized to a few fixed thumbnail sizes and
+re-encoded as WebP, then written atomically under static/avatars/ with the
+content hash in the file name. Pages reference them through Streamlit's static
+file serving (app/static/...), so the browser caches them and the page payload
+no longer carries a base64 copy of whatever resolution the camera produced.
+"""
+from io import BytesIO
+import glob
+import hashlib
+import json
+import os
+import tempfile
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+_this_dir = os.path.dirname(os.path.abspath(__file__))
+STATIC_AVATAR_DIR = os.path.join(_this_dir, "static", "avatars")
+STATIC_AVATAR_URL = "app/static/avatars"
+# Where avatars were written before this pipeline existed (raw uploads named {uid}.png)
+LEGACY_AVATAR_DIR = os.path.join(_this_dir, "data", "avatars")
+
+AVATAR_SIZES = (64, 100, 256)
+WEBP_QUALITY = 82
+
+os.makedirs(STATIC_AVATAR_DIR, exist_ok=True)
+
+
+def _atomic_write(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _manifest_path(uid):
+    return os.path.join(STATIC_AVATAR_DIR, f"{uid}.json")
+
+def _thumbnail_name(uid, size, content_hash):
+    return f"{uid}_{size}_{content_hash}.webp"
+
+def _square(image):
+    """Center-crop to a square so thumbnails aren't distorted."""
+    width, height = image.size
+    side = min(width, height)
+    left = (width - side) // 2
+    top = (height - side) // 2
+    return image.crop((left, top, left + side, top + side))
+
+
+def process_avatar(uid, data):
+    """
+    Decode an uploaded image and store its thumbnails. Returns the content hash.
+    Raises ValueError if the upload isn't a readable image.
+    """
+    try:
+        image = Image.open(BytesIO(data))
+        image = ImageOps.exif_transpose(image)  # phone photos carry their rotation in EXIF
+        image.load()
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise ValueError(f"Could not read the image: {e}")
+    image = _square(image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB"))
+    content_hash = hashlib.sha256(data).hexdigest()[:12]
+
+    for size in AVATAR_SIZES:
+        thumb = image.resize((size, size), Image.LANCZOS)
+        buffer = BytesIO()
+        thumb.save(buffer, format="WEBP", quality=WEBP_QUALITY, method=6)
+        _atomic_write(os.path.join(STATIC_AVATAR_DIR, _thumbnail_name(uid, size, content_hash)), buffer.getvalue())
+    # The manifest flips to the new hash only after every thumbnail exists
+    _atomic_write(_manifest_path(uid), json.dumps({"hash": content_hash, "sizes": list(AVATAR_SIZES)}).encode())
+    _remove_thumbnails(uid, keep_hash=content_hash)
+    return content_hash
+
+def _remove_thumbnails(uid, keep_hash=None):
+    for path in glob.glob(os.path.join(STATIC_AVATAR_DIR, f"{glob.escape(uid)}_*.webp")):
+        if keep_hash is None or not path.endswith(f"_{keep_hash}.webp"):
+            os.remove(path)
+
+def _migrate_legacy_avatar(uid):
+    legacy_path = os.path.join(LEGACY_AVATAR_DIR, f"{uid}.png")
+    if not os.path.exists(legacy_path):
+        return None
+    with open(legacy_path, "rb") as f:
+        data = f.read()
+    try:
+        content_hash = process_avatar(uid, data)
+    except ValueError:
+        return None
+    os.remove(legacy_path)
+    return content_hash
+
+def avatar_hash(uid):
+    """Content hash of the user's current avatar, or None if they don't have one."""
+    try:
+        with open(_manifest_path(uid), "r") as f:
+            return json.load(f).get("hash")
+    except FileNotFoundError:
+        return _migrate_legacy_avatar(uid)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+def avatar_url(uid, size, content_hash=None):
+    """Static URL for one thumbnail size, or None if the user has no avatar."""
+    content_hash = content_hash or avatar_hash(uid)
+    if not content_hash:
+        return None
+    return f"{STATIC_AVATAR_URL}/{_thumbnail_name(uid, size, content_hash)}"
+
+def avatar_path(uid, size, content_hash=None):
+    """File path of one thumbnail size, or None if the user has no avatar."""
+    content_hash = content_hash or avatar_hash(uid)
+    if not content_hash:
+        return None
+    return os.path.join(STATIC_AVATAR_DIR, _thumbnail_name(uid, size, content_hash))
+
+def remove_avatar(uid):
+    manifest = _manifest_path(uid)
+    if os.path.exists(manifest):
+        os.remove(manifest)
+    _remove_thumbnails(uid)
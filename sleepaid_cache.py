@@ -0,0 +1,263 @@
+"""
+Shared cache tier.
+
+`session_state` only lives inside one Streamlit process, so with several
+replicas behind a load balancer each one re-read and recomputed everything.
+This module puts the expensive pieces (a user's log list, rollups, score
+arrays, GPT suggestions) behind a small get/set/delete/incr interface with two
+backends:
+
+- `DiskCache`: JSON files under data/cache, for a single host (replicas on one
+  machine, or local development), swept periodically for expired entries.
+- `RedisCache`: any Redis-protocol server. Takes a client object, so tests can
+  pass a local stand-in (fakeredis, or anything with get/set/delete/incr).
+
+Keys are versioned (`sleepaid:v{CACHE_VERSION}:...`) so a deploy that changes a
+value's shape never reads the old one, and every entry has a TTL. Per-user data
+also carries a generation number that is bumped whenever the user writes, so
+replicas never serve a log list or scores from before the latest save.
+
+Pick the backend with SLEEPAID_CACHE_URL: "redis://host:6379/0", a directory
+path, "disk" (the default) or "none".
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import redis
+except ImportError:  # Only needed for the Redis backend
+    redis = None
+
+_this_dir = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CACHE_DIR = os.path.join(_this_dir, "data", "cache")
+CACHE_VERSION = 1
+SWEEP_INTERVAL = 300     # seconds between DiskCache expiry sweeps (per process)
+DISK_CACHE_MAX_BYTES = int(float(os.getenv("SLEEPAID_CACHE_MAX_MB", "512")) * 1024 * 1024)
+
+# Seconds each kind of entry may be served for
+TTLS = {
+    "logs": 3600,
+    "rollup": 6 * 3600,
+    "scores": 3600,
+    "factors": 3600,
+    "suggestion": 24 * 3600,
+    "template": 7 * 86400,
+    "template_stats": 30 * 86400,
+    "gen": 30 * 86400,
+}
+
+
+def make_key(namespace, uid, *parts):
+    return ":".join(["sleepaid", f"v{CACHE_VERSION}", namespace, uid] + [str(p) for p in parts])
+
+def digest(value):
+    """Short stable hash of a JSON-serializable value, for folding inputs into a key."""
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+class NullCache:
+    """Caching disabled: every get misses."""
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def incr(self, key, ttl):
+        return 0
+
+
+class DiskCache:
+    """
+    One JSON file per key, written atomically, with the file's mtime set to its
+    expiry time. Expired entries are dropped on read, and since keys carry a
+    generation, date or digest most are never read again: every SWEEP_INTERVAL a
+    background sweep deletes expired files (found from mtimes alone) and, if the
+    directory is still over max_bytes, the entries expiring soonest.
+    """
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DISK_CACHE_MAX_BYTES, sweep_interval=SWEEP_INTERVAL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._sweep_lock = threading.Lock()
+        self._next_sweep = time.monotonic() + sweep_interval
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if entry["expires_at"] < time.time():
+            self.delete(key)
+            return None
+        return entry["value"]
+
+    def set(self, key, value, ttl):
+        expires_at = time.time() + ttl
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"expires_at": expires_at, "value": value}, f)
+            os.utime(tmp_path, (expires_at, expires_at))
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._maybe_sweep()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def incr(self, key, ttl):
+        with self._lock:
+            value = (self.get(key) or 0) + 1
+            self.set(key, value, ttl)
+            return value
+
+    def _maybe_sweep(self):
+        if time.monotonic() < self._next_sweep or not self._sweep_lock.acquire(blocking=False):
+            return
+        self._next_sweep = time.monotonic() + self.sweep_interval
+        def run():
+            try:
+                self.sweep()
+            except OSError as e:
+                print(f"Cache sweep of {self.directory} failed: {e}")
+            finally:
+                self._sweep_lock.release()
+        threading.Thread(target=run, name="sleepaid-cache-sweep", daemon=True).start()
+
+    def sweep(self):
+        """Delete expired entries (and stale temp files), then the soonest-expiring ones while over max_bytes."""
+        now = time.time()
+        live, total, removed = [], 0, 0
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+                # Temp files get their mtime only just before the rename; an hour-old one was abandoned
+                stale = stat.st_mtime < now - (3600 if entry.name.startswith(".tmp-") else 0)
+                if stale:
+                    os.remove(entry.path)
+                    removed += 1
+                elif not entry.name.startswith(".tmp-"):
+                    live.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+            except FileNotFoundError:
+                continue
+        if total > self.max_bytes:
+            live.sort()
+            for _, size, path in live:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+                total -= size
+        return removed
+
+
+class RedisCache:
+    """Values stored as JSON strings with SET ... EX ttl."""
+    def __init__(self, client):
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url):
+        if redis is None:
+            raise ImportError("The redis package is required for a redis:// cache URL (pip install redis)")
+        return cls(redis.Redis.from_url(url))
+
+    def get(self, key):
+        raw = self.client.get(key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(key, json.dumps(value), ex=int(ttl))
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def incr(self, key, ttl):
+        value = self.client.incr(key)
+        self.client.expire(key, int(ttl))
+        return int(value)
+
+
+def cache_from_url(url):
+    if not url or url == "disk":
+        return DiskCache()
+    if url == "none":
+        return NullCache()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisCache.from_url(url)
+    return DiskCache(url)
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """The process's cache backend, from SLEEPAID_CACHE_URL."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = cache_from_url(os.getenv("SLEEPAID_CACHE_URL", "disk"))
+    return _cache
+
+
+# --- Per-user helpers ---
+def user_generation(cache, uid):
+    """Bumped on every write by the user; part of the key of anything derived from their logs."""
+    try:
+        return cache.get(make_key("gen", uid)) or 0
+    except Exception as e:
+        print(f"Cache read failed for {uid}'s generation: {e}")
+        return 0
+
+def bump_generation(cache, uid):
+    try:
+        return cache.incr(make_key("gen", uid), TTLS["gen"])
+    except Exception as e:
+        print(f"Cache write failed for {uid}'s generation: {e}")
+        return None
+
+def cached(cache, namespace, uid, parts, compute):
+    """
+    Return the cached value for (namespace, uid, *parts), computing and storing it on a miss.
+    Cache errors never break the page: they fall through to `compute`.
+    """
+    key = make_key(namespace, uid, *parts)
+    try:
+        value = cache.get(key)
+    except Exception as e:
+        print(f"Cache read failed for {key}: {e}")
+        value = None
+    if value is not None:
+        return value
+    value = compute()
+    if value is not None:
+        try:
+            cache.set(key, value, TTLS[namespace])
+        except Exception as e:
+            print(f"Cache write failed for {key}: {e}")
+    return value
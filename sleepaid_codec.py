@@ -0,0 +1,168 @@
+"""
+Compact storage encoding for sleep log documents (schema version 2): short field
+names, code tables and a bitmask for the option labels, times as minutes since
+midnight, and no empty fields or derived efficiency. `record_from_document`
+decodes either version into a LogRecord, `decode_log` into the form-shaped dict.
+The code tables below are a storage format: only ever append to them.
+"""
+from sleepaid_records import (
+    ENVIRONMENT,
+    FEELINGS,
+    INVALID_TIME,
+    MENTAL_STATES,
+    LogRecord,
+    _to_float,
+    _to_int,
+    _time_field,
+    format_hhmm,
+    has_valid_time,
+    parse_date_ordinal,
+)
+
+SCHEMA_VERSION = 2
+
+# Append-only storage code tables
+FEELING_CODES = ("😴 Exhausted", "😐 Meh", "🙂 Refreshed", "💪 Energized", "😐 Okay", "Motivated")
+ENVIRONMENT_CODES = ("Room was cool", "Dark", "Quiet", "No screens", "No caffeine")
+MENTAL_STATE_CODES = ("Relaxed", "Neutral", "Stressed")
+
+_FEELING_INDEX = {label: i for i, label in enumerate(FEELING_CODES)}
+_ENVIRONMENT_INDEX = {label: i for i, label in enumerate(ENVIRONMENT_CODES)}
+_MENTAL_STATE_INDEX = {label: i for i, label in enumerate(MENTAL_STATE_CODES)}
+
+
+def schema_version(doc):
+    return doc.get("v", 1) if isinstance(doc, dict) else 1
+
+def _options(value):
+    """Multiselect values are lists; some older logs store a bare string."""
+    if not value:
+        return []
+    return [value] if isinstance(value, str) else list(value)
+
+def _encode_options(labels, index):
+    return [index.get(label, label) for label in _options(labels)]
+
+def _decode_options(codes, table):
+    return [table[code] if isinstance(code, int) and 0 <= code < len(table) else str(code) for code in codes]
+
+def efficiency(hours_slept, bed_minutes, wake_minutes):
+    """Sleep efficiency as the log form works it out, or None without both times."""
+    if not has_valid_time(bed_minutes) or not has_valid_time(wake_minutes):
+        return None
+    in_bed = wake_minutes - bed_minutes
+    if in_bed <= 0:
+        in_bed += 24 * 60
+    return hours_slept * 60 / in_bed * 100
+
+
+def encode_log(log):
+    """A log dict (the form's shape, or already version 2) as a version 2 document."""
+    if schema_version(log) == SCHEMA_VERSION:
+        return log
+    doc = {"v": SCHEMA_VERSION, "date": log.get("date", ""), "h": _to_float(log.get("hours_slept"), 0.0)}
+    time_in_bed = _to_float(log.get("time_in_bed"))
+    if time_in_bed is not None:
+        doc["tib"] = time_in_bed
+    latency = _to_int(log.get("time_to_fall_asleep"))
+    if latency is not None:
+        doc["lat"] = latency
+    bed, wake = _time_field(log, "bed_time"), _time_field(log, "wake_time")
+    for key, field, minutes in (("bed", "bed_time", bed), ("wake", "wake_time", wake)):
+        if minutes == INVALID_TIME:
+            doc[key] = str(log[field])  # kept as-is; still reads back as invalid
+        elif minutes is not None:
+            doc[key] = minutes
+    stored_efficiency = _to_float(log.get("sleep_efficiency"))
+    if stored_efficiency is not None and efficiency(doc["h"], bed, wake) is None:
+        doc["eff"] = stored_efficiency
+    wakes = _to_int(log.get("woke_up_times"), 0)
+    if wakes:
+        doc["wakes"] = wakes
+    woke_up_night = log.get("woke_up_night")
+    if woke_up_night is not None and bool(woke_up_night) != (wakes > 0):
+        doc["wn"] = woke_up_night
+    quality = log.get("quality_rating")
+    if quality is not None:
+        doc["q"] = _to_int(quality, quality)
+    mask, other = 0, []
+    for label in _options(log.get("sleep_environment")):
+        if label in _ENVIRONMENT_INDEX:
+            mask |= 1 << _ENVIRONMENT_INDEX[label]
+        else:
+            other.append(label)
+    # Empty and zero fields are left out; decoding supplies them
+    optional = {
+        "feel": _encode_options(log.get("woke_up_feeling"), _FEELING_INDEX),
+        "env": mask,
+        "env_other": other,
+        "mind": _encode_options(log.get("mental_state"), _MENTAL_STATE_INDEX),
+        "notes": log.get("notes"),
+    }
+    doc.update({key: value for key, value in optional.items() if value})
+    return doc
+
+def _doc_time(doc, key):
+    value = doc.get(key)
+    if value is None:
+        return None
+    return value if isinstance(value, int) and 0 <= value < 24 * 60 else INVALID_TIME
+
+def _environment_labels(doc):
+    mask = doc.get("env", 0)
+    labels = [label for i, label in enumerate(ENVIRONMENT_CODES) if mask >> i & 1]
+    return labels + list(doc.get("env_other", []))
+
+def decode_log(doc):
+    """Any stored log document as the form-shaped dict (version 1 documents are only normalised)."""
+    if schema_version(doc) != SCHEMA_VERSION:
+        log = dict(doc)
+        for field in ("woke_up_feeling", "sleep_environment", "mental_state"):
+            if field in log:
+                log[field] = _options(log[field])
+        return log
+    log = {"date": doc.get("date", ""), "hours_slept": doc.get("h", 0.0)}
+    if "tib" in doc:
+        log["time_in_bed"] = doc["tib"]
+    if "lat" in doc:
+        log["time_to_fall_asleep"] = doc["lat"]
+    bed, wake = _doc_time(doc, "bed"), _doc_time(doc, "wake")
+    for field, key, minutes in (("bed_time", "bed", bed), ("wake_time", "wake", wake)):
+        if minutes is not None:
+            log[field] = format_hhmm(minutes) if has_valid_time(minutes) else doc[key]
+    eff = doc.get("eff", efficiency(log["hours_slept"], bed, wake))
+    if eff is not None:
+        log["sleep_efficiency"] = eff
+    log["woke_up_feeling"] = _decode_options(doc.get("feel", []), FEELING_CODES)
+    log["woke_up_night"] = doc.get("wn", doc.get("wakes", 0) > 0)
+    log["woke_up_times"] = doc.get("wakes", 0)
+    if "q" in doc:
+        log["quality_rating"] = doc["q"]
+    log["sleep_environment"] = _environment_labels(doc)
+    log["mental_state"] = _decode_options(doc.get("mind", []), MENTAL_STATE_CODES)
+    log["notes"] = doc.get("notes", "")
+    return log
+
+def record_from_document(doc):
+    """A stored log document of either version as a LogRecord; version 2 skips all string parsing."""
+    if schema_version(doc) != SCHEMA_VERSION:
+        return LogRecord.from_dict(doc)
+    record = LogRecord.__new__(LogRecord)
+    record.ordinal = parse_date_ordinal(doc.get("date", ""))
+    record.hours_slept = doc.get("h", 0.0)
+    record.time_in_bed = doc.get("tib")
+    record.time_to_fall_asleep = doc.get("lat")
+    record.bed_minutes = _doc_time(doc, "bed")
+    record.wake_minutes = _doc_time(doc, "wake")
+    record.sleep_efficiency = doc.get("eff", efficiency(record.hours_slept, record.bed_minutes, record.wake_minutes))
+    record.feelings = FEELINGS.codes_for(_decode_options(doc.get("feel", []), FEELING_CODES))
+    record.woke_up_times = doc.get("wakes", 0)
+    record.woke_up_night = doc.get("wn", record.woke_up_times > 0)
+    record.quality_rating = doc.get("q")
+    mask = 0
+    for code in ENVIRONMENT.codes_for(_environment_labels(doc)):
+        mask |= 1 << code
+    record.environment = mask
+    record.mental_state = MENTAL_STATES.codes_for(_decode_options(doc.get("mind", []), MENTAL_STATE_CODES))
+    record.notes = doc.get("notes", "")
+    return record
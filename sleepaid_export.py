@@ -0,0 +1,194 @@
+"""
+Full-account archive export.
+
+`start_export` builds a zip on a small background pool, so the page that asked
+for it keeps rendering. The zip holds:
+
+    logs.jsonl      every sleep log, one decoded (form-shaped) log per line
+    profile.json    the user's profile
+    usage.json      usage counters
+    avatar.webp     the largest avatar thumbnail, if the user has one
+    manifest.json   when it was made and what it holds
+
+Logs are read from Firestore a page at a time and streamed into the zip entry
+as they arrive, so memory stays constant however long the history is. The
+archive is written to a temporary name and renamed into data/exports/{token}/
+when complete. It is never served as a static file: the session that started
+the export downloads it through st.download_button, and it is deleted when that
+user logs out or EXPORT_TTL after it was started, whichever comes first.
+
+The job registry and the archive live in the process that built them, so with
+several replicas behind a load balancer the deployment needs sticky sessions
+(which Streamlit's websocket sessions already require).
+"""
+import json
+import os
+import secrets
+import shutil
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from sleepaid_avatars import AVATAR_SIZES, avatar_path
+from sleepaid_codec import decode_log
+
+_this_dir = os.path.dirname(os.path.abspath(__file__))
+EXPORT_DIR = os.getenv("SLEEPAID_EXPORT_DIR", os.path.join(_this_dir, "data", "exports"))
+PAGE_SIZE = 500          # log documents per Firestore read
+EXPORT_TTL = 3600        # seconds an archive stays downloadable
+MAX_CONCURRENT_EXPORTS = 2
+
+
+class ExportJob:
+    def __init__(self, uid):
+        self.uid = uid
+        self.token = secrets.token_urlsafe(24)
+        self.filename = f"sleepaid-export-{datetime.now().strftime('%Y-%m-%d')}.zip"
+        self.started_at = time.time()
+        self.status = "running"   # then "done" or "failed"
+        self.logs_written = 0
+        self.error = None
+
+    @property
+    def path(self):
+        return os.path.join(EXPORT_DIR, self.token, self.filename)
+
+    @property
+    def expired(self):
+        return time.time() - self.started_at > EXPORT_TTL
+
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    with _jobs_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_EXPORTS, thread_name_prefix="sleepaid-export")
+        return _executor
+
+def iter_log_pages(db, uid, page_size=PAGE_SIZE):
+    """Yield lists of the user's log snapshots, oldest first (log documents are keyed by date)."""
+    collection = db.collection('users').document(uid).collection('sleep_logs')
+    cursor = None
+    while True:
+        query = collection.order_by('__name__').limit(page_size)
+        if cursor is not None:
+            query = query.start_after(cursor)
+        page = list(query.stream())
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        cursor = page[-1]
+
+def _json_bytes(value):
+    # default=str covers Firestore timestamps
+    return json.dumps(value, indent=2, sort_keys=True, default=str, ensure_ascii=False).encode("utf-8")
+
+
+def write_archive(db, job, profile, pending_logs):
+    """Write the archive for `job`. `pending_logs` are queued writes ({date: doc}) not yet in Firestore."""
+    os.makedirs(os.path.dirname(job.path), exist_ok=True)
+    tmp_path = job.path + ".part"
+    pending_logs = dict(pending_logs or {})
+    try:
+        with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            with archive.open("logs.jsonl", "w", force_zip64=True) as logs:
+                def write_log(doc):
+                    line = json.dumps(decode_log(doc), sort_keys=True, default=str, ensure_ascii=False)
+                    logs.write(line.encode("utf-8") + b"\n")
+                    job.logs_written += 1
+                if db is not None:
+                    for page in iter_log_pages(db, job.uid):
+                        for snapshot in page:
+                            # A queued save for the same day is newer than what Firestore has
+                            write_log(pending_logs.pop(snapshot.id, None) or snapshot.to_dict() or {})
+                for date in sorted(pending_logs):
+                    write_log(pending_logs[date])
+            archive.writestr("profile.json", _json_bytes(profile or {}))
+            usage = {}
+            if db is not None:
+                usage = db.collection('user_usage').document(job.uid).get().to_dict() or {}
+            archive.writestr("usage.json", _json_bytes(usage))
+            files = ["logs.jsonl", "profile.json", "usage.json"]
+            avatar = avatar_path(job.uid, max(AVATAR_SIZES))
+            if avatar and os.path.exists(avatar):
+                archive.write(avatar, "avatar.webp")
+                files.append("avatar.webp")
+            archive.writestr("manifest.json", _json_bytes({
+                "exported_at": datetime.now().isoformat(),
+                "logs": job.logs_written,
+                "files": files,
+            }))
+        os.replace(tmp_path, job.path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _run(db, job, profile, pending_logs):
+    try:
+        write_archive(db, job, profile, pending_logs)
+        job.status = "done"
+        # Don't wait for the next export to come along to delete it
+        timer = threading.Timer(max(0.0, job.started_at + EXPORT_TTL - time.time()), discard_export, (job.token,))
+        timer.daemon = True
+        timer.start()
+    except Exception as e:
+        print(f"Error exporting account {job.uid}: {e}")
+        job.error = str(e)
+        job.status = "failed"
+
+
+def prune_exports():
+    """Forget expired jobs and delete their archives (and any leftover export directories past the TTL)."""
+    with _jobs_lock:
+        for token in [t for t, job in _jobs.items() if job.expired and job.status != "running"]:
+            del _jobs[token]
+        live = set(_jobs)
+    if not os.path.isdir(EXPORT_DIR):
+        return
+    for token in os.listdir(EXPORT_DIR):
+        path = os.path.join(EXPORT_DIR, token)
+        try:
+            if token not in live and time.time() - os.path.getmtime(path) > EXPORT_TTL:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+
+def start_export(db, uid, profile, pending_logs=None):
+    """Queue an archive build for `uid`, or return the one already running for them."""
+    prune_exports()
+    with _jobs_lock:
+        for job in _jobs.values():
+            if job.uid == uid and job.status == "running":
+                return job
+        job = ExportJob(uid)
+        _jobs[job.token] = job
+    _get_executor().submit(_run, db, job, profile, pending_logs)
+    return job
+
+def get_job(token):
+    with _jobs_lock:
+        return _jobs.get(token)
+
+def read_archive(job):
+    """The finished archive's bytes, for the owning session's download button."""
+    with open(job.path, "rb") as f:
+        return f.read()
+
+def discard_export(token):
+    """Forget a job and delete its archive (on logout, or once it expires). A running job is left to finish."""
+    with _jobs_lock:
+        job = _jobs.get(token)
+        if job is None or job.status == "running":
+            return
+        del _jobs[token]
+    shutil.rmtree(os.path.join(EXPORT_DIR, token), ignore_errors=True)
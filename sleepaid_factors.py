@@ -0,0 +1,159 @@
+"""
+Factor-impact analysis for the log form's environment and mental-state tags.
+
+Each log becomes a one-hot row (intercept, one column per environment tag, and
+mental-state dummies against Neutral as the reference) and the effect of every
+tag on score, hours slept and latency comes from a ridge-regularised
+least-squares fit. Mental state is one categorical variable, so a column for
+every state next to the intercept would be exactly collinear; instead
+"Relaxed" and "Stressed" are contrasts with neutral nights, and nights with no
+mental state recorded get a column of their own that isn't reported. The fit only needs
+the sufficient statistics X'X and X'y per target, so those are what's kept (in
+the profile as `factor_stats`): a new log adds its row's outer product, a
+re-logged day subtracts the old row first, and nothing rescans history. The
+first build (or a rebuild after the scoring inputs change) is one vectorized
+pass over the LogStore columns.
+"""
+import numpy as np
+
+from sleepaid_records import ENVIRONMENT, MENTAL_STATES
+from sleepaid_scoring import calculate_sleep_score, score_columns, scoring_fingerprint
+from sleepaid_store import LogColumns
+
+STATS_VERSION = 2
+RIDGE = 1.0          # shrinks effects of rarely used tags towards zero
+MIN_NIGHTS = 5       # nights needed both with and without a tag before it's reported
+
+ENVIRONMENT_FACTORS = ("Room was cool", "Dark", "Quiet", "No screens", "No caffeine")
+MENTAL_REFERENCE = "Neutral"
+MENTAL_FACTORS = ("Relaxed", "Stressed")   # effects are relative to MENTAL_REFERENCE
+FACTORS = ([("environment", label) for label in ENVIRONMENT_FACTORS] + [("mental_state", label) for label in MENTAL_FACTORS]
+           + [("unrecorded", "No mental state")])
+TARGETS = ("score", "hours", "latency")
+# Smallest effect worth telling the user about, per target
+MIN_EFFECT = {"score": 2.0, "hours": 0.25, "latency": 3.0}
+
+_ENVIRONMENT_CODES = np.array([ENVIRONMENT.code(label) for label in ENVIRONMENT_FACTORS], dtype=np.uint32)
+_MENTAL_CODES = np.array([MENTAL_STATES.code(label) for label in MENTAL_FACTORS], dtype=np.int16)
+
+
+def fingerprint(user_profile):
+    """Changes whenever the scoring inputs do, so stored score statistics can be recognised as stale."""
+    return scoring_fingerprint(user_profile)
+
+def design_matrix(cols):
+    """(n, 1 + len(FACTORS)) one-hot rows for LogColumns. Mental state uses the first one picked."""
+    environment = (cols.environment[:, None] >> _ENVIRONMENT_CODES[None, :]) & 1
+    mental = cols.mental_code[:, None] == _MENTAL_CODES[None, :]
+    unrecorded = cols.mental_code[:, None] < 0
+    return np.hstack([np.ones((len(cols), 1)), environment, mental, unrecorded]).astype(np.float64)
+
+def target_values(cols, scores):
+    """{target: values}, NaN where the log didn't record it."""
+    return {
+        "score": np.asarray(scores, dtype=np.float64),
+        "hours": cols.hours_slept.astype(np.float64),
+        "latency": cols.time_to_fall_asleep.astype(np.float64),
+    }
+
+def _accumulate(X, targets, sign=1.0):
+    """{target: (X'X, X'y)} over the rows where the target is present."""
+    sums = {}
+    for name, y in targets.items():
+        present = ~np.isnan(y)
+        Xp = X[present]
+        sums[name] = (sign * Xp.T @ Xp, sign * Xp.T @ y[present])
+    return sums
+
+def empty_stats(user_profile):
+    k = 1 + len(FACTORS)
+    return {
+        "version": STATS_VERSION,
+        "fingerprint": fingerprint(user_profile),
+        "factors": [label for _, label in FACTORS],
+        # Flattened: Firestore can't store arrays of arrays
+        "targets": {name: {"xtx": [0.0] * (k * k), "xty": [0.0] * k} for name in TARGETS},
+    }
+
+def is_current(stats, user_profile):
+    return (isinstance(stats, dict) and stats.get("version") == STATS_VERSION
+            and stats.get("factors") == [label for _, label in FACTORS]
+            and stats.get("fingerprint") == fingerprint(user_profile))
+
+def _add(stats, sums):
+    k = 1 + len(FACTORS)
+    stats = dict(stats, targets=dict(stats["targets"]))
+    for name, (xtx, xty) in sums.items():
+        current = stats["targets"][name]
+        stats["targets"][name] = {
+            "xtx": (np.asarray(current["xtx"]).reshape(k, k) + xtx).ravel().tolist(),
+            "xty": (np.asarray(current["xty"]) + xty).tolist(),
+        }
+    return stats
+
+def stats_from_columns(cols, user_profile):
+    """Sufficient statistics over a whole history in one vectorized pass."""
+    stats = empty_stats(user_profile)
+    if not len(cols):
+        return stats
+    scores = score_columns(cols, user_profile)
+    return _add(stats, _accumulate(design_matrix(cols), target_values(cols, scores)))
+
+def _record_sums(record, user_profile, sign):
+    cols = LogColumns.from_records([record])
+    # Same consistency (0) as the batch pass uses
+    score = calculate_sleep_score(record, user_profile, 0)
+    return _accumulate(design_matrix(cols), target_values(cols, [score]), sign)
+
+def add_log(stats, record, user_profile, replaced=None):
+    """Fold one new log into `stats`; `replaced` is the earlier log for the same day, if any. O(1) in history length."""
+    if replaced is not None:
+        stats = _add(stats, _record_sums(replaced, user_profile, -1.0))
+    return _add(stats, _record_sums(record, user_profile, 1.0))
+
+def factor_effects(stats, ridge=RIDGE, min_nights=MIN_NIGHTS):
+    """
+    Per-target effects of each tag, as dicts with kind, factor, target, effect and
+    nights (logged with the tag), for tags seen on at least `min_nights` nights and
+    missing on as many. A mental state's "missing" nights are the neutral ones it's
+    compared with.
+    """
+    k = 1 + len(FACTORS)
+    effects = []
+    for name in TARGETS:
+        xtx = np.asarray(stats["targets"][name]["xtx"]).reshape(k, k)
+        xty = np.asarray(stats["targets"][name]["xty"])
+        n = xtx[0, 0]
+        if n < 2 * min_nights:
+            continue
+        penalty = ridge * np.eye(k)
+        penalty[0, 0] = 0.0  # the intercept isn't shrunk
+        beta = np.linalg.solve(xtx + penalty, xty)
+        reference = n - sum(xtx[j, j] for j, (kind, _) in enumerate(FACTORS, start=1) if kind in ("mental_state", "unrecorded"))
+        for j, (kind, label) in enumerate(FACTORS, start=1):
+            if kind == "unrecorded":
+                continue
+            nights = xtx[j, j]
+            without = reference if kind == "mental_state" else n - nights
+            if nights >= min_nights and without >= min_nights:
+                effects.append({"kind": kind, "factor": label, "target": name, "effect": float(beta[j]), "nights": int(round(nights))})
+    return effects
+
+def notable_effects(effects, limit=3):
+    """The largest effects worth mentioning, biggest (relative to MIN_EFFECT) first."""
+    notable = [e for e in effects if abs(e["effect"]) >= MIN_EFFECT[e["target"]]]
+    notable.sort(key=lambda e: abs(e["effect"]) / MIN_EFFECT[e["target"]], reverse=True)
+    return notable[:limit]
+
+def describe_effect(effect):
+    """e.g. '“Dark” nights: +9 points for you.' Mental states are phrased against the reference."""
+    label, value = effect["factor"], effect["effect"]
+    if effect["kind"] == "environment":
+        subject = f"“{label}” nights"
+    else:
+        subject = f"Going to bed {label.lower()} (vs. {MENTAL_REFERENCE.lower()})"
+    if effect["target"] == "score":
+        return f"{subject}: {value:+.0f} points for you."
+    if effect["target"] == "hours":
+        return f"{subject}: {value:+.1f} h of sleep for you."
+    return f"{subject}: you fall asleep {abs(value):.0f} min {'slower' if value > 0 else 'faster'}."
@@ -0,0 +1,68 @@
+"""
+Process-wide Firebase client: `connect()` initializes Firestore once per process,
+warms its channel, and runs a health check the writer and app consult.
+"""
+import os
+import threading
+import time
+from datetime import datetime
+
+import firebase_admin
+from firebase_admin import credentials, firestore
+
+# Path to the service account key; set SLEEPAID_FIREBASE_CREDENTIALS in deployment
+CREDENTIALS_PATH = os.getenv(
+    "SLEEPAID_FIREBASE_CREDENTIALS",
+    r"C:\Users\sween\Downloads\sleepaid\sleepaid-c10bf-firebase-adminsdk-fbsvc-9fc57fd56d.json",
+)
+HEALTH_CHECK_INTERVAL = 60.0   # seconds
+HEALTH_CHECK_TIMEOUT = 10.0
+HEALTH_RECHECK_INTERVAL = 10.0   # seconds between checks while unhealthy
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class FirebaseClient:
+    def __init__(self, credentials_path, health_check_interval=HEALTH_CHECK_INTERVAL):
+        try:
+            firebase_admin.get_app()
+        except ValueError:
+            # No default app yet in this process
+            firebase_admin.initialize_app(credentials.Certificate(credentials_path))
+        self.db = firestore.client()
+        self.healthy = False
+        self.last_check = None
+        self.last_error = None
+        self.last_latency = None
+        self.check()
+        if health_check_interval:
+            threading.Thread(target=self._health_loop, args=(health_check_interval,), name="sleepaid-firebase-health", daemon=True).start()
+
+    def check(self):
+        """One cheap read. Opens (or re-opens) the gRPC channel and records whether it worked."""
+        started = time.monotonic()
+        try:
+            self.db.collection('user_profiles').limit(1).get(timeout=HEALTH_CHECK_TIMEOUT)
+            self.healthy, self.last_error = True, None
+        except Exception as e:
+            self.healthy, self.last_error = False, str(e)
+            print(f"Firestore health check failed: {e}")
+        self.last_check = datetime.now().isoformat()
+        self.last_latency = time.monotonic() - started
+        return self.healthy
+
+    def _health_loop(self, interval):
+        while True:
+            time.sleep(interval if self.healthy else min(interval, HEALTH_RECHECK_INTERVAL))
+            self.check()
+
+
+def connect(credentials_path=None, health_check_interval=HEALTH_CHECK_INTERVAL):
+    """The process's FirebaseClient, created (and warmed) on first call. Raises if initialization fails."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = FirebaseClient(credentials_path or CREDENTIALS_PATH, health_check_interval)
+    return _client
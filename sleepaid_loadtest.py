@@ -0,0 +1,336 @@
+"""
+Headless load test.
+
+Drives sleepaid_app.py through Streamlit's AppTest for many simulated sessions
+at once (login, dashboard, each dashboard tab, a log submission, the profile
+page) against `FakeFirestore`, an in-memory stand-in with a configurable
+per-call latency that counts document reads the way Firestore bills them. It
+reports p50/p95/p99 rerun latency and mean Firestore reads per action:
+
+    python sleepaid_loadtest.py --users 200 --concurrency 200 --latency-ms 40
+    python sleepaid_loadtest.py --users 20 --cache disk   # with the shared cache tier
+
+Nothing here touches a real backend: Firebase auth and the Firestore client are
+swapped for the fakes, the OpenAI key is blanked (rule-based suggestions) and the
+write queue and cache live in a temporary directory. AppTest always reruns the
+whole script, so tab clicks are measured as full reruns (fragment-only reruns
+in a browser are cheaper).
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import date, timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+
+_this_dir = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(_this_dir, "sleepaid_app.py")
+ACTIONS = ["login", "tab_metrics", "tab_gpt", "tab_last7", "log_submit", "profile"]
+
+
+# --- In-memory Firestore ---
+class FakeSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeDocument:
+    def __init__(self, db, path):
+        self._db = db
+        self.path = path
+        self.id = path[-1]
+
+    def collection(self, name):
+        return FakeCollection(self._db, self.path + (name,))
+
+    def get(self, **kwargs):
+        self._db._call()
+        data = self._db._docs.get(self.path)
+        self._db._count_reads(self.path, 1)
+        return FakeSnapshot(self.id, data)
+
+    def set(self, data, merge=False):
+        self._db._call()
+        self._db._apply_set(self.path, data, merge)
+
+
+class FakeCollection:
+    def __init__(self, db, path, order=None, descending=False, limit=None, after=None):
+        self._db = db
+        self.path = path
+        self._order = order
+        self._descending = descending
+        self._limit = limit
+        self._after = after
+
+    def document(self, doc_id):
+        return FakeDocument(self._db, self.path + (doc_id,))
+
+    def _query(self, **changes):
+        state = dict(order=self._order, descending=self._descending, limit=self._limit, after=self._after)
+        state.update(changes)
+        return FakeCollection(self._db, self.path, **state)
+
+    def order_by(self, field, direction="ASCENDING"):
+        return self._query(order=field, descending=str(direction).upper().endswith("DESCENDING"))
+
+    def limit(self, n):
+        return self._query(limit=n)
+
+    def start_after(self, snapshot):
+        return self._query(after=snapshot.id)
+
+    def _sort_key(self, item):
+        path, data = item
+        return path[-1] if self._order in (None, "__name__") else str(data.get(self._order, ""))
+
+    def stream(self, **kwargs):
+        self._db._call()
+        with self._db._lock:
+            items = [(p, d) for p, d in self._db._docs.items() if len(p) == len(self.path) + 1 and p[:-1] == self.path]
+        items.sort(key=self._sort_key, reverse=self._descending)
+        if self._after is not None:
+            items = [item for item in items if item[0][-1] > self._after]
+        if self._limit is not None:
+            items = items[:self._limit]
+        # Firestore bills a query that matches nothing as one read
+        self._db._count_reads(self.path, max(1, len(items)))
+        return iter([FakeSnapshot(p[-1], d) for p, d in items])
+
+    def get(self, **kwargs):
+        return list(self.stream())
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self._db = db
+        self._ops = []
+
+    def set(self, document, data, merge=False):
+        self._ops.append((document.path, data, merge))
+
+    def commit(self):
+        self._db._call()
+        for path, data, merge in self._ops:
+            self._db._apply_set(path, data, merge)
+
+
+class FakeFirestore:
+    """Enough of the Firestore client API for the app and worker, with latency and read accounting."""
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self._docs = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.reads_by_user = {}
+
+    def collection(self, name):
+        return FakeCollection(self, (name,))
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def _call(self):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _count_reads(self, path, n):
+        # Every collection the app uses is keyed by uid at the first document level
+        uid = path[1] if len(path) > 1 else None
+        with self._lock:
+            self.reads_by_user[uid] = self.reads_by_user.get(uid, 0) + n
+
+    def reads_for(self, uid):
+        with self._lock:
+            return self.reads_by_user.get(uid, 0)
+
+    def _apply_set(self, path, data, merge):
+        with self._lock:
+            current = dict(self._docs.get(path) or {}) if merge else {}
+            for key, value in data.items():
+                if hasattr(value, "value") and type(value).__name__ == "Increment":
+                    value = current.get(key, 0) + value.value
+                current[key] = value
+            self._docs[path] = current
+
+    def seed(self, path, data):
+        with self._lock:
+            self._docs[tuple(path)] = dict(data)
+
+
+def seed_user(db, uid, days, today):
+    db.seed(("user_profiles", uid), {
+        "onboarding_complete": True,
+        "personal_info": {"first_name": f"Load {uid}", "age": 30, "gender": "", "timezone": "UTC"},
+        "sleep_patterns": {"struggle": "Falling asleep", "goal": "Sleep 7+ hours", "goal_custom": "", "usual_bedtime": "23:00", "usual_wake_time": "07:00"},
+        "lifestyle_support": {"workout": "No", "workout_freq": 0, "caffeine": "No", "caffeine_time": "", "phone_use": "Yes", "support_pref": ""},
+    })
+    rng = np.random.default_rng(abs(hash(uid)) % 2**32)
+    # Leave today open so the session can submit it
+    for i in range(1, days + 1):
+        day = (today - timedelta(days=i)).isoformat()
+        hours = float(rng.choice(np.arange(5.0, 9.5, 0.5)))
+        db.seed(("users", uid, "sleep_logs", day), {
+            "date": day, "hours_slept": hours, "time_in_bed": hours + 0.5, "time_to_fall_asleep": int(rng.integers(5, 45)),
+            "bed_time": f"{int(rng.integers(21, 24)):02d}:{int(rng.choice([0, 15, 30, 45])):02d}", "wake_time": "07:00",
+            "sleep_efficiency": hours / (hours + 0.5) * 100, "woke_up_feeling": ["🙂 Refreshed"], "woke_up_night": False,
+            "woke_up_times": 0, "quality_rating": int(rng.integers(4, 10)), "sleep_environment": ["Dark"], "mental_state": ["Relaxed"], "notes": "",
+        })
+
+
+# --- Session driver ---
+_compile_lock = threading.Lock()
+
+def _serialize_script_compiles():
+    """
+    Each AppTest compiles the script itself, and CPython's ast.parse is not safe to
+    run from many threads at once ("AST constructor recursion depth mismatch"), so
+    compiles take turns. Script execution itself still runs concurrently.
+    """
+    from streamlit.runtime.scriptrunner import magic
+
+    add_magic = magic.add_magic
+    def locked_add_magic(code, script_path):
+        with _compile_lock:
+            return add_magic(code, script_path)
+    return mock.patch.object(magic, "add_magic", locked_add_magic)
+
+def _shared_runtime():
+    """
+    AppTest installs a mock Runtime in a global for each run and clears it when the
+    run ends, which breaks other sessions still running. Serve every session one
+    shared mock Runtime instead, like the single Runtime of a real server process
+    (so st.cache_resource is shared across sessions too).
+    """
+    from unittest.mock import MagicMock
+    from streamlit.testing.v1 import app_test
+    from streamlit.runtime import Runtime
+
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = app_test.MediaFileManager(app_test.MemoryMediaFileStorage("/mock/media"))
+    runtime.dataframe_source_mgr = app_test.DataframeSourceManager()
+    runtime.cache_storage_manager = app_test.MemoryCacheStorageManager()
+    runtime.bidi_component_registry = app_test.BidiComponentManager()
+    stack = ExitStack()
+    stack.enter_context(mock.patch.object(Runtime, "instance", classmethod(lambda cls: runtime)))
+    stack.enter_context(mock.patch.object(Runtime, "exists", classmethod(lambda cls: True)))
+    return stack
+
+def _click(at, label, sidebar=False):
+    buttons = at.sidebar.button if sidebar else at.button
+    for button in buttons:
+        if button.label == label:
+            return button.click()
+    raise LookupError(f"No button labelled {label!r} (exceptions: {[e.value for e in at.exception]})")
+
+def run_session(db, uid, timeout):
+    from streamlit.testing.v1 import AppTest
+
+    timings = {}
+    reads = {}
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+
+    def timed(action, step):
+        before = db.reads_for(uid)
+        started = time.perf_counter()
+        step()
+        at.run()
+        timings[action] = time.perf_counter() - started
+        reads[action] = db.reads_for(uid) - before
+        if at.exception:
+            raise RuntimeError(f"{action}: {at.exception[0].value}")
+
+    at.run()
+    def login():
+        at.text_input[0].input(f"{uid}@example.com")
+        at.text_input[1].input("password")
+        _click(at, "Login")
+    timed("login", login)
+    timed("tab_metrics", lambda: _click(at, "Metrics"))
+    timed("tab_gpt", lambda: _click(at, "GPT Suggestion"))
+    timed("tab_last7", lambda: _click(at, "Last 7 Days"))
+    _click(at, "🌙 Log Today's Sleep")
+    at.run()
+    timed("log_submit", lambda: _click(at, "Submit Sleep Log"))
+    timed("profile", lambda: _click(at, "Profile", sidebar=True))
+    return timings, reads
+
+
+def report(results, errors, wall):
+    print(f"\n{len(results)} sessions completed, {len(errors)} failed, {wall:.1f}s wall time")
+    for uid, error in errors[:5]:
+        print(f"  {uid}: {error}")
+    if not results:
+        return
+    print(f"\n{'action':<14}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'reads/action':>14}")
+    all_latencies = []
+    for action in ACTIONS:
+        latencies = np.array([timings[action] for timings, _ in results]) * 1000
+        action_reads = np.array([reads[action] for _, reads in results])
+        all_latencies.append(latencies)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        print(f"{action:<14}{p50:>10.0f}{p95:>10.0f}{p99:>10.0f}{action_reads.mean():>14.1f}")
+    p50, p95, p99 = np.percentile(np.concatenate(all_latencies), [50, 95, 99])
+    print(f"{'all':<14}{p50:>10.0f}{p95:>10.0f}{p99:>10.0f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate concurrent SleepAId sessions against an in-memory Firestore.")
+    parser.add_argument("--users", type=int, default=200, help="Simulated sessions, one user each.")
+    parser.add_argument("--concurrency", type=int, default=200, help="Sessions running at the same time.")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Added latency per Firestore call.")
+    parser.add_argument("--history-days", type=int, default=90, help="Logs seeded per user.")
+    parser.add_argument("--cache", default="none", help="SLEEPAID_CACHE_URL for the run: none, disk, or a redis:// URL.")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Seconds allowed per rerun.")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="sleepaid-loadtest-")
+    os.environ["OPENAI_API_KEY"] = ""
+    os.environ["SLEEPAID_WRITE_QUEUE"] = os.path.join(workdir, "write_queue.jsonl")
+    os.environ["SLEEPAID_CACHE_URL"] = os.path.join(workdir, "cache") if args.cache == "disk" else args.cache
+
+    import firebase_admin.auth
+    import sleepaid_firebase
+
+    db = FakeFirestore(latency=args.latency_ms / 1000)
+    today = date.today()
+    uids = [f"load{i:04d}" for i in range(args.users)]
+    for uid in uids:
+        seed_user(db, uid, args.history_days, today)
+
+    def get_user_by_email(email):
+        return SimpleNamespace(uid=email.split("@")[0])
+
+    results, errors = [], []
+    started = time.perf_counter()
+    with mock.patch.object(sleepaid_firebase, "_client", SimpleNamespace(db=db, healthy=True)), \
+            mock.patch.object(firebase_admin.auth, "get_user_by_email", get_user_by_email), \
+            _serialize_script_compiles(), _shared_runtime():
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            futures = {uid: pool.submit(run_session, db, uid, args.timeout) for uid in uids}
+            for uid, future in futures.items():
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    errors.append((uid, e))
+    report(results, errors, time.perf_counter() - started)
+    print(f"Firestore calls: {db.calls}, work dir: {workdir}")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,143 @@
+"""
+Convert stored sleep logs to the compact version 2 encoding (see sleepaid_codec).
+
+Walks `user_profiles` in pages like the nightly worker, and for each user
+rewrites every `sleep_logs` document that isn't version 2 yet, in WriteBatches.
+Each rewrite is conditioned on the document's update time, so a log the app
+saved mid-run is never overwritten with its older contents: the batch fails,
+the user is recorded as failed, and the next run picks them up. Progress is
+checkpointed after every page:
+
+    python sleepaid_migrate_logs.py --credentials path/to/key.json --dry-run
+    python sleepaid_migrate_logs.py --credentials path/to/key.json --workers 8
+    python sleepaid_migrate_logs.py --credentials path/to/key.json --reset   # start over
+
+The app and worker read both versions, so the migration can run at any time.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from google.cloud.firestore_v1 import DELETE_FIELD
+
+from sleepaid_codec import SCHEMA_VERSION, encode_log, schema_version
+from sleepaid_firebase import connect
+from sleepaid_worker import iter_profile_pages, load_checkpoint, save_checkpoint
+
+_this_dir = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CHECKPOINT = os.path.join(_this_dir, "data", "log_migration_checkpoint.json")
+BATCH_LIMIT = 400    # Firestore allows 500 writes per batch
+
+
+def document_size(value):
+    """Approximate stored size in bytes, following Firestore's size rules for field values."""
+    if isinstance(value, dict):
+        return sum(len(key.encode()) + 1 + document_size(v) for key, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(document_size(v) for v in value)
+    if isinstance(value, str):
+        return len(value.encode()) + 1
+    if isinstance(value, bool) or value is None:
+        return 1
+    return 8
+
+def migration_update(old, new):
+    """Field updates turning document `old` into `new`: the new fields, and deletes for the old ones."""
+    update = {key: DELETE_FIELD for key in old if key not in new}
+    update.update(new)
+    return update
+
+
+def migrate_user(db, uid, dry_run):
+    """Re-encode one user's logs. Returns (documents converted, bytes before, bytes after)."""
+    converted, before, after = 0, 0, 0
+    pending = []
+    def commit():
+        batch = db.batch()
+        for snapshot, new in pending:
+            batch.update(snapshot.reference, migration_update(snapshot.to_dict(), new),
+                         option=db.write_option(last_update_time=snapshot.update_time))
+        batch.commit()
+        pending.clear()
+    for snapshot in db.collection('users').document(uid).collection('sleep_logs').stream():
+        doc = snapshot.to_dict() or {}
+        if schema_version(doc) == SCHEMA_VERSION:
+            continue
+        new = encode_log(doc)
+        converted += 1
+        before += document_size(doc)
+        after += document_size(new)
+        if dry_run:
+            continue
+        pending.append((snapshot, new))
+        if len(pending) >= BATCH_LIMIT:
+            commit()
+    if pending:
+        commit()
+    return converted, before, after
+
+
+def run(db, page_size, workers, checkpoint_path, dry_run=False, reset=False):
+    checkpoint = {} if reset or dry_run else load_checkpoint(checkpoint_path)
+    # A finished run is only resumed from if it was interrupted; otherwise rescan (retrying failed users)
+    if checkpoint.get("completed_at"):
+        checkpoint = {}
+    checkpoint.setdefault("users", 0)
+    checkpoint.setdefault("converted", 0)
+    checkpoint.setdefault("bytes_before", 0)
+    checkpoint.setdefault("bytes_after", 0)
+    checkpoint.setdefault("failed", [])
+    started = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for page in iter_profile_pages(db, page_size, checkpoint.get("last_uid")):
+            futures = {pool.submit(migrate_user, db, snap.id, dry_run): snap.id for snap in page}
+            for future in as_completed(futures):
+                uid = futures[future]
+                try:
+                    converted, before, after = future.result()
+                except Exception as e:
+                    print(f"Error migrating logs for {uid}: {e}")
+                    checkpoint["failed"].append(uid)
+                    continue
+                checkpoint["users"] += 1
+                checkpoint["converted"] += converted
+                checkpoint["bytes_before"] += before
+                checkpoint["bytes_after"] += after
+            checkpoint["last_uid"] = page[-1].id
+            checkpoint["updated_at"] = datetime.now().isoformat()
+            if not dry_run:
+                save_checkpoint(checkpoint_path, checkpoint)
+            print(f"Page done through {checkpoint['last_uid']} ({checkpoint['users']} users, {checkpoint['converted']} logs, {len(checkpoint['failed'])} failed)")
+
+    checkpoint["completed_at"] = datetime.now().isoformat()
+    if not dry_run:
+        save_checkpoint(checkpoint_path, checkpoint)
+    saved = checkpoint["bytes_before"] - checkpoint["bytes_after"]
+    share = saved / checkpoint["bytes_before"] * 100 if checkpoint["bytes_before"] else 0.0
+    print(f"{'Would convert' if dry_run else 'Converted'} {checkpoint['converted']} logs for {checkpoint['users']} users "
+          f"in {time.monotonic() - started:.1f}s: ~{checkpoint['bytes_before']} -> ~{checkpoint['bytes_after']} bytes ({share:.0f}% smaller), "
+          f"{len(checkpoint['failed'])} failed")
+    return checkpoint
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert SleepAId sleep logs to the compact version 2 encoding.")
+    parser.add_argument("--credentials", required=True, help="Path to the Firebase service account key JSON file.")
+    parser.add_argument("--page-size", type=int, default=200, help="Profiles fetched per Firestore page.")
+    parser.add_argument("--workers", type=int, default=8, help="Maximum users migrated concurrently.")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT, help="Where progress is recorded between runs.")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would change without writing anything.")
+    parser.add_argument("--reset", action="store_true", help="Ignore any existing checkpoint and start from the first user.")
+    args = parser.parse_args(argv)
+
+    db = connect(args.credentials, health_check_interval=None).db
+    checkpoint = run(db, args.page_size, args.workers, args.checkpoint, dry_run=args.dry_run, reset=args.reset)
+    return 1 if checkpoint["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
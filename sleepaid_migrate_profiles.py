@@ -0,0 +1,125 @@
+"""
+Rewrite stored user profiles in the canonical schema (see sleepaid_profiles).
+
+Pages through `user_profiles` by document id, canonicalizes each profile, and
+writes the ones that change in WriteBatches, several batches in flight at once
+(bounded by --workers). Each write is conditioned on the profile's update time,
+so a profile the app saved mid-run is never overwritten with its older contents:
+that batch fails, its users are recorded as failed, and the next run picks them
+up. A page is only checkpointed once all of its batches have landed:
+
+    python sleepaid_migrate_profiles.py --credentials path/to/key.json --dry-run
+    python sleepaid_migrate_profiles.py --credentials path/to/key.json --workers 8
+    python sleepaid_migrate_profiles.py --credentials path/to/key.json --reset   # start over
+
+Once a run finishes with nothing failed and nothing left to convert, the
+read-side conversion in the app's get_user_profile can be removed.
+"""
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from sleepaid_firebase import connect
+from sleepaid_migrate_logs import migration_update
+from sleepaid_profiles import canonicalize_profile
+from sleepaid_worker import iter_profile_pages, load_checkpoint, save_checkpoint
+
+_this_dir = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CHECKPOINT = os.path.join(_this_dir, "data", "profile_migration_checkpoint.json")
+BATCH_LIMIT = 400    # Firestore allows 500 writes per batch
+
+
+def changed_fields(old, new):
+    """Top-level fields that differ between two profiles."""
+    return sorted(key for key in set(old) | set(new) if old.get(key) != new.get(key))
+
+def commit_batch(db, pending):
+    """Write one batch of (snapshot, canonical profile) pairs; all or nothing."""
+    batch = db.batch()
+    for snapshot, new in pending:
+        batch.update(snapshot.reference, migration_update(snapshot.to_dict() or {}, new),
+                     option=db.write_option(last_update_time=snapshot.update_time))
+    batch.commit()
+
+
+def migrate_page(db, pool, page, batch_size, dry_run, checkpoint):
+    """Canonicalize a page of profile snapshots and wait for its batches to land."""
+    pending = []
+    for snapshot in page:
+        old = snapshot.to_dict() or {}
+        new = canonicalize_profile(old)
+        fields = changed_fields(old, new)
+        checkpoint["users"] += 1
+        if not fields:
+            continue
+        checkpoint["converted"] += 1
+        for field in fields:
+            checkpoint["fields"][field] = checkpoint["fields"].get(field, 0) + 1
+        if not dry_run:
+            pending.append((snapshot, new))
+    chunks = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    futures = {pool.submit(commit_batch, db, chunk): chunk for chunk in chunks}
+    for future in as_completed(futures):
+        try:
+            future.result()
+        except Exception as e:
+            uids = [snapshot.id for snapshot, _ in futures[future]]
+            print(f"Error writing {len(uids)} profiles ({uids[0]}..{uids[-1]}): {e}")
+            checkpoint["failed"].extend(uids)
+            checkpoint["converted"] -= len(uids)
+
+
+def run(db, page_size, batch_size, workers, checkpoint_path, dry_run=False, reset=False):
+    checkpoint = {} if reset or dry_run else load_checkpoint(checkpoint_path)
+    # A finished run is only resumed from if it was interrupted; otherwise rescan (retrying failed users)
+    if checkpoint.get("completed_at"):
+        checkpoint = {}
+    checkpoint.setdefault("users", 0)
+    checkpoint.setdefault("converted", 0)
+    checkpoint.setdefault("fields", {})
+    checkpoint.setdefault("failed", [])
+    batch_size = max(1, min(batch_size, BATCH_LIMIT))
+    started = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for page in iter_profile_pages(db, page_size, checkpoint.get("last_uid")):
+            migrate_page(db, pool, page, batch_size, dry_run, checkpoint)
+            checkpoint["last_uid"] = page[-1].id
+            checkpoint["updated_at"] = datetime.now().isoformat()
+            if not dry_run:
+                save_checkpoint(checkpoint_path, checkpoint)
+            print(f"Page done through {checkpoint['last_uid']} ({checkpoint['users']} users, {checkpoint['converted']} converted, {len(checkpoint['failed'])} failed)")
+
+    checkpoint["completed_at"] = datetime.now().isoformat()
+    if not dry_run:
+        save_checkpoint(checkpoint_path, checkpoint)
+    fields = Counter(checkpoint["fields"]).most_common()
+    print(f"{'Would convert' if dry_run else 'Converted'} {checkpoint['converted']} of {checkpoint['users']} profiles "
+          f"in {time.monotonic() - started:.1f}s, {len(checkpoint['failed'])} failed")
+    if fields:
+        print("Fields changed: " + ", ".join(f"{field} ({count})" for field, count in fields))
+    return checkpoint
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rewrite SleepAId user profiles in the canonical schema.")
+    parser.add_argument("--credentials", required=True, help="Path to the Firebase service account key JSON file.")
+    parser.add_argument("--page-size", type=int, default=1000, help="Profiles fetched per Firestore page.")
+    parser.add_argument("--batch-size", type=int, default=100, help=f"Profiles per WriteBatch (at most {BATCH_LIMIT}).")
+    parser.add_argument("--workers", type=int, default=8, help="Maximum batches committed concurrently.")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT, help="Where progress is recorded between runs.")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would change without writing anything.")
+    parser.add_argument("--reset", action="store_true", help="Ignore any existing checkpoint and start from the first user.")
+    args = parser.parse_args(argv)
+
+    db = connect(args.credentials, health_check_interval=None).db
+    checkpoint = run(db, args.page_size, args.batch_size, args.workers, args.checkpoint, dry_run=args.dry_run, reset=args.reset)
+    return 1 if checkpoint["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""
+Local stand-in for the OpenAI chat completions endpoint, for exercising
+sleepaid_openai offline. It answers POST .../chat/completions according to its
+`mode` (ok, error, rate_limit, bad_request), after an optional `delay`, and
+counts requests and how many were in flight at once.
+
+    python sleepaid_mock_openai.py --port 8089 --mode error
+    OPENAI_BASE_URL=http://127.0.0.1:8089/v1 OPENAI_API_KEY=mock streamlit run sleepaid_app.py
+
+Tests start one in-process with `MockOpenAI().start()` and change `mode` and
+`delay` between calls.
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MODES = {
+    "ok": 200,
+    "error": 500,
+    "rate_limit": 429,
+    "bad_request": 400,
+}
+
+
+class MockOpenAI:
+    def __init__(self, host="127.0.0.1", port=0, mode="ok", delay=0.0, content="Keep a steady bedtime tonight."):
+        self.mode = mode
+        self.delay = delay
+        self.content = content
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name="sleepaid-mock-openai", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _respond(self, body):
+        """(status, payload) for one request, after the configured delay."""
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.delay)
+            status = MODES[self.mode]
+            if status != 200:
+                return status, {"error": {"message": f"mock {self.mode}", "type": self.mode, "code": None}}
+            return status, {
+                "id": f"chatcmpl-mock-{self.requests}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "mock"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": self.content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            }
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self.send_error(404)
+                    return
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                except json.JSONDecodeError:
+                    body = {}
+                status, payload = mock._respond(body)
+                data = json.dumps(payload).encode("utf-8")
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except OSError:
+                    pass  # the client timed out and hung up
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a mock OpenAI chat completions endpoint.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--mode", choices=sorted(MODES), default="ok", help="How every request is answered.")
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds to wait before answering.")
+    args = parser.parse_args(argv)
+
+    mock = MockOpenAI(args.host, args.port, args.mode, args.delay)
+    print(f"Mock OpenAI ({args.mode}, {args.delay:.1f}s delay) at {mock.url}; set OPENAI_BASE_URL to that")
+    try:
+        mock._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Resilient OpenAI client layer.
+
+Every suggestion goes through one process-wide `ResilientClient`:
+
+- a per-call timeout, plus an overall deadline across retries, so a slow
+  upstream can't hold a Streamlit script thread for long;
+- a bounded semaphore limiting concurrent calls across all sessions (callers
+  that can't get a slot quickly are turned away instead of queueing);
+- jittered retries for errors worth retrying (timeouts, connection errors,
+  429s and 5xx);
+- a circuit breaker: after FAILURE_THRESHOLD consecutive failures calls are
+  refused for RESET_AFTER seconds, then a single trial call decides whether to
+  close it again.
+
+Callers treat any `SuggestionUnavailable` as "use the rule-based suggestion".
+Point OPENAI_BASE_URL at a local mock server (sleepaid_mock_openai.py) to
+exercise all of this offline; test_sleepaid_openai.py does.
+"""
+import os
+import random
+import threading
+import time
+
+import openai
+
+CALL_TIMEOUT = float(os.getenv("SLEEPAID_OPENAI_TIMEOUT", "6"))          # seconds per attempt
+TOTAL_DEADLINE = float(os.getenv("SLEEPAID_OPENAI_DEADLINE", "10"))      # seconds across retries
+MAX_CONCURRENCY = int(os.getenv("SLEEPAID_OPENAI_MAX_CONCURRENCY", "8"))
+SLOT_WAIT = 1.0          # seconds to wait for a free concurrency slot
+MAX_RETRIES = 2
+RETRY_BASE = 0.25        # seconds, doubled per retry, with full jitter
+FAILURE_THRESHOLD = 5
+RESET_AFTER = 30.0
+
+RETRYABLE_ERRORS = (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+
+class SuggestionUnavailable(Exception):
+    """The model couldn't be used for this call; fall back to the rule-based suggestion."""
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_after=RESET_AFTER):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_after:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        """
+        Whether a call may go ahead: True when closed, "trial" for the one call let
+        through at a time while half-open, False otherwise.
+        """
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial_running:
+                self._trial_running = True
+                return "trial"
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+    def release_trial(self):
+        """Give back a half-open trial that ended without a result, so the next call can try."""
+        with self._lock:
+            self._trial_running = False
+
+
+class ResilientClient:
+    def __init__(self, base_url=None, call_timeout=CALL_TIMEOUT, total_deadline=TOTAL_DEADLINE,
+                 max_concurrency=MAX_CONCURRENCY, max_retries=MAX_RETRIES, breaker=None):
+        self.base_url = base_url or os.getenv("OPENAI_BASE_URL") or None
+        self.call_timeout = call_timeout
+        self.total_deadline = total_deadline
+        self.max_retries = max_retries
+        self.breaker = breaker or CircuitBreaker()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._client = None
+        self._client_key = None
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        # The app and worker set openai.api_key after import; rebuild if it changes
+        with self._lock:
+            if self._client is None or self._client_key != openai.api_key:
+                self._client = openai.OpenAI(api_key=openai.api_key, base_url=self.base_url, max_retries=0)
+                self._client_key = openai.api_key
+            return self._client
+
+    def chat(self, messages, **kwargs):
+        """Message content of one chat completion. Raises SuggestionUnavailable instead of hanging or leaking errors."""
+        permit = self.breaker.allow()
+        if not permit:
+            raise SuggestionUnavailable("circuit open")
+        try:
+            if not self._slots.acquire(timeout=SLOT_WAIT):
+                # Not the upstream's fault, so the breaker isn't told
+                raise SuggestionUnavailable("too many concurrent requests")
+            try:
+                content = self._call_with_retries(messages, kwargs)
+            except Exception as e:
+                self.breaker.record_failure()
+                if isinstance(e, SuggestionUnavailable):
+                    raise
+                raise SuggestionUnavailable(f"{type(e).__name__}: {e}") from e
+            finally:
+                self._slots.release()
+            self.breaker.record_success()
+            return content
+        finally:
+            # Whatever happened, a half-open trial never stays taken. Only the call holding
+            # it gives it back: one started while closed mustn't free a later trial.
+            if permit == "trial":
+                self.breaker.release_trial()
+
+    def _call_with_retries(self, messages, kwargs):
+        client = self._get_client()
+        deadline = time.monotonic() + self.total_deadline
+        for attempt in range(self.max_retries + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise SuggestionUnavailable("deadline exceeded")
+            try:
+                response = client.chat.completions.create(messages=messages, timeout=min(self.call_timeout, remaining), **kwargs)
+            except RETRYABLE_ERRORS as e:
+                error = e
+            except openai.OpenAIError as e:
+                # Bad request, auth, etc.: retrying won't help
+                raise SuggestionUnavailable(f"{type(e).__name__}: {e}")
+            else:
+                content = response.choices[0].message.content if response.choices else None
+                if not content:
+                    raise SuggestionUnavailable("no content returned")
+                return content.strip()
+            if attempt == self.max_retries:
+                break
+            delay = random.uniform(0, RETRY_BASE * 2 ** attempt)
+            if time.monotonic() + delay >= deadline:
+                break
+            time.sleep(delay)
+        raise SuggestionUnavailable(f"{type(error).__name__}: {error}")
+
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """The process-wide ResilientClient."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = ResilientClient()
+    return _client
@@ -0,0 +1,100 @@
+"""
+Prefix-sum index over a user's log days: per-series cumulative sums (hours,
+scores, sleep debt and recovery...), so any window's totals are two lookups.
+"""
+import calendar
+from datetime import date
+
+import numpy as np
+
+SERIES = (
+    "nights",          # logged nights
+    "hours",
+    "deficit",         # hours short of the goal's minimum
+    "recovery",        # hours above the minimum, up to the goal's maximum
+    "in_goal",         # nights within the goal range
+    "latency",
+    "latency_nights",  # nights that recorded a latency
+    "wakeups",
+    "bed_diff",        # minutes between consecutive logged bedtimes (on the later night)
+    "bed_pairs",
+    "wake_diff",       # the same for wake times
+    "wake_pairs",
+)
+
+
+class PrefixIndex:
+    def __init__(self, first_ordinal, prefix):
+        self.first_ordinal = first_ordinal
+        # series -> array of length days + 1, prefix[s][i] = total over the first i days
+        self.prefix = prefix
+
+    @property
+    def last_ordinal(self):
+        return self.first_ordinal + len(self.prefix["nights"]) - 2
+
+    @classmethod
+    def from_columns(cls, cols, min_goal, max_goal):
+        """Build from LogColumns sorted by ordinal with one row per day (a LogStore view)."""
+        if not len(cols):
+            return cls(0, {name: np.zeros(1) for name in SERIES})
+        ordinals = cols.ordinal.astype(np.int64)
+        first = int(ordinals[0])
+        days = np.zeros((len(SERIES), int(ordinals[-1]) - first + 1))
+        row = dict(zip(SERIES, days))
+        idx = ordinals - first
+        hours = cols.hours_slept
+        latency = cols.time_to_fall_asleep
+        has_latency = ~np.isnan(latency)
+        row["nights"][idx] = 1
+        row["hours"][idx] = hours
+        row["deficit"][idx] = np.maximum(0.0, min_goal - hours)
+        row["recovery"][idx] = np.clip(hours, min_goal, max_goal) - min_goal
+        row["in_goal"][idx] = (hours >= min_goal) & (hours <= max_goal)
+        row["latency"][idx] = np.where(has_latency, latency, 0.0)
+        row["latency_nights"][idx] = has_latency
+        row["wakeups"][idx] = cols.woke_up_times
+        # Consecutive logs whose times are both valid, as in the insights' consistency
+        for name, minutes, valid in (("bed", cols.bed_minutes, cols.bed_valid), ("wake", cols.wake_minutes, cols.wake_valid)):
+            pairs = valid[1:] & valid[:-1]
+            diffs = np.abs(np.diff(minutes.astype(np.int64)))
+            row[f"{name}_diff"][idx[1:]] = np.where(pairs, diffs, 0)
+            row[f"{name}_pairs"][idx[1:]] = pairs
+        prefix = {name: np.concatenate(([0.0], np.cumsum(row[name]))) for name in SERIES}
+        return cls(first, prefix)
+
+    def totals(self, start_ordinal, end_ordinal):
+        """{series: total} over days [start_ordinal, end_ordinal], in O(1). Days outside the index count as unlogged."""
+        n = len(self.prefix["nights"]) - 1
+        lo = min(max(start_ordinal - self.first_ordinal, 0), n)
+        hi = min(max(end_ordinal - self.first_ordinal + 1, 0), n)
+        if hi <= lo:
+            return {name: 0.0 for name in SERIES}
+        return {name: float(p[hi] - p[lo]) for name, p in self.prefix.items()}
+
+    def window(self, start_ordinal, end_ordinal):
+        """Averages, goal progress, consistency and sleep debt for days [start_ordinal, end_ordinal]."""
+        t = self.totals(start_ordinal, end_ordinal)
+        nights = int(t["nights"])
+        def mean(total, count):
+            return total / count if count else 0.0
+        return {
+            "days": end_ordinal - start_ordinal + 1,
+            "nights_logged": nights,
+            "avg_hours": mean(t["hours"], nights),
+            "avg_latency": mean(t["latency"], t["latency_nights"]),
+            "avg_wakeups": mean(t["wakeups"], nights),
+            "percent_in_goal": int(mean(t["in_goal"], nights) * 100),
+            "avg_bedtime_diff": mean(t["bed_diff"], t["bed_pairs"]),
+            "avg_waketime_diff": mean(t["wake_diff"], t["wake_pairs"]),
+            "sleep_debt": t["deficit"],
+            "recovered": t["recovery"],
+            "net_debt": t["deficit"] - t["recovery"],
+        }
+
+    def last_days(self, today, days):
+        return self.window(today.toordinal() - (days - 1), today.toordinal())
+
+    def month(self, year, month):
+        last_day = calendar.monthrange(year, month)[1]
+        return self.window(date(year, month, 1).toordinal(), date(year, month, last_day).toordinal())
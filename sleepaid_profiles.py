@@ -0,0 +1,86 @@
+"""
+The canonical user profile schema.
+
+Profiles exist in several shapes: legacy ones keep everything under
+`onboarding` (with short codes like "7+_hours"), current onboarding writes
+`personal_info` / `sleep_patterns` / `lifestyle_support`, and very old ones
+have `sleep_habits` / `night_patterns`. `canonicalize_profile` turns any of
+them into one schema (version 3) with just the three current sections, keeping
+everything else on the profile (anomaly state, factor stats, scoring
+overrides...) as it is. Scoring reads `sleep_patterns`, which is what the forms
+edit, so there are no derived copies to drift. It is idempotent: a canonical
+profile comes back equal.
+
+The app canonicalizes on read and write; sleepaid_migrate_profiles.py rewrites
+stored profiles so the read-side conversion can eventually go.
+"""
+PROFILE_SCHEMA_VERSION = 3
+DEFAULT_DURATION_GOAL = "7-8 hours"
+# The struggle that makes scoring measure wake-ups against the user's usual count
+NIGHT_WAKING_STRUGGLE = "Waking up during the night"
+
+# Legacy onboarding codes -> current option labels
+GOAL_MAP = {
+    "7+_hours": "Sleep 7+ hours",
+    "no_caffeine": "No caffeine after 6pm",
+    "log_daily": "Log my sleep daily",
+    "bed_before_11": "Go to bed before 11pm",
+    "wake_consistent": "Wake up at the same time",
+    "custom": "Custom goal",
+}
+STRUGGLE_MAP = {
+    "falling_asleep": "Falling asleep",
+    "waking_up": NIGHT_WAKING_STRUGGLE,
+    "waking_early": "Waking up too early",
+    "consistency": "Staying consistent"
+}
+
+
+def canonicalize_profile(data):
+    """Any stored profile shape as a version 3 profile (a new dict; `data` isn't modified)."""
+    if not isinstance(data, dict):
+        return data
+    profile = dict(data)
+    onboarding = profile.pop("onboarding", None) or {}
+    sleep_habits = profile.pop("sleep_habits", None) or {}
+    night_patterns = profile.pop("night_patterns", None) or {}
+
+    personal_info = dict(profile.get("personal_info") or {})
+    for key, default in (("first_name", ""), ("age", ""), ("gender", ""), ("timezone", "UTC")):
+        if key not in personal_info:
+            personal_info[key] = onboarding.get(key, default)
+    personal_info["timezone"] = personal_info["timezone"] or "UTC"
+    # The profile page shows `name`; onboarding only ever asked for a first name
+    if not personal_info.get("name") and personal_info["first_name"]:
+        personal_info["name"] = personal_info["first_name"]
+
+    sleep_patterns = dict(profile.get("sleep_patterns") or {})
+    legacy_bedtime = sleep_habits.get("usual_bedtime") or "23:00"
+    for key, default in (("struggle", ""), ("goal", ""), ("goal_custom", ""), ("usual_bedtime", legacy_bedtime), ("usual_wake_time", "07:00")):
+        if key not in sleep_patterns:
+            sleep_patterns[key] = onboarding.get(key, default)
+    sleep_patterns["goal"] = GOAL_MAP.get(sleep_patterns["goal"], sleep_patterns["goal"])
+    sleep_patterns["struggle"] = STRUGGLE_MAP.get(sleep_patterns["struggle"], sleep_patterns["struggle"])
+    sleep_patterns["usual_bedtime"] = sleep_patterns["usual_bedtime"] or legacy_bedtime
+    sleep_patterns["usual_wake_time"] = sleep_patterns["usual_wake_time"] or "07:00"
+    if not sleep_patterns["struggle"] and night_patterns.get("wakes_up_at_night"):
+        sleep_patterns["struggle"] = NIGHT_WAKING_STRUGGLE
+    # The rest of what scoring reads (see ScoringModel.profile_params); only very old
+    # profiles set the latency goal and usual wake-up count
+    sleep_patterns.setdefault("sleep_duration_goal", sleep_habits.get("sleep_duration_goal") or DEFAULT_DURATION_GOAL)
+    for key, value in (("time_to_fall_asleep", sleep_habits.get("time_to_fall_asleep")), ("wake_up_count", night_patterns.get("wake_up_count"))):
+        if key not in sleep_patterns and value is not None:
+            sleep_patterns[key] = value
+
+    lifestyle_support = dict(profile.get("lifestyle_support") or {})
+    for key, default in (("workout", ""), ("workout_freq", 0), ("caffeine", ""), ("caffeine_time", ""), ("phone_use", ""), ("support_pref", "")):
+        if key not in lifestyle_support:
+            lifestyle_support[key] = onboarding.get(key, default)
+
+    profile.update({
+        "schema_version": PROFILE_SCHEMA_VERSION,
+        "personal_info": personal_info,
+        "sleep_patterns": sleep_patterns,
+        "lifestyle_support": lifestyle_support,
+    })
+    return profile
@@ -0,0 +1,100 @@
+"""
+Opt-in sampling profiler for single app reruns.
+
+`profile_rerun(page, uid)`, called from the app script, starts a thread that
+samples the script thread's stack every few milliseconds, from the script's
+own frame down, until that frame leaves the stack: the rerun ended, whether it
+ran to the end, hit st.stop()/st.rerun() or raised. Samples are wall-clock, so
+time spent waiting on Firestore or the model shows up as well as CPU.
+
+Results are written in the collapsed-stack format ("frame;frame;frame count"
+per line) that flamegraph.pl, inferno and speedscope read, one file per rerun,
+named by time, page and a hash of the uid:
+
+    data/profiles/20261019-142501-dashboard-3f9a0c1b2d4e5f60.folded
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from sleepaid_cache import digest
+
+_this_dir = os.path.dirname(os.path.abspath(__file__))
+PROFILE_DIR = os.getenv("SLEEPAID_PROFILE_DIR", os.path.join(_this_dir, "data", "profiles"))
+SAMPLE_INTERVAL = float(os.getenv("SLEEPAID_PROFILE_INTERVAL_MS", "5")) / 1000
+MAX_SECONDS = 120    # a rerun still going after this is cut off
+
+
+def env_pages():
+    """Pages named in SLEEPAID_PROFILE ("dashboard,log", or "all"); empty when profiling is off."""
+    return {page.strip() for page in os.getenv("SLEEPAID_PROFILE", "").split(",") if page.strip()}
+
+def admin_uids():
+    """Users allowed to request a profile with ?profile=1 (SLEEPAID_ADMIN_UIDS, comma separated)."""
+    return {uid.strip() for uid in os.getenv("SLEEPAID_ADMIN_UIDS", "").split(",") if uid.strip()}
+
+def _label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    def __init__(self, thread_id, anchor, path, interval=SAMPLE_INTERVAL, max_seconds=MAX_SECONDS):
+        self.thread_id = thread_id
+        # Frames are recorded from here down; once it's off the stack the rerun is over
+        self.anchor = anchor
+        self.path = path
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.stacks = Counter()
+        self._thread = threading.Thread(target=self._run, name="sleepaid-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        """The script thread's stack from the anchor down, or None if the anchor is gone."""
+        frame = sys._current_frames().get(self.thread_id)
+        labels = []
+        while frame is not None:
+            labels.append(_label(frame))
+            if frame is self.anchor:
+                return ";".join(reversed(labels))
+            frame = frame.f_back
+        return None
+
+    def _run(self):
+        started = time.monotonic()
+        while time.monotonic() - started < self.max_seconds:
+            stack = self._sample()
+            if stack is None:
+                break
+            self.stacks[stack] += 1
+            time.sleep(self.interval)
+        self.anchor = None  # don't keep the script's frame (and its globals) alive
+        self.write(time.monotonic() - started)
+
+    def write(self, elapsed):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "w") as f:
+                for stack, count in self.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+        except OSError as e:
+            print(f"Warning: could not write profile {self.path}: {e}")
+            return
+        print(f"Profile written to {self.path} ({sum(self.stacks.values())} samples over {elapsed:.2f}s)")
+
+
+def profile_path(page, uid, profile_dir=None):
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    return os.path.join(profile_dir or PROFILE_DIR, f"{stamp}-{page}-{digest(uid)}.folded")
+
+def profile_rerun(page, uid):
+    """Profile the rest of the calling script's current run. Call it from the script's top level."""
+    anchor = sys._getframe(1)
+    return SamplingProfiler(threading.get_ident(), anchor, profile_path(page, uid)).start()
@@ -0,0 +1,259 @@
+"""
+Durable write-ahead queue.
+
+Writes waiting for Firestore are appended to a JSONL file before the page
+treats them as saved, so an outage or a restart doesn't lose a user's entry.
+The file is append-only: a `put` line per write and an `ack` line once it has
+reached Firestore. fsyncs are batched: a sync thread fsyncs whatever has been
+appended every FSYNC_INTERVAL and wakes every writer waiting on it, so a burst
+of submissions shares one fsync. On startup the file is replayed and anything
+without an ack is pending again; the file is rewritten with just the pending
+entries once it is mostly acks.
+
+A queue file belongs to one process, which holds an exclusive lock on it for
+as long as it runs: another process replaying it would re-send writes it never
+sees acked, and would lose its own appends when the owner compacts. Replicas
+on one host each claim a slot (`open_queue`), and pending writes left in a slot
+nobody holds any more are moved into the claiming process's queue.
+"""
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+FSYNC_INTERVAL = 0.02
+COMPACT_MIN_LINES = 1000
+MAX_SLOTS = 64       # queue files per path, i.e. processes on one host sharing it
+
+
+class QueueLocked(RuntimeError):
+    """Another live process owns the queue file."""
+
+
+def _write_key(job):
+    """Writes with the same key target the same document; only the newest one matters."""
+    return (job["kind"], job["uid"], job["key"])
+
+def slot_path(path, slot):
+    """data/write_queue.jsonl, data/write_queue.1.jsonl, ..."""
+    if not slot:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{slot}{ext}"
+
+def _claim(path):
+    """An open lock file for `path`, exclusively locked until it's closed (or the process exits)."""
+    lock_file = open(path + ".lock", "a+")
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        lock_file.close()
+        raise QueueLocked(f"{path} is in use by another process")
+    return lock_file
+
+def _read(path):
+    """Replay a queue file: (pending {seq: job} oldest first, highest seq, line count)."""
+    pending, last_seq, lines = {}, 0, 0
+    if not os.path.exists(path):
+        return pending, last_seq, lines
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A torn final line from a crash mid-append; its put was never acknowledged to the user
+                print(f"Warning: skipping unreadable write queue line in {path}")
+                continue
+            lines += 1
+            if entry["op"] == "put":
+                pending[entry["seq"]] = entry["job"]
+                last_seq = max(last_seq, entry["seq"])
+            elif entry["op"] == "ack":
+                for seq in entry["seqs"]:
+                    pending.pop(seq, None)
+    return pending, last_seq, lines
+
+
+class WriteQueue:
+    def __init__(self, path, fsync_interval=FSYNC_INTERVAL):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._synced = threading.Condition(self._lock)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Raises QueueLocked if another process has the file
+        self._lock_file = _claim(path)
+        # seq -> job, oldest first
+        self._pending, self._seq, self._lines = _read(path)
+        if self._pending:
+            print(f"Write queue: {len(self._pending)} pending writes recovered from {path}")
+        self._file = open(path, "a", encoding="utf-8")
+        self._written_seq = self._durable_seq = self._seq
+        threading.Thread(target=self._sync_loop, name="sleepaid-queue-fsync", daemon=True).start()
+
+    def _append(self, entry):
+        self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        self._file.flush()
+        self._lines += 1
+
+    def put(self, job):
+        """Append a write and return its sequence number once it is on disk."""
+        return self.put_many([job])[0]
+
+    def put_many(self, jobs):
+        """Append several writes under one lock and one fsync wait; returns their sequence numbers."""
+        seqs = []
+        with self._lock:
+            for job in jobs:
+                self._seq += 1
+                self._append({"op": "put", "seq": self._seq, "job": job})
+                self._pending[self._seq] = job
+                seqs.append(self._seq)
+            if not seqs:
+                return seqs
+            self._written_seq = seqs[-1]
+            while self._durable_seq < seqs[-1]:
+                self._synced.wait()
+        return seqs
+
+    def adopt(self, path):
+        """
+        Move the pending writes of an unowned queue file (a slot whose process has exited)
+        into this queue, then delete it. A write older than one already queued here for the
+        same document is dropped. Raises QueueLocked if the file is owned after all.
+        """
+        lock_file = _claim(path)
+        try:
+            pending = _read(path)[0]
+            with self._lock:
+                queued = {}
+                for job in self._pending.values():
+                    queued[_write_key(job)] = max(queued.get(_write_key(job), ""), job.get("queued_at", ""))
+            jobs = [job for job in pending.values() if job.get("queued_at", "") > queued.get(_write_key(job), "")]
+            self.put_many(jobs)
+            os.remove(path)
+        finally:
+            # The lock file stays: removing it could let two processes lock different inodes
+            lock_file.close()
+        if jobs:
+            print(f"Write queue: {len(jobs)} pending writes moved from {path} to {self.path}")
+        return len(jobs)
+
+    def ack(self, seqs):
+        """Mark writes as applied. Acks aren't waited on: replaying an applied write is harmless."""
+        if not seqs:
+            return
+        with self._lock:
+            self._append({"op": "ack", "seqs": list(seqs)})
+            for seq in seqs:
+                self._pending.pop(seq, None)
+            if self._lines >= COMPACT_MIN_LINES and self._lines > 2 * len(self._pending):
+                self._compact()
+
+    def _compact(self):
+        """Rewrite the file with only the pending puts (called with the lock held)."""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for seq, job in self._pending.items():
+                f.write(json.dumps({"op": "put", "seq": seq, "job": job}, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._lines = len(self._pending)
+        self._durable_seq = self._written_seq
+        self._synced.notify_all()
+
+    def peek(self, limit):
+        """
+        Up to `limit` pending writes, oldest first, as (seqs, job) pairs. Writes to the
+        same document are coalesced into the newest one; `seqs` lists every write it covers.
+        Writes put with the same "group" (one submit_many call) are never split: the batch
+        stops before a group that doesn't fit, unless it's the first, which comes whole.
+        """
+        with self._lock:
+            latest = {}      # document -> [seqs, newest job]
+            units = {}       # group (or a lone write's seq) -> its documents, oldest first
+            touched_by = {}  # document -> the units writing it
+            for seq, job in self._pending.items():
+                key = _write_key(job)
+                latest.setdefault(key, [[], None])[0].append(seq)
+                latest[key][1] = job
+                unit = job.get("group") or seq
+                if key not in units.setdefault(unit, []):
+                    units[unit].append(key)
+                touched_by.setdefault(key, []).append(unit)
+            chosen, taken = {}, set()
+            for unit in units:
+                if unit in taken:
+                    continue
+                # Coalescing ties a document's writes together, so their groups go as one
+                closure, todo = [], [unit]
+                while todo:
+                    u = todo.pop()
+                    if u in taken or u in closure:
+                        continue
+                    closure.append(u)
+                    for key in units[u]:
+                        todo.extend(touched_by[key])
+                keys = [key for u in closure for key in units[u] if key not in chosen]
+                if chosen and len(chosen) + len(set(keys)) > limit:
+                    break
+                taken.update(closure)
+                for key in keys:
+                    chosen[key] = True
+            return [(latest[key][0], latest[key][1]) for key in chosen]
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def pending_for(self, kind, uid):
+        """{key: data} of the newest pending write per document, for read-your-writes overlays."""
+        with self._lock:
+            return {job["key"]: dict(job["data"]) for job in self._pending.values() if job["kind"] == kind and job["uid"] == uid}
+
+    def _sync_loop(self):
+        while True:
+            time.sleep(self.fsync_interval)
+            with self._lock:
+                if self._written_seq <= self._durable_seq:
+                    continue
+                os.fsync(self._file.fileno())
+                self._durable_seq = self._written_seq
+                self._synced.notify_all()
+
+
+def open_queue(path, max_slots=MAX_SLOTS, fsync_interval=FSYNC_INTERVAL):
+    """
+    This process's WriteQueue: the first slot of `path` no live process holds. Pending
+    writes in the other unheld slots (left by processes that have exited) are moved into it.
+    """
+    queue = None
+    for slot in range(max_slots):
+        try:
+            queue = WriteQueue(slot_path(path, slot), fsync_interval)
+            break
+        except QueueLocked:
+            continue
+    if queue is None:
+        raise QueueLocked(f"All {max_slots} slots of {path} are in use")
+    for slot in range(max_slots):
+        other = slot_path(path, slot)
+        if other == queue.path or not os.path.exists(other):
+            continue
+        try:
+            queue.adopt(other)
+        except QueueLocked:
+            pass
+    return queue
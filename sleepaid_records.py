@@ -0,0 +1,190 @@
+"""
+Compact in-memory sleep log records: `LogRecord.from_dict` parses a Firestore
+log once into a __slots__ object of plain numbers and enum codes.
+"""
+from datetime import date
+import threading
+
+
+def parse_hhmm(value):
+    """'HH:MM' -> minutes since midnight, or None if it isn't a valid time."""
+    try:
+        hours, minutes = str(value).split(":")
+        hours, minutes = int(hours), int(minutes)
+    except (ValueError, AttributeError):
+        return None
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        return None
+    return hours * 60 + minutes
+
+def format_hhmm(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+def parse_date_ordinal(value):
+    """'YYYY-MM-DD' -> proleptic Gregorian ordinal, or None if it isn't a valid date."""
+    try:
+        return date.fromisoformat(str(value)).toordinal()
+    except ValueError:
+        return None
+
+
+# --- Enum tables for option labels ---
+class EnumTable:
+    """
+    Maps option labels to small integer codes. Labels we have never seen (old
+    form versions, hand-edited documents) are appended on first use, so codes
+    are stable within a process but are not a storage format.
+    """
+    def __init__(self, labels):
+        self.labels = list(labels)
+        self.codes = {label: i for i, label in enumerate(self.labels)}
+        self._lock = threading.Lock()
+
+    def code(self, label):
+        code = self.codes.get(label)
+        if code is None:
+            with self._lock:
+                code = self.codes.get(label)
+                if code is None:
+                    code = len(self.labels)
+                    self.labels.append(label)
+                    self.codes[label] = code
+        return code
+
+    def label(self, code):
+        return self.labels[code]
+
+    def codes_for(self, options):
+        """Multiselect values are lists; some older logs store a bare string."""
+        if not options:
+            return ()
+        if isinstance(options, str):
+            options = [options]
+        return tuple(self.code(option) for option in options)
+
+
+FEELINGS = EnumTable(["😴 Exhausted", "😐 Meh", "🙂 Refreshed", "💪 Energized", "😐 Okay", "Motivated"])
+ENVIRONMENT = EnumTable(["Room was cool", "Dark", "Quiet", "No screens", "No caffeine"])
+MENTAL_STATES = EnumTable(["Relaxed", "Neutral", "Stressed"])
+
+# Sentinel for a time field that is present but could not be parsed
+# (a missing field is None).
+INVALID_TIME = -1
+
+
+def has_valid_time(minutes):
+    """True for a parsed time field (not missing and not INVALID_TIME)."""
+    return minutes is not None and minutes != INVALID_TIME
+
+def _to_float(value, default=None):
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+def _to_int(value, default=None):
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+def _time_field(data, key):
+    if key not in data:
+        return None
+    minutes = parse_hhmm(data[key])
+    return INVALID_TIME if minutes is None else minutes
+
+
+class LogRecord:
+    """One night's log, parsed once. Optional fields are None when the log didn't record them."""
+    __slots__ = (
+        "ordinal",
+        "hours_slept",
+        "time_in_bed",
+        "time_to_fall_asleep",
+        "bed_minutes",
+        "wake_minutes",
+        "sleep_efficiency",
+        "feelings",
+        "woke_up_night",
+        "woke_up_times",
+        "quality_rating",
+        "environment",
+        "mental_state",
+        "notes",
+    )
+
+    @classmethod
+    def from_dict(cls, data):
+        record = cls.__new__(cls)
+        record.ordinal = parse_date_ordinal(data.get("date", ""))
+        record.hours_slept = _to_float(data.get("hours_slept"), 0.0)
+        record.time_in_bed = _to_float(data.get("time_in_bed"))
+        record.time_to_fall_asleep = _to_int(data.get("time_to_fall_asleep"))
+        record.bed_minutes = _time_field(data, "bed_time")
+        record.wake_minutes = _time_field(data, "wake_time")
+        record.sleep_efficiency = _to_float(data.get("sleep_efficiency"))
+        record.feelings = FEELINGS.codes_for(data.get("woke_up_feeling"))
+        record.woke_up_night = data.get("woke_up_night")
+        record.woke_up_times = _to_int(data.get("woke_up_times"), 0)
+        record.quality_rating = data.get("quality_rating")
+        # Environment is an unordered tag set, so a bitmask is enough
+        mask = 0
+        for code in ENVIRONMENT.codes_for(data.get("sleep_environment")):
+            mask |= 1 << code
+        record.environment = mask
+        record.mental_state = MENTAL_STATES.codes_for(data.get("mental_state"))
+        record.notes = data.get("notes") or ""
+        return record
+
+    @property
+    def date(self):
+        return date.fromordinal(self.ordinal).isoformat() if self.ordinal is not None else ""
+
+    @property
+    def environment_count(self):
+        return self.environment.bit_count()
+
+    def feeling_labels(self):
+        return [FEELINGS.label(code) for code in self.feelings]
+
+    def environment_labels(self):
+        return [ENVIRONMENT.label(code) for code in range(self.environment.bit_length()) if self.environment >> code & 1]
+
+    def mental_state_labels(self):
+        return [MENTAL_STATES.label(code) for code in self.mental_state]
+
+    def to_dict(self):
+        """The Firestore document shape (fields the log never had are left out)."""
+        data = {"date": self.date, "hours_slept": self.hours_slept}
+        optional = {
+            "time_in_bed": self.time_in_bed,
+            "time_to_fall_asleep": self.time_to_fall_asleep,
+            "bed_time": format_hhmm(self.bed_minutes) if has_valid_time(self.bed_minutes) else None,
+            "wake_time": format_hhmm(self.wake_minutes) if has_valid_time(self.wake_minutes) else None,
+            "sleep_efficiency": self.sleep_efficiency,
+            "woke_up_night": self.woke_up_night,
+            "quality_rating": self.quality_rating,
+        }
+        data.update({key: value for key, value in optional.items() if value is not None})
+        data["woke_up_feeling"] = self.feeling_labels()
+        data["woke_up_times"] = self.woke_up_times
+        data["sleep_environment"] = self.environment_labels()
+        data["mental_state"] = self.mental_state_labels()
+        data["notes"] = self.notes
+        return data
+
+    def __repr__(self):
+        return f"LogRecord({self.date!r}, hours_slept={self.hours_slept})"
+
+
+def as_record(log):
+    """Accept either a raw log dict or an already-parsed record."""
+    return log if isinstance(log, LogRecord) else LogRecord.from_dict(log)
+
+def records_from_dicts(logs):
+    return [LogRecord.from_dict(log) for log in logs]
@@ -0,0 +1,297 @@
+"""
+Config-driven sleep scoring.
+
+The rules (weights, bands and category maps) live in config/scoring_rules.json
+and are compiled once at import into lookup tables and sorted threshold arrays.
+`calculate_sleep_score` scores one log; `score_logs` scores many at once with
+NumPy using the very same tables, so both paths always agree.
+
+A profile may carry a partial `scoring_overrides` dict (same shape as the
+config) to tune the model for one user; each distinct override is compiled once.
+"""
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+import copy
+import json
+import os
+
+import numpy as np
+
+from sleepaid_cache import digest
+from sleepaid_profiles import NIGHT_WAKING_STRUGGLE
+from sleepaid_records import FEELINGS, INVALID_TIME, MENTAL_STATES, as_record, parse_hhmm
+from sleepaid_store import MISSING_TIME, LogColumns
+
+_this_dir = os.path.dirname(os.path.abspath(__file__))
+SCORING_RULES_PATH = os.getenv("SLEEPAID_SCORING_RULES", os.path.join(_this_dir, "config", "scoring_rules.json"))
+
+# Order matters: components are summed in this order so scalar and batch scores match exactly.
+COMPONENTS = ("duration", "latency", "wakeups", "energy", "consistency", "efficiency", "environment", "stress")
+
+
+def _leading_int(value, default):
+    digits = ""
+    for ch in str(value):
+        if not ch.isdigit():
+            break
+        digits += ch
+    return int(digits) if digits else default
+
+
+class Bands:
+    """
+    A threshold ladder: `points[i]` applies to values falling in band i.
+    inclusive="upper" means a value equal to a threshold belongs to the band below it
+    (e.g. "<= 15 min"), "lower" means it belongs to the band above (e.g. ">= 90%").
+    """
+    __slots__ = ("thresholds", "points", "_bisect", "_side", "_np_thresholds", "_np_points")
+
+    def __init__(self, spec):
+        thresholds = [float(t) for t in spec["thresholds"]]
+        points = [float(p) for p in spec["points"]]
+        inclusive = spec.get("inclusive", "upper")
+        if thresholds != sorted(thresholds):
+            raise ValueError(f"Band thresholds must be ascending: {thresholds}")
+        if len(points) != len(thresholds) + 1:
+            raise ValueError(f"Bands need one more point value than thresholds: {spec}")
+        if inclusive not in ("upper", "lower"):
+            raise ValueError(f"Unknown band inclusivity: {inclusive}")
+        self.thresholds = thresholds
+        self.points = points
+        self._bisect = bisect_left if inclusive == "upper" else bisect_right
+        self._side = "left" if inclusive == "upper" else "right"
+        self._np_thresholds = np.asarray(thresholds)
+        self._np_points = np.asarray(points)
+
+    def lookup(self, value):
+        return self.points[self._bisect(self.thresholds, value)]
+
+    def lookup_many(self, values):
+        return self._np_points[np.searchsorted(self._np_thresholds, values, side=self._side)]
+
+
+class CategoryPoints:
+    """Points per enum code for a single-choice field, indexed by the record's first code."""
+    __slots__ = ("table", "default_code", "other", "_np_table")
+
+    def __init__(self, spec, enum_table):
+        self.default_code = enum_table.code(spec["default"])
+        self.other = float(spec["other_points"])
+        codes = {enum_table.code(label): float(points) for label, points in spec["points"].items()}
+        self.table = [codes.get(code, self.other) for code in range(len(enum_table.labels))]
+        # One extra slot so codes registered after compiling map to `other`
+        self._np_table = np.asarray(self.table + [self.other])
+
+    def lookup(self, codes):
+        code = codes[0] if codes else self.default_code
+        return self.table[code] if code < len(self.table) else self.other
+
+    def lookup_many(self, first_codes):
+        """Vectorized lookup over a column of first codes (-1 = nothing chosen)."""
+        codes = np.where(first_codes < 0, self.default_code, first_codes)
+        return self._np_table[np.minimum(codes, len(self.table))]
+
+
+class ScoringModel:
+    """Compiled form of a scoring rules dict."""
+
+    def __init__(self, rules):
+        self.version = rules.get("version", 1)
+        unknown = set(rules["weights"]) - set(COMPONENTS)
+        if unknown:
+            raise ValueError(f"Unknown scoring components: {sorted(unknown)}")
+        self.weights = {name: float(rules["weights"].get(name, 0)) for name in COMPONENTS}
+
+        duration = rules["duration"]
+        self.goal_ranges = {goal: (float(lo), float(hi)) for goal, (lo, hi) in duration["goal_ranges"].items()}
+        self.default_goal_range = self.goal_ranges[duration["default_goal"]]
+        self.duration_bands = Bands(duration["hours_outside_goal"])
+
+        self.default_latency_goal = float(rules["latency"]["default_goal_minutes"])
+        self.latency_bands = Bands(rules["latency"]["minutes_over_goal"])
+
+        self.wakeup_bands = Bands(rules["wakeups"]["count"])
+        self.wakeup_distance_bands = Bands(rules["wakeups"]["distance_from_usual"])
+
+        self.energy_points = CategoryPoints(rules["energy"], FEELINGS)
+
+        self.default_bedtime = parse_hhmm(rules["consistency"]["default_bedtime"])
+        self.consistency_bands = Bands(rules["consistency"]["minutes_from_usual"])
+
+        self.efficiency_bands = Bands(rules["efficiency"]["percent"])
+
+        self.max_environment_factors = int(rules["environment"]["max_factors"])
+
+        self.stress_points = CategoryPoints(rules["stress"], MENTAL_STATES)
+
+    # --- Per-user parameters ---
+    def profile_params(self, user_profile):
+        """Pull the personal goals the bands are measured against out of a (canonical) profile's sleep_patterns."""
+        sleep_patterns = (user_profile or {}).get("sleep_patterns", {}) or {}
+        min_goal, max_goal = self.goal_ranges.get(sleep_patterns.get("sleep_duration_goal"), self.default_goal_range)
+        usual_bedtime = parse_hhmm(sleep_patterns.get("usual_bedtime", "")) if sleep_patterns.get("usual_bedtime") else self.default_bedtime
+        return {
+            "min_goal": min_goal,
+            "max_goal": max_goal,
+            "latency_goal": float(sleep_patterns.get("time_to_fall_asleep", self.default_latency_goal)),
+            "wakes_up_at_night": sleep_patterns.get("struggle") == NIGHT_WAKING_STRUGGLE,
+            "usual_wakeups": _leading_int(sleep_patterns.get("wake_up_count", "0"), 1),
+            "usual_bedtime": usual_bedtime,
+        }
+
+    # --- Scalar evaluation ---
+    def components(self, record, user_profile, consistency, params=None):
+        """Points (0-100, before weighting) earned by each component for one LogRecord."""
+        params = params or self.profile_params(user_profile)
+        hours = record.hours_slept
+        if hours < params["min_goal"]:
+            outside = params["min_goal"] - hours
+        elif hours > params["max_goal"]:
+            outside = hours - params["max_goal"]
+        else:
+            outside = 0.0
+
+        latency = record.time_to_fall_asleep if record.time_to_fall_asleep is not None else 15
+        wakeups = record.woke_up_times
+        if params["wakes_up_at_night"]:
+            wakeup_points = self.wakeup_distance_bands.lookup(abs(wakeups - params["usual_wakeups"]))
+        else:
+            wakeup_points = self.wakeup_bands.lookup(wakeups)
+
+        log_bedtime = record.bed_minutes if record.bed_minutes is not None else params["usual_bedtime"]
+        if log_bedtime is None or log_bedtime == INVALID_TIME or params["usual_bedtime"] is None:
+            bedtime_diff = consistency
+        else:
+            bedtime_diff = abs(log_bedtime - params["usual_bedtime"])
+
+        time_in_bed = record.time_in_bed if record.time_in_bed is not None else (hours if hours > 0 else 8)
+        efficiency = (hours / time_in_bed) * 100 if time_in_bed > 0 else 0
+
+        environment = min(record.environment_count, self.max_environment_factors)
+
+        return {
+            "duration": self.duration_bands.lookup(outside),
+            "latency": self.latency_bands.lookup(latency - params["latency_goal"]),
+            "wakeups": wakeup_points,
+            "energy": self.energy_points.lookup(record.feelings),
+            "consistency": self.consistency_bands.lookup(bedtime_diff),
+            "efficiency": self.efficiency_bands.lookup(efficiency),
+            "environment": environment / self.max_environment_factors * 100,
+            "stress": self.stress_points.lookup(record.mental_state),
+        }
+
+    def score(self, record, user_profile, consistency, params=None):
+        points = self.components(record, user_profile, consistency, params)
+        score = 0
+        for name in COMPONENTS:
+            score += points[name] * self.weights[name]
+        return int(min(score, 100))
+
+    # --- Batch evaluation ---
+    def score_many(self, records, user_profile, consistencies=None):
+        """Scores for a list of LogRecords; returns an int array aligned with `records`."""
+        return self.score_columns(LogColumns.from_records(records), user_profile, consistencies)
+
+    def score_columns(self, cols, user_profile, consistencies=None):
+        """Scores for LogColumns (e.g. a LogStore slice); returns an int array aligned with the rows."""
+        n = len(cols)
+        if n == 0:
+            return np.zeros(0, dtype=int)
+        params = self.profile_params(user_profile)
+        if consistencies is None:
+            consistencies = np.zeros(n)
+        consistencies = np.asarray(consistencies, dtype=float)
+
+        hours = cols.hours_slept
+        latency = np.where(np.isnan(cols.time_to_fall_asleep), 15.0, cols.time_to_fall_asleep)
+        wakeups = cols.woke_up_times.astype(float)
+        time_in_bed = np.where(np.isnan(cols.time_in_bed), np.where(hours > 0, hours, 8.0), cols.time_in_bed)
+        environment = np.minimum(cols.environment_count.astype(float), self.max_environment_factors)
+        # NaN marks a bedtime that can't be compared; those fall back to the supplied consistency.
+        usual_bedtime = params["usual_bedtime"]
+        if usual_bedtime is None:
+            bedtimes = np.full(n, np.nan)
+        else:
+            bedtimes = np.where(cols.bed_minutes == MISSING_TIME, usual_bedtime, cols.bed_minutes).astype(float)
+            bedtimes[bedtimes == INVALID_TIME] = np.nan
+
+        outside = np.where(hours < params["min_goal"], params["min_goal"] - hours,
+                           np.where(hours > params["max_goal"], hours - params["max_goal"], 0.0))
+        if params["wakes_up_at_night"]:
+            wakeup_points = self.wakeup_distance_bands.lookup_many(np.abs(wakeups - params["usual_wakeups"]))
+        else:
+            wakeup_points = self.wakeup_bands.lookup_many(wakeups)
+        bedtime_diff = np.where(np.isnan(bedtimes), consistencies, np.abs(bedtimes - (usual_bedtime or 0)))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            efficiency = np.where(time_in_bed > 0, (hours / time_in_bed) * 100, 0.0)
+
+        points = {
+            "duration": self.duration_bands.lookup_many(outside),
+            "latency": self.latency_bands.lookup_many(latency - params["latency_goal"]),
+            "wakeups": wakeup_points,
+            "energy": self.energy_points.lookup_many(cols.feeling_code),
+            "consistency": self.consistency_bands.lookup_many(bedtime_diff),
+            "efficiency": self.efficiency_bands.lookup_many(efficiency),
+            "environment": environment / self.max_environment_factors * 100,
+            "stress": self.stress_points.lookup_many(cols.mental_code),
+        }
+        score = np.zeros(n)
+        for name in COMPONENTS:
+            score += points[name] * self.weights[name]
+        return np.minimum(score, 100).astype(int)
+
+
+# --- Loading and per-user overrides ---
+def load_scoring_rules(path=SCORING_RULES_PATH):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _merge_rules(base, overrides):
+    merged = copy.deepcopy(base)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge_rules(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+BASE_RULES = load_scoring_rules()
+BASE_MODEL = ScoringModel(BASE_RULES)
+
+@lru_cache(maxsize=256)
+def _compile_overrides(overrides_json):
+    return ScoringModel(_merge_rules(BASE_RULES, json.loads(overrides_json)))
+
+def get_scoring_model(user_profile):
+    """The compiled model for a user: the base rules plus any `scoring_overrides` on their profile."""
+    overrides = (user_profile or {}).get("scoring_overrides")
+    if not overrides or not isinstance(overrides, dict):
+        return BASE_MODEL
+    return _compile_overrides(json.dumps(overrides, sort_keys=True))
+
+def scoring_fingerprint(user_profile):
+    """Changes whenever a user's scoring inputs do (rules, overrides, goal, usual bedtime...), so stored scores can be recognised as stale."""
+    model = get_scoring_model(user_profile)
+    return digest([model.version, (user_profile or {}).get("scoring_overrides"), model.profile_params(user_profile)])
+
+
+# --- Public API ---
+def calculate_sleep_score(log, user_profile, consistency):
+    """
+    Personalized sleep score based on user onboarding preferences and daily log.
+    Args:
+        log (LogRecord | dict): The sleep log for the day.
+        user_profile (dict): The user's onboarding profile.
+        consistency (float): Minutes difference in bedtime from previous day.
+    Returns:
+        int: Sleep score (0-100)
+    """
+    return get_scoring_model(user_profile).score(as_record(log), user_profile or {}, consistency)
+
+def score_logs(records, user_profile, consistencies=None):
+    """Batch version of calculate_sleep_score over LogRecords; returns a list of ints aligned with `records`."""
+    return get_scoring_model(user_profile).score_many(records, user_profile or {}, consistencies).tolist()
+
+def score_columns(cols, user_profile, consistencies=None):
+    """Batch scores straight from LogStore columns, without materializing records."""
+    return get_scoring_model(user_profile).score_columns(cols, user_profile or {}, consistencies)
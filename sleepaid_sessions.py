@@ -0,0 +1,157 @@
+"""
+Process-wide memory for per-session derived data (LogStore, PrefixIndex): sized
+entries, evicted from the longest-idle sessions past a ceiling, and dropped with
+the session's `SessionHandle`.
+"""
+import os
+import sys
+import threading
+import time
+import uuid
+import weakref
+
+import numpy as np
+
+MEMORY_CEILING = int(float(os.getenv("SLEEPAID_SESSION_MEMORY_MB", "256")) * 1024 * 1024)
+IDLE_SECONDS = float(os.getenv("SLEEPAID_SESSION_IDLE_SECONDS", "600"))
+
+
+def approximate_size(value):
+    """Deep size in bytes: containers and objects (__dict__ or __slots__) recursively, NumPy arrays with their data."""
+    seen = set()
+    total = 0
+    stack = [value]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, (type, type(sys), type(approximate_size))):
+            continue
+        seen.add(id(obj))
+        # ndarray's __sizeof__ includes the data it owns, and only the header for views
+        total += sys.getsizeof(obj)
+        if isinstance(obj, (str, bytes, int, float, bool, np.ndarray, np.generic)) or obj is None:
+            continue
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        else:
+            if hasattr(obj, "__dict__"):
+                stack.append(vars(obj))
+            for cls in type(obj).__mro__:
+                for name in cls.__dict__.get("__slots__", ()):
+                    if name != "__weakref__" and hasattr(obj, name):
+                        stack.append(getattr(obj, name))
+    return total
+
+def _version(value):
+    """Objects that change in place (LogStore) expose a version; their size is re-measured when it moves."""
+    return getattr(value, "version", None)
+
+
+class SessionHandle:
+    """Kept in st.session_state; when Streamlit drops the session, the handle goes and its entries with it."""
+    __slots__ = ("session_id", "__weakref__")
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+
+
+class SessionMemory:
+    def __init__(self, ceiling=MEMORY_CEILING, idle_seconds=IDLE_SECONDS):
+        self.ceiling = ceiling
+        self.idle_seconds = idle_seconds
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # session id -> {"last_seen": monotonic time, "entries": {name: [tag, value, size, version]}}
+        self._sessions = {}
+        self._total = 0
+
+    def open_session(self):
+        handle = SessionHandle(uuid.uuid4().hex)
+        with self._lock:
+            self._sessions[handle.session_id] = {"last_seen": time.monotonic(), "entries": {}}
+        weakref.finalize(handle, self.close_session, handle.session_id)
+        return handle
+
+    def close_session(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session:
+                self._total -= sum(entry[2] for entry in session["entries"].values())
+
+    def _session(self, handle):
+        # A handle whose entries were evicted wholesale gets a fresh record
+        session = self._sessions.setdefault(handle.session_id, {"last_seen": 0.0, "entries": {}})
+        session["last_seen"] = time.monotonic()
+        return session
+
+    def get(self, handle, name, tag=None):
+        """The value stored under `name` for this session, or None if it's missing, evicted or has another tag."""
+        with self._lock:
+            entry = self._session(handle)["entries"].get(name)
+            if entry is None or entry[0] != tag:
+                return None
+            value = entry[1]
+            if _version(value) != entry[3]:
+                size = approximate_size(value)
+                self._total += size - entry[2]
+                entry[2], entry[3] = size, _version(value)
+            self._evict(handle.session_id)
+            return value
+
+    def put(self, handle, name, value, tag=None):
+        """Store `value` (replacing any earlier one) and evict idle sessions if that passes the ceiling."""
+        size = approximate_size(value)
+        with self._lock:
+            entries = self._session(handle)["entries"]
+            if name in entries:
+                self._total -= entries[name][2]
+            entries[name] = [tag, value, size, _version(value)]
+            self._total += size
+            self._evict(handle.session_id)
+        return value
+
+    def _evict(self, current_id):
+        if self._total <= self.ceiling:
+            return
+        now = time.monotonic()
+        idle = sorted((s["last_seen"], sid) for sid, s in self._sessions.items()
+                      if sid != current_id and s["entries"] and now - s["last_seen"] >= self.idle_seconds)
+        freed, sessions = 0, 0
+        for _, sid in idle:
+            if self._total <= self.ceiling:
+                break
+            entries = self._sessions[sid]["entries"]
+            size = sum(entry[2] for entry in entries.values())
+            entries.clear()
+            self._total -= size
+            freed += size
+            sessions += 1
+        if sessions:
+            self.evictions += sessions
+            print(f"Session memory: evicted {freed / 1024:.0f} KB from {sessions} idle sessions "
+                  f"({self._total / 1024 / 1024:.1f} of {self.ceiling / 1024 / 1024:.1f} MB in use)")
+
+    def usage(self):
+        """{"total": bytes, "ceiling": bytes, "sessions": {session id: {name: bytes}}}, for monitoring."""
+        with self._lock:
+            return {
+                "total": self._total,
+                "ceiling": self.ceiling,
+                "sessions": {sid: {name: entry[2] for name, entry in s["entries"].items()}
+                             for sid, s in self._sessions.items()},
+            }
+
+
+_memory = None
+_memory_lock = threading.Lock()
+
+def get_session_memory():
+    """The process-wide SessionMemory, sized by SLEEPAID_SESSION_MEMORY_MB."""
+    global _memory
+    if _memory is None:
+        with _memory_lock:
+            if _memory is None:
+                _memory = SessionMemory()
+    return _memory
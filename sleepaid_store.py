@@ -0,0 +1,178 @@
+"""
+Columnar in-memory log store: one user's LogRecords as parallel NumPy arrays
+sorted by date ordinal, sliced as views and grown by doubling.
+"""
+import numpy as np
+
+# Time columns are small ints: minutes since midnight, INVALID_TIME (-1, from
+# sleepaid_records) for an unparseable value, or MISSING_TIME when absent.
+MISSING_TIME = -2
+
+# name -> (dtype, fill value for a missing field)
+COLUMNS = {
+    "ordinal": (np.int32, 0),
+    "hours_slept": (np.float64, 0.0),
+    "time_in_bed": (np.float64, np.nan),
+    "time_to_fall_asleep": (np.float64, np.nan),
+    "bed_minutes": (np.int16, MISSING_TIME),
+    "wake_minutes": (np.int16, MISSING_TIME),
+    "sleep_efficiency": (np.float64, np.nan),
+    "woke_up_times": (np.int16, 0),
+    "quality_rating": (np.float64, np.nan),
+    "environment": (np.uint32, 0),
+    "environment_count": (np.int8, 0),
+    "feeling_code": (np.int16, -1),
+    "mental_code": (np.int16, -1),
+}
+
+
+def _row(record):
+    """Column values for one record, in COLUMNS order."""
+    def opt(value, fill):
+        return fill if value is None else value
+    try:
+        quality = float(record.quality_rating) if record.quality_rating is not None else np.nan
+    except (TypeError, ValueError):
+        quality = np.nan
+    return (
+        record.ordinal if record.ordinal is not None else 0,
+        record.hours_slept,
+        opt(record.time_in_bed, np.nan),
+        opt(record.time_to_fall_asleep, np.nan),
+        opt(record.bed_minutes, MISSING_TIME),
+        opt(record.wake_minutes, MISSING_TIME),
+        opt(record.sleep_efficiency, np.nan),
+        record.woke_up_times,
+        quality,
+        record.environment,
+        record.environment_count,
+        record.feelings[0] if record.feelings else -1,
+        record.mental_state[0] if record.mental_state else -1,
+    )
+
+
+class LogColumns:
+    """
+    A set of aligned column arrays plus the records they came from.
+    Instances returned by LogStore are views into the store's buffers: treat them as read-only.
+    """
+    __slots__ = tuple(COLUMNS) + ("records",)
+
+    def __init__(self, arrays, records):
+        for name in COLUMNS:
+            setattr(self, name, arrays[name])
+        self.records = records
+
+    @classmethod
+    def from_records(cls, records):
+        """Columns in the same order as `records` (no sorting), e.g. for batch scoring a list."""
+        rows = [_row(r) for r in records]
+        arrays = {}
+        for i, (name, (dtype, _)) in enumerate(COLUMNS.items()):
+            arrays[name] = np.fromiter((row[i] for row in rows), dtype=dtype, count=len(rows))
+        return cls(arrays, list(records))
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def bed_valid(self):
+        return self.bed_minutes >= 0
+
+    @property
+    def wake_valid(self):
+        return self.wake_minutes >= 0
+
+
+class LogStore:
+    """One user's dated logs as growable column buffers, kept sorted by ordinal (one log per day)."""
+
+    def __init__(self, capacity=64):
+        self._size = 0
+        self._buffers = {name: np.full(capacity, fill, dtype=dtype) for name, (dtype, fill) in COLUMNS.items()}
+        self._records = [None] * capacity
+        # Bumped on every append, so indexes derived from the store know when to rebuild
+        self.version = 0
+        # Logs whose date couldn't be parsed can't be placed on the timeline; kept for history/export.
+        self.undated = []
+
+    @classmethod
+    def from_records(cls, records):
+        dated = sorted((r for r in records if r.ordinal is not None), key=lambda r: r.ordinal)
+        store = cls(capacity=max(64, len(dated) * 2))
+        for record in dated:
+            store.append(record)
+        store.undated = [r for r in records if r.ordinal is None]
+        return store
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def nbytes(self):
+        return sum(buf.nbytes for buf in self._buffers.values())
+
+    def _grow(self):
+        capacity = len(self._records) * 2
+        for name, (dtype, fill) in COLUMNS.items():
+            buf = np.full(capacity, fill, dtype=dtype)
+            buf[:self._size] = self._buffers[name][:self._size]
+            self._buffers[name] = buf
+        self._records.extend([None] * (capacity - len(self._records)))
+
+    def append(self, record):
+        """
+        Add or replace the log for `record`'s day. Appending the newest day is O(1)
+        amortized; a backfilled older day shifts the later rows along.
+        """
+        if record.ordinal is None:
+            self.undated.append(record)
+            return
+        self.version += 1
+        ordinals = self._buffers["ordinal"][:self._size]
+        pos = int(np.searchsorted(ordinals, record.ordinal))
+        row = _row(record)
+        if pos < self._size and ordinals[pos] == record.ordinal:
+            # Same day logged again: overwrite in place
+            for i, name in enumerate(COLUMNS):
+                self._buffers[name][pos] = row[i]
+            self._records[pos] = record
+            return
+        if self._size == len(self._records):
+            self._grow()
+        if pos < self._size:
+            for name in COLUMNS:
+                buf = self._buffers[name]
+                buf[pos + 1:self._size + 1] = buf[pos:self._size]
+            self._records[pos + 1:self._size + 1] = self._records[pos:self._size]
+        for i, name in enumerate(COLUMNS):
+            self._buffers[name][pos] = row[i]
+        self._records[pos] = record
+        self._size += 1
+
+    def _view(self, start, stop):
+        arrays = {name: buf[start:stop] for name, buf in self._buffers.items()}
+        return LogColumns(arrays, self._records[start:stop])
+
+    def view(self):
+        """All dated logs, oldest first."""
+        return self._view(0, self._size)
+
+    def slice(self, start_ordinal, end_ordinal):
+        """Logs dated within [start_ordinal, end_ordinal], oldest first."""
+        ordinals = self._buffers["ordinal"][:self._size]
+        start = int(np.searchsorted(ordinals, start_ordinal, side="left"))
+        stop = int(np.searchsorted(ordinals, end_ordinal, side="right"))
+        return self._view(start, stop)
+
+    def tail(self, n):
+        """The `n` most recent logs, oldest first."""
+        return self._view(max(0, self._size - n), self._size)
+
+    def newest_first(self, n=None):
+        """Records newest first (the order Firestore queries return), optionally only the latest `n`."""
+        start = 0 if n is None else max(0, self._size - n)
+        return self._records[start:self._size][::-1]
+
+    def latest(self):
+        return self._records[self._size - 1] if self._size else None
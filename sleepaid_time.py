@@ -0,0 +1,62 @@
+"""
+Timezone-aware day bucketing.
+
+A log belongs to the user's local "sleep day", not the server's calendar day:
+we convert to the user's zone and treat anything before the cutoff hour
+(default 4am) as part of the previous day, so logging at 1am after a late
+night still lands on the right date. Zone objects are cached per process.
+"""
+from datetime import datetime, timedelta
+from functools import lru_cache
+import os
+
+import pytz
+
+DAY_CUTOFF_HOUR = int(os.getenv("SLEEPAID_DAY_CUTOFF_HOUR", "4"))
+
+# Built once: the timezone selectboxes look up the saved zone's position here
+# instead of scanning the ~600-entry list on every render.
+TIMEZONES = list(pytz.all_timezones)
+TIMEZONE_INDEX = {name: i for i, name in enumerate(TIMEZONES)}
+
+
+@lru_cache(maxsize=None)
+def get_zone(name):
+    """Cached pytz zone; unknown or empty names fall back to UTC."""
+    try:
+        return pytz.timezone(name or "UTC")
+    except pytz.UnknownTimeZoneError:
+        return pytz.utc
+
+def timezone_index(name, default="UTC"):
+    """Selectbox index for a saved timezone name."""
+    return TIMEZONE_INDEX.get(name, TIMEZONE_INDEX.get(default, 0))
+
+def user_timezone_name(user_profile):
+    return ((user_profile or {}).get('personal_info', {}) or {}).get('timezone') or 'UTC'
+
+def sleep_day(moment=None, tz_name="UTC", cutoff_hour=DAY_CUTOFF_HOUR):
+    """
+    The local sleep day a moment falls in.
+    moment: an aware datetime (naive ones are taken as UTC); defaults to now.
+    """
+    if moment is None:
+        moment = datetime.now(pytz.utc)
+    elif moment.tzinfo is None:
+        moment = pytz.utc.localize(moment)
+    local = moment.astimezone(get_zone(tz_name))
+    if local.hour < cutoff_hour:
+        local -= timedelta(days=1)
+    return local.date()
+
+def user_today(user_profile, moment=None):
+    """Today's sleep day for a user, per the timezone saved on their profile."""
+    return sleep_day(moment, user_timezone_name(user_profile))
+
+def next_sleep_day(user_profile, moment=None):
+    """The sleep day starting at the user's next cutoff: the one they next wake into."""
+    return sleep_day(moment, user_timezone_name(user_profile)) + timedelta(days=1)
+
+def last_n_days(today, n):
+    """The `n` sleep days ending with `today`, oldest first."""
+    return [today - timedelta(days=i) for i in range(n - 1, -1, -1)]
@@ -0,0 +1,113 @@
+"""
+Long-range trend series.
+
+Builds the data behind the profile page's trend explorer from LogStore columns:
+pick a metric, a window (30/90/365 days or all time) and a bucket size (daily,
+weekly, monthly), and get back per-bucket means computed with NumPy. Series that
+are still longer than MAX_POINTS are downsampled with Largest-Triangle-Three-
+Buckets (LTTB), which keeps the visual shape (peaks, dips) while bounding what
+is sent to Plotly, so an all-time daily chart for a years-long history renders
+as fast as a month.
+"""
+from datetime import date
+
+import numpy as np
+
+RANGES = {"30 days": 30, "90 days": 90, "1 year": 365, "All time": None}
+BUCKETS = ("Daily", "Weekly", "Monthly")
+# Metric label -> LogStore column (None: the batch sleep scores)
+METRICS = {
+    "Sleep score": None,
+    "Hours slept": "hours_slept",
+    "Time to fall asleep (min)": "time_to_fall_asleep",
+    "Wakeups": "woke_up_times",
+}
+MAX_POINTS = 400
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def default_bucket(days):
+    """A bucket size that keeps the chart readable for the window."""
+    if days is not None and days <= 90:
+        return "Daily"
+    if days is not None and days <= 365:
+        return "Weekly"
+    return "Monthly"
+
+def metric_values(cols, metric, scores=None):
+    """The metric for each row of `cols` as float64, NaN where the log didn't record it."""
+    column = METRICS[metric]
+    if column is None:
+        return np.asarray(scores, dtype=np.float64)
+    return getattr(cols, column).astype(np.float64)
+
+def bucket_starts(ordinals, bucket):
+    """The ordinal of the first day of each row's bucket (weeks start on Monday)."""
+    ordinals = np.asarray(ordinals, dtype=np.int64)
+    if bucket == "Daily":
+        return ordinals
+    if bucket == "Weekly":
+        # Ordinal 1 (0001-01-01) was a Monday
+        return ordinals - (ordinals - 1) % 7
+    if bucket == "Monthly":
+        months = (ordinals - _EPOCH_ORDINAL).astype("datetime64[D]").astype("datetime64[M]")
+        return months.astype("datetime64[D]").astype(np.int64) + _EPOCH_ORDINAL
+    raise ValueError(f"Unknown bucket: {bucket}")
+
+def resample(ordinals, values, bucket):
+    """
+    Mean of `values` per bucket, ignoring NaNs.
+    Returns (bucket start ordinals, means, counts of logged values); buckets with no values are dropped.
+    """
+    starts = bucket_starts(ordinals, bucket)
+    values = np.asarray(values, dtype=np.float64)
+    keys, inverse = np.unique(starts, return_inverse=True)
+    present = ~np.isnan(values)
+    counts = np.bincount(inverse, weights=present, minlength=len(keys))
+    sums = np.bincount(inverse, weights=np.where(present, values, 0.0), minlength=len(keys))
+    keep = counts > 0
+    return keys[keep], sums[keep] / counts[keep], counts[keep].astype(np.int64)
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling. Returns the indices of the points to
+    keep (always including the first and last), at most `threshold` of them.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # Interior points split into threshold - 2 buckets
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    keep = np.empty(threshold, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, stop = edges[i], edges[i + 1]
+        # Average of the next bucket (or the last point) is the triangle's third vertex
+        next_start, next_stop = stop, edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[next_start:next_stop].mean()
+        avg_y = y[next_start:next_stop].mean()
+        areas = np.abs((x[a] - avg_x) * (y[start:stop] - y[a]) - (x[a] - x[start:stop]) * (avg_y - y[a]))
+        a = start + int(np.argmax(areas))
+        keep[i + 1] = a
+    return keep
+
+def trend_series(cols, scores, metric, days, bucket, today, max_points=MAX_POINTS):
+    """
+    Points for one trend chart.
+    cols/scores: a LogStore view (oldest first) and its batch scores.
+    Returns (dates as datetime64[D], values, logged-day counts), at most `max_points` long.
+    """
+    ordinals = cols.ordinal.astype(np.int64)
+    values = metric_values(cols, metric, scores)
+    if days is not None:
+        in_window = ordinals > today.toordinal() - days
+        ordinals, values = ordinals[in_window], values[in_window]
+    starts, means, counts = resample(ordinals, values, bucket)
+    if len(starts) > max_points:
+        keep = lttb(starts, means, max_points)
+        starts, means, counts = starts[keep], means[keep], counts[keep]
+    return (starts - _EPOCH_ORDINAL).astype("datetime64[D]"), means, counts
@@ -0,0 +1,161 @@
+"""
+Nightly precompute worker.
+
+Walks `user_profiles` in pages and, for every user, precomputes streaks, the
+7- and 30-day stats and the next day's suggestion into `user_rollups/{uid}`.
+The dashboard reads that document instead of recomputing on the morning load.
+
+The run is a single pass over every timezone, so each rollup is computed for
+the sleep day that starts at its user's next 4am cutoff, the one they next wake
+into (sleepaid_time.next_sleep_day), whatever their local time when the run
+reaches them. The dashboard only uses a rollup on the day it was computed for,
+and computes live otherwise (e.g. for a user who logs before looking).
+
+Progress is checkpointed after every page, so an interrupted run picks up
+where it stopped:
+
+    python sleepaid_worker.py --credentials path/to/key.json --workers 8
+    python sleepaid_worker.py --credentials path/to/key.json --reset   # start over
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import openai
+from dotenv import load_dotenv
+
+from sleepaid_ai import generate_gpt_suggestion, rule_based_suggestion
+from sleepaid_analytics import build_rollup
+from sleepaid_firebase import connect
+from sleepaid_codec import record_from_document
+from sleepaid_profiles import canonicalize_profile
+from sleepaid_time import next_sleep_day
+
+_this_dir = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CHECKPOINT = os.path.join(_this_dir, "data", "worker_checkpoint.json")
+
+
+# --- Checkpointing ---
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        print(f"Warning: ignoring unreadable checkpoint {path}")
+        return {}
+
+def save_checkpoint(path, checkpoint):
+    """Write the checkpoint atomically so a crash never leaves half a file behind."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# --- Firestore access ---
+def iter_profile_pages(db, page_size, start_after_uid=None):
+    """Yield lists of profile snapshots, ordered by document id."""
+    collection = db.collection('user_profiles')
+    cursor = None
+    if start_after_uid:
+        snapshot = collection.document(start_after_uid).get()
+        if snapshot.exists:
+            cursor = snapshot
+    while True:
+        query = collection.order_by('__name__').limit(page_size)
+        if cursor is not None:
+            query = query.start_after(cursor)
+        page = list(query.stream())
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        cursor = page[-1]
+
+def load_logs_for(db, uid):
+    logs_ref = db.collection('users').document(uid).collection('sleep_logs').order_by('date', direction="DESCENDING").stream()
+    return [record_from_document(log.to_dict()) for log in logs_ref]
+
+
+# --- Per-user work ---
+def precompute_user(db, snapshot, use_gpt):
+    uid = snapshot.id
+    # Scored exactly as the app scores it (get_user_profile canonicalizes too)
+    user_profile = canonicalize_profile(snapshot.to_dict() or {})
+    records = load_logs_for(db, uid)
+    # Bucketed by the user's own sleep day, not the server's date: the one they wake into
+    # next, not the one that's ending (which the dashboard will never ask for again)
+    rollup = build_rollup(records, user_profile, next_sleep_day(user_profile))
+    if use_gpt and records:
+        rollup["suggestion"] = generate_gpt_suggestion(rollup["today_score"], records[0], user_profile, records)
+    else:
+        rollup["suggestion"] = rule_based_suggestion(rollup["today_score"])
+    db.collection('user_rollups').document(uid).set(rollup)
+    return uid
+
+
+def run(db, page_size, workers, checkpoint_path, use_gpt, reset=False):
+    checkpoint = {} if reset else load_checkpoint(checkpoint_path)
+    today = datetime.now().date()
+    # A checkpoint from an earlier day is stale: every user needs a fresh rollup.
+    if checkpoint.get("as_of") != today.isoformat():
+        checkpoint = {}
+    checkpoint.setdefault("as_of", today.isoformat())
+    checkpoint.setdefault("processed", 0)
+    checkpoint.setdefault("failed", [])
+    started = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for page in iter_profile_pages(db, page_size, checkpoint.get("last_uid")):
+            futures = {pool.submit(precompute_user, db, snap, use_gpt): snap.id for snap in page}
+            for future in as_completed(futures):
+                uid = futures[future]
+                try:
+                    future.result()
+                    checkpoint["processed"] += 1
+                except Exception as e:
+                    print(f"Error precomputing {uid}: {e}")
+                    checkpoint["failed"].append(uid)
+            # Only advance past a page once all of it is done.
+            checkpoint["last_uid"] = page[-1].id
+            checkpoint["updated_at"] = datetime.now().isoformat()
+            save_checkpoint(checkpoint_path, checkpoint)
+            print(f"Page done through {checkpoint['last_uid']} ({checkpoint['processed']} users, {len(checkpoint['failed'])} failed)")
+
+    checkpoint["completed_at"] = datetime.now().isoformat()
+    save_checkpoint(checkpoint_path, checkpoint)
+    print(f"Finished in {time.monotonic() - started:.1f}s: {checkpoint['processed']} users, {len(checkpoint['failed'])} failed")
+    return checkpoint
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Precompute SleepAId dashboard rollups for every user.")
+    parser.add_argument("--credentials", required=True, help="Path to the Firebase service account key JSON file.")
+    parser.add_argument("--page-size", type=int, default=200, help="Profiles fetched per Firestore page.")
+    parser.add_argument("--workers", type=int, default=8, help="Maximum users processed concurrently.")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT, help="Where progress is recorded between runs.")
+    parser.add_argument("--no-gpt", action="store_true", help="Use rule-based suggestions instead of calling OpenAI.")
+    parser.add_argument("--reset", action="store_true", help="Ignore any existing checkpoint and start from the first user.")
+    args = parser.parse_args(argv)
+
+    load_dotenv(os.path.join(_this_dir, ".env2"))
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+
+    # A batch job doesn't need the periodic health check
+    db = connect(args.credentials, health_check_interval=None).db
+    checkpoint = run(db, args.page_size, args.workers, args.checkpoint, use_gpt=not args.no_gpt, reset=args.reset)
+    return 1 if checkpoint["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,215 @@
+"""
+Write-behind Firestore writer.
+
+Submitting a sleep log used to block the page on the Firestore round trip (plus
+a fixed sleep "to give Firestore a moment") before redirecting, and a log or
+profile saved while Firestore was down was simply lost. The app now applies the
+change locally straight away and hands the write to a `BackgroundWriter`: every
+write is first made durable in a WriteQueue on disk, then one daemon thread per
+process flushes the queue to Firestore in batches. While the backend is down
+(or `db` is None) writes stay queued and are retried with exponential backoff
+and jitter. A write Firestore rejects outright (an invalid field, a document
+over the size limit) would block the queue forever, so a batch failing that way
+is split to find the bad job, which goes to a dead-letter file; the rest of
+the batch goes through, and only the bad job's user is told. Given a `health`
+source (the FirebaseClient), the writer also holds off flushing while its health
+check says Firestore is unreachable.
+"""
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from google.api_core import exceptions as api_exceptions
+
+from sleepaid_queue import open_queue
+
+_this_dir = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_QUEUE_PATH = os.getenv("SLEEPAID_WRITE_QUEUE", os.path.join(_this_dir, "data", "write_queue.jsonl"))
+
+KINDS = ("log", "profile")
+BATCH_SIZE = 100     # Firestore allows up to 500 writes per batch
+IDLE_POLL = 5.0      # seconds between checks when there's nothing to do (or no db yet, or it's unreachable)
+BACKOFF_BASE = 0.5   # seconds before the first retry, doubled on each attempt
+BACKOFF_CAP = 60.0
+
+
+def document_for(db, job):
+    """The Firestore document a write job targets."""
+    if job["kind"] == "log":
+        # Logs use their date as the document id, so replaying a write is harmless
+        return db.collection('users').document(job["uid"]).collection('sleep_logs').document(job["key"])
+    if job["kind"] == "profile":
+        return db.collection('user_profiles').document(job["uid"])
+    raise ValueError(f"Unknown write kind: {job['kind']}")
+
+def is_permanent(error):
+    """
+    Errors retrying can't fix, because they're about the write itself: Firestore
+    rejecting the request (bad argument, document too large, missing parent) or
+    the client failing to serialize it. Outages, timeouts, contention, quota and
+    credentials problems affect every write alike and are retried.
+    """
+    return isinstance(error, (api_exceptions.BadRequest, api_exceptions.NotFound, ValueError, TypeError))
+
+def describe(job):
+    if job["kind"] == "log":
+        return f"sleep log for {job['key']}"
+    return "profile"
+
+
+class BackgroundWriter:
+    def __init__(self, db, queue_path=DEFAULT_QUEUE_PATH, batch_size=BATCH_SIZE, backoff_base=BACKOFF_BASE, backoff_cap=BACKOFF_CAP, on_applied=None,
+                 dead_letter_path=None, health=None):
+        self.db = db
+        # Anything with a `healthy` flag (the FirebaseClient); flushing pauses while it's False
+        self.health = health
+        # Next to the queue unless given (data/write_queue_dead_letter.jsonl by default)
+        self.dead_letter_path = dead_letter_path or os.path.splitext(queue_path)[0] + "_dead_letter.jsonl"
+        # Called with the list of jobs after each batch reaches Firestore
+        self.on_applied = on_applied
+        # This process's own slot of the queue file (see sleepaid_queue)
+        self.queue = open_queue(queue_path)
+        self.batch_size = batch_size
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.healthy = db is not None
+        self.last_error = None
+        self._wake = threading.Event()
+        self._failures = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="sleepaid-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, kind, uid, key, data):
+        """Record a write durably and return; it reaches Firestore in the background."""
+        self.submit_many([(kind, uid, key, data)])
+
+    def submit_many(self, writes):
+        """
+        Record several (kind, uid, key, data) writes with one fsync. They share a group id,
+        so they are always flushed together in one batch.
+        """
+        queued_at = datetime.now().isoformat()
+        group = uuid.uuid4().hex if len(writes) > 1 else None
+        jobs = []
+        for kind, uid, key, data in writes:
+            if kind not in KINDS:
+                raise ValueError(f"Unknown write kind: {kind}")
+            job = {"kind": kind, "uid": uid, "key": key, "data": data, "queued_at": queued_at}
+            if group:
+                job["group"] = group
+            jobs.append(job)
+        self.queue.put_many(jobs)
+        self._wake.set()
+
+    @property
+    def depth(self):
+        """Writes waiting for Firestore, across all users."""
+        return self.queue.depth
+
+    def pending(self, kind, uid):
+        """{key: data} for this user's queued writes of one kind, newest per document."""
+        return self.queue.pending_for(kind, uid)
+
+    def pop_failures(self, uid):
+        """Writes for `uid` that Firestore rejected since the last call, as (job, error message) pairs."""
+        with self._lock:
+            return self._failures.pop(uid, [])
+
+    def flush(self, timeout=None):
+        """Block until the queue is empty. Returns False if `timeout` ran out first."""
+        self._wake.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.queue.depth:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def _backoff(self, attempt):
+        delay = min(self.backoff_cap, self.backoff_base * 2 ** (attempt - 1))
+        return random.uniform(delay / 2, delay)  # jitter so retries don't line up
+
+    def _write_batch(self, batch):
+        write_batch = self.db.batch()
+        for _, job in batch:
+            write_batch.set(document_for(self.db, job), job["data"])
+        write_batch.commit()
+
+    def _write_isolating(self, batch):
+        """
+        Write `batch`, splitting it in halves while it fails permanently. Returns the
+        (entry, error) pairs that fail on their own; retryable errors are raised. Writes
+        submitted together are never split: a group with a rejected write is rejected whole.
+        """
+        units = {}
+        for entry in batch:
+            units.setdefault(entry[1].get("group") or id(entry), []).append(entry)
+        return self._isolate(list(units.values()))
+
+    def _isolate(self, units):
+        try:
+            self._write_batch([entry for unit in units for entry in unit])
+            return []
+        except Exception as e:
+            if not is_permanent(e):
+                raise
+            if len(units) == 1:
+                return [(entry, str(e)) for entry in units[0]]
+            mid = len(units) // 2
+            return self._isolate(units[:mid]) + self._isolate(units[mid:])
+
+    def _dead_letter(self, rejected):
+        """Set rejected writes aside (durably) and tell their users."""
+        failed_at = datetime.now().isoformat()
+        os.makedirs(os.path.dirname(self.dead_letter_path) or ".", exist_ok=True)
+        with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+            for (_, job), error in rejected:
+                f.write(json.dumps({"job": job, "error": error, "failed_at": failed_at}, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        with self._lock:
+            for (_, job), error in rejected:
+                self._failures.setdefault(job["uid"], []).append((job, error))
+        print(f"Write queue: moved {len(rejected)} rejected write(s) to {self.dead_letter_path}")
+
+    def available(self):
+        """Whether there's a db to flush to and its health check (if any) last passed."""
+        return self.db is not None and (self.health is None or self.health.healthy)
+
+    def _run(self):
+        attempt = 0
+        while True:
+            batch = self.queue.peek(self.batch_size) if self.available() else []
+            if not batch:
+                self._wake.wait(IDLE_POLL)
+                self._wake.clear()
+                continue
+            try:
+                rejected = self._write_isolating(batch)
+            except Exception as e:
+                # Nothing is lost (the batch stays queued) and every user's writes wait alike,
+                # so this isn't reported per user; the sidebar shows what's waiting to sync
+                attempt += 1
+                self.healthy = False
+                self.last_error = str(e)
+                print(f"Write queue flush failed (attempt {attempt}, {self.queue.depth} pending): {e}")
+                time.sleep(self._backoff(attempt))
+                continue
+            if rejected:
+                self._dead_letter(rejected)
+            seqs = [seq for group, _ in batch for seq in group]
+            self.queue.ack(seqs)
+            attempt = 0
+            self.healthy = True
+            rejected_seqs = {seq for (group, _), _ in rejected for seq in group}
+            applied = [job for group, job in batch if group[-1] not in rejected_seqs]
+            if self.on_applied and applied:
+                try:
+                    self.on_applied(applied)
+                except Exception as e:
+                    print(f"Write queue on_applied hook failed: {e}")
@@ -0,0 +1,133 @@
+"""
+Tests for the resilient OpenAI layer against a local mock server (no network, no key):
+
+    python -m pytest -q test_sleepaid_openai.py
+"""
+import threading
+import time
+import unittest
+from unittest import mock
+
+import openai
+
+import sleepaid_openai
+from sleepaid_mock_openai import MockOpenAI
+from sleepaid_openai import FAILURE_THRESHOLD, CircuitBreaker, ResilientClient, SuggestionUnavailable
+
+MESSAGES = [{"role": "user", "content": "How did I sleep?"}]
+
+
+class ResilientClientTest(unittest.TestCase):
+    def setUp(self):
+        self.mock = MockOpenAI().start()
+        self.addCleanup(self.mock.stop)
+        patcher = mock.patch.object(openai, "api_key", "mock-key")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def client(self, **kwargs):
+        kwargs.setdefault("max_retries", 0)
+        return ResilientClient(base_url=self.mock.url, **kwargs)
+
+    def call_concurrently(self, client, n):
+        """Results of `n` simultaneous chat calls: content, or the SuggestionUnavailable message."""
+        results = []
+        def call():
+            try:
+                results.append(client.chat(MESSAGES, model="mock"))
+            except SuggestionUnavailable as e:
+                results.append(f"unavailable: {e}")
+        threads = [threading.Thread(target=call) for _ in range(n)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        return results
+
+    def test_success(self):
+        self.assertEqual(self.client().chat(MESSAGES, model="mock"), self.mock.content)
+
+    def test_breaker_opens_after_threshold_failures(self):
+        client = self.client()
+        self.mock.mode = "error"
+        for _ in range(FAILURE_THRESHOLD):
+            self.assertEqual(client.breaker.state, "closed")
+            with self.assertRaises(SuggestionUnavailable):
+                client.chat(MESSAGES, model="mock")
+        self.assertEqual(client.breaker.state, "open")
+        # Refused without reaching the server, even once it has recovered
+        self.mock.mode = "ok"
+        with self.assertRaisesRegex(SuggestionUnavailable, "circuit open"):
+            client.chat(MESSAGES, model="mock")
+        self.assertEqual(self.mock.requests, FAILURE_THRESHOLD)
+
+    def test_one_half_open_trial_at_a_time(self):
+        client = self.client(breaker=CircuitBreaker(failure_threshold=1, reset_after=0.2))
+        self.mock.mode = "error"
+        with self.assertRaises(SuggestionUnavailable):
+            client.chat(MESSAGES, model="mock")
+        time.sleep(0.3)
+        self.assertEqual(client.breaker.state, "half-open")
+        self.mock.mode, self.mock.delay = "ok", 0.5
+        results = self.call_concurrently(client, 5)
+        self.assertEqual(results.count(self.mock.content), 1)
+        self.assertEqual(results.count("unavailable: circuit open"), 4)
+        self.assertEqual(self.mock.max_in_flight, 1)
+        self.assertEqual(client.breaker.state, "closed")
+
+    def test_failed_trial_reopens_and_frees_the_next_trial(self):
+        client = self.client(breaker=CircuitBreaker(failure_threshold=1, reset_after=0.2))
+        self.mock.mode = "error"
+        with self.assertRaises(SuggestionUnavailable):
+            client.chat(MESSAGES, model="mock")
+        time.sleep(0.3)
+        with self.assertRaises(SuggestionUnavailable):
+            client.chat(MESSAGES, model="mock")
+        self.assertEqual(client.breaker.state, "open")
+        time.sleep(0.3)
+        self.mock.mode = "ok"
+        self.assertEqual(client.chat(MESSAGES, model="mock"), self.mock.content)
+
+    def test_deadline_bounds_a_hanging_upstream(self):
+        client = self.client(call_timeout=0.3, total_deadline=1.0, max_retries=10)
+        self.mock.delay = 5.0
+        started = time.monotonic()
+        with self.assertRaises(SuggestionUnavailable):
+            client.chat(MESSAGES, model="mock")
+        elapsed = time.monotonic() - started
+        self.assertLess(elapsed, client.total_deadline + 0.5)
+        self.assertGreater(self.mock.requests, 1)  # timeouts were retried until the deadline
+
+    def test_bad_request_is_not_retried(self):
+        client = self.client(max_retries=3)
+        self.mock.mode = "bad_request"
+        with self.assertRaises(SuggestionUnavailable):
+            client.chat(MESSAGES, model="mock")
+        self.assertEqual(self.mock.requests, 1)
+
+    def test_concurrency_slots_turn_callers_away(self):
+        client = self.client(max_concurrency=2)
+        self.mock.delay = 0.5
+        with mock.patch.object(sleepaid_openai, "SLOT_WAIT", 0.1):
+            results = self.call_concurrently(client, 4)
+        self.assertEqual(results.count(self.mock.content), 2)
+        self.assertEqual(results.count("unavailable: too many concurrent requests"), 2)
+        self.assertEqual(self.mock.max_in_flight, 2)
+        # Being turned away isn't the upstream's fault
+        self.assertEqual(client.breaker.failures, 0)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_half_open_lets_one_trial_through(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_after=0.0)
+        breaker.record_failure()
+        self.assertEqual(breaker.allow(), "trial")
+        self.assertFalse(breaker.allow())
+        breaker.release_trial()
+        self.assertEqual(breaker.allow(), "trial")
+        breaker.record_success()
+        self.assertIs(breaker.allow(), True)
+
+
+if __name__ == "__main__":
+    unittest.main()